@@ -5,6 +5,8 @@ import logging
 from flask import Flask
 app = Flask(__name__)
 app.config.from_object("config.ActiveConfig")
+if app.config['ARCHIVE_DAYS'] and not app.config['ARCHIVE_DIR']:
+    raise RuntimeError("ARCHIVE_DIR must be set when ARCHIVE_DAYS is enabled")
 
 # setup logging
 def _get_logger():
@@ -23,9 +25,38 @@ def _get_logger():
 logger = _get_logger()
 
 # Load ORM
-from model import db
+from model import db, Run, CaseHistory, STATISTICS_BACKFILL
 db.init_app(app)
 
+def _save_statistics(statistics):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            Run.save_statistics(connection, statistics)
+
+@app.after_request
+def save_statistics(response):
+    """
+    Save statistics generated during the request after response is sent,
+    so listing test runs stays read only.
+    """
+    statistics = db.session.info.pop(STATISTICS_BACKFILL, None)
+    if statistics:
+        response.call_on_close(lambda: _save_statistics(statistics))
+    return response
+
+@app.teardown_request
+def save_streamed_statistics(error=None):
+    """
+    Save statistics generated while streaming a response, which happens
+    after save_statistics ran.
+    """
+    statistics = db.session.info.pop(STATISTICS_BACKFILL, None)
+    if statistics:
+        try:
+            _save_statistics(statistics)
+        except Exception:
+            logger.exception("Failed to save statistics of %s test runs", len(statistics))
+
 # Celery task entry
 from celery import Celery
 def make_celery(app):
@@ -46,6 +77,7 @@ celery = make_celery(app)
 # Load utils
 from caselink import CASELINK_URL
 app.config.update({"CASELINK_URL": CASELINK_URL})
+from utils import response_cache as ResponseCache
 
 # Load Views
 from views.api import restful_api
@@ -59,10 +91,43 @@ app.register_blueprint(restful_api, url_prefix="/api")
 app.register_blueprint(dt_api, url_prefix="/dt")
 app.register_blueprint(dashboard_statistics, url_prefix="/statistics")
 
+if app.config['METRICS_ENABLED']:
+    from utils import metrics as Metrics
+    Metrics.init_app(app)
+    Metrics.init_celery(celery)
+
 def initdb():
     "Initialize the database"
     with app.app_context():
         db.create_all()
+        ResponseCache.clear()
+
+def rebuild_statistics():
+    "Recount statistics and case history of all test runs"
+    with app.app_context():
+        count = Run.rebuild_statistics()
+        CaseHistory.rebuild()
+        db.session.commit()
+        logger.info("Statistics of %s test runs rebuilt", count)
+        ResponseCache.clear()
+
+def rollup_statistics():
+    "Regenerate daily rollup of auto results of all days in the database"
+    from tasks.statistics import rollup_statistics as _rollup
+    with app.app_context():
+        logger.info("Daily rollup of %(rows)s rows regenerated", _rollup(days=None))
+
+def purge_runs(days):
+    "Delete test runs older than given days"
+    from tasks.retention import purge_runs as _purge
+    with app.app_context():
+        logger.info("%(runs)s test runs and %(blobs)s blobs deleted", _purge(days=int(days)))
+
+def archive_runs(days):
+    "Move results of test runs older than given days to archive files"
+    from tasks.retention import archive_runs as _archive
+    with app.app_context():
+        logger.info("%(runs)s test runs archived, %(blobs)s blobs deleted", _archive(days=int(days)))
 
 # Load Migration
 from flask_migrate import Migrate
@@ -0,0 +1,396 @@
+#!/bin/env python
+"""
+Benchmarks for libvirt-dashboard.
+
+Synthetic test runs are written straight into the database given by
+--database, then each scenario is timed and the results are printed as
+JSON. Pass the JSON of a previous version as --baseline to spot
+regressions, exit status is 1 if any scenario failed, or got slower than
+allowed or went missing since the baseline.
+
+    python -m app.bench --runs 200 --cases 1000 --output bench.json
+"""
+import sys
+import json
+import math
+import random
+import timeit
+import argparse
+import datetime
+import platform
+import subprocess
+
+import six.moves as sm
+
+import app
+from app.model import db, Run, Tag, AutoResult, ManualResult, Blob, CaseHistory, CaseName, \
+    run_tags_table
+from app.utils import blob as Blobs
+from app.utils import polarion as Polarion
+from app.utils import response_cache as ResponseCache
+
+INSERT_CHUNK_SIZE = 5000
+
+WORDS = ['libvirt', 'qemu', 'domain', 'virsh', 'guest', 'device', 'attach',
+         'detach', 'migrate', 'snapshot', 'pool', 'volume', 'network', 'cpu',
+         'memory', 'timeout', 'error', 'failed', 'unexpected', 'xml', 'disk']
+
+COMPONENTS = ['libvirt', 'qemu-kvm', 'virt-install', 'libguestfs']
+ARCHES = ['x86_64', 'ppc64le', 'aarch64', 's390x']
+
+
+def _text(rnd, size):
+    lines, length = [], 0
+    while length < size:
+        line = " ".join(rnd.choice(WORDS) for _ in sm.range(rnd.randint(4, 16)))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+class Generator(object):
+    """
+    Write synthetic test runs, their auto and manual results with bulk
+    inserts, bypassing the API and linkage generation.
+
+    Texts are picked from a pool of distinct texts, sizes follow a log
+    normal distribution around failure_size / output_size.
+    """
+    def __init__(self, runs, cases, failure_size=2048, output_size=8192, texts=1000,
+                 fail_ratio=0.1, skip_ratio=0.05, names=20, seed=0):
+        self.runs = runs
+        self.cases = cases
+        self.failure_size = failure_size
+        self.output_size = output_size
+        self.texts = texts
+        self.fail_ratio = fail_ratio
+        self.skip_ratio = skip_ratio
+        self.names = names
+        self.rnd = random.Random(seed)
+
+    def _pool(self, size):
+        blobs, digests = {}, []
+        for _ in sm.range(self.texts):
+            length = min(int(self.rnd.lognormvariate(math.log(size), 1)), size * 32)
+            digest, codec, length, payload = Blobs.encode(_text(self.rnd, max(length, 16)))
+            blobs[digest] = (codec, length, payload)
+            digests.append(digest)
+        Blob.save(db.session.connection(), blobs)
+        return digests
+
+    @staticmethod
+    def _auto_case(idx):
+        return 'bench.group%s.case%s' % (idx % 50, idx)
+
+    @staticmethod
+    def _manual_case(idx):
+        # Ten auto cases per manual case
+        return 'RHEL7-%s' % (10000 + idx // 10)
+
+    def _result(self):
+        value = self.rnd.random()
+        if value < self.fail_ratio:
+            return 'failed'
+        if value < self.fail_ratio + self.skip_ratio:
+            return 'skipped'
+        return 'passed'
+
+    def _insert(self, table, rows):
+        for idx in range(0, len(rows), INSERT_CHUNK_SIZE):
+            db.session.execute(table.insert(), rows[idx:idx + INSERT_CHUNK_SIZE])
+
+    def generate(self):
+        """
+        Generate the test runs, return ids of them, oldest first.
+        """
+        failures = self._pool(self.failure_size)
+        outputs = self._pool(self.output_size)
+        tags = ['bench-%s' % idx for idx in range(10)]
+        self._insert(Tag.__table__, [{'name': tag} for tag in tags
+                                     if Tag.query.get(tag) is None])
+        # Every run has the same cases
+        CaseName.record(db.session.connection(),
+                        [self._manual_case(idx) for idx in sm.range(self.cases)])
+        case_ids = CaseName.ids(db.session.connection(),
+                                [self._auto_case(idx) for idx in sm.range(self.cases)])
+        db.session.commit()
+
+        start = datetime.datetime.now() - datetime.timedelta(hours=self.runs)
+        run_ids = []
+        for idx in sm.range(self.runs):
+            counts = {'auto_passed': 0, 'auto_failed': 0, 'auto_skipped': 0,
+                      'manual_passed': 0, 'manual_failed': 0, 'manual_error': 0}
+            autos, manuals = [], {}
+            for case_idx in sm.range(self.cases):
+                result = self._result()
+                counts['auto_' + result] += 1
+                autos.append({
+                    'case_id': case_ids[self._auto_case(case_idx)],
+                    'time': self.rnd.uniform(0.5, 120.0),
+                    'result': result,
+                    'output_digest': self.rnd.choice(outputs),
+                    'failure_digest': self.rnd.choice(failures) if result == 'failed' else None,
+                    'skip_digest': self.rnd.choice(failures) if result == 'skipped' else None,
+                })
+                # Manual case failed if any of its auto cases failed
+                manual = self._manual_case(case_idx)
+                if manuals.get(manual) != 'failed' and result != 'skipped':
+                    manuals[manual] = result
+            for manual_result in manuals.values():
+                counts[ManualResult.statistics_col(manual_result)] += 1
+
+            run_id = db.session.execute(Run.__table__.insert().values(
+                name='bench-job-%s' % (idx % self.names),
+                component=COMPONENTS[idx % len(COMPONENTS)],
+                build='bench-build-%s' % (idx // 10),
+                product='RHEL', version='7.%s' % (idx % 5),
+                arch=ARCHES[idx % len(ARCHES)],
+                type='acceptance', framework='libvirt-autotest', project='VIRTTP',
+                date=start + datetime.timedelta(hours=idx),
+                ci_url='http://ci.example.com/job/%s' % idx,
+                **counts)).inserted_primary_key[0]
+
+            for auto in autos:
+                auto['run_id'] = run_id
+            self._insert(AutoResult.__table__, autos)
+            self._insert(ManualResult.__table__, [
+                {'run_id': run_id, 'case': case, 'time': 0.0, 'result': manual_result}
+                for case, manual_result in manuals.items()])
+            self._insert(run_tags_table, [
+                {'run_id': run_id, 'tag_name': tag} for tag in self.rnd.sample(tags, 2)])
+            db.session.commit()
+            run_ids.append(run_id)
+
+        CaseHistory.rebuild(run_ids)
+        db.session.commit()
+        return run_ids
+
+
+class Bench(object):
+    """
+    Timed scenarios, each of them is a method named scenario_<name>,
+    and returns number of rows it handled. A method named cleanup_<name>
+    is called after each timed run, to undo changes of the scenario.
+    """
+    def __init__(self, run_ids, cases, repeat=3):
+        self.run_ids = run_ids
+        self.cases = cases
+        self.repeat = repeat
+        self.client = app.app.test_client()
+        self.rnd = random.Random(0)
+        self.ingested = []
+
+    @classmethod
+    def scenarios(cls):
+        return sorted(name[len('scenario_'):] for name in dir(cls)
+                      if name.startswith('scenario_'))
+
+    def _get(self, url):
+        rv = self.client.get(url)
+        if rv.status_code != 200:
+            raise RuntimeError("GET %s returned %s" % (url, rv.status_code))
+        return rv
+
+    def scenario_ingest(self):
+        rv = self.client.post('/api/run/', data={
+            "name": "bench-ingest", "component": "libvirt", "build": "bench-build",
+            "product": "RHEL", "version": "7.3", "arch": "x86_64", "type": "acceptance",
+            "framework": "libvirt-autotest", "project": "VIRTTP",
+            "date": datetime.datetime.now().isoformat(),
+            "ci_url": "http://ci.example.com/job/ingest",
+        })
+        run_id = json.loads(rv.data)['id']
+        self.ingested.append(run_id)
+        results = [{'case': 'bench.ingest.case%s' % idx, 'time': '1.5',
+                    'output': _text(self.rnd, 2048),
+                    'failure': _text(self.rnd, 1024) if idx % 10 == 0 else None}
+                   for idx in sm.range(self.cases)]
+        rv = self.client.post('/api/run/%s/bulk/auto/' % run_id, data=json.dumps(results),
+                              content_type='application/json')
+        if rv.status_code != 200:
+            raise RuntimeError("Bulk submit returned %s" % rv.status_code)
+        return len(results)
+
+    def cleanup_ingest(self):
+        Run.delete_runs(self.ingested)
+        db.session.commit()
+        Blob.delete_unreferenced(Blob.unreferenced(0), 0)
+        db.session.commit()
+        self.ingested = []
+
+    def scenario_refresh(self):
+        from app.tasks import refresh_auto
+        return refresh_auto(self.run_ids[-1])['total']
+
+    def scenario_datatables(self):
+        rv = self._get('/dt/run/?draw=1&start=0&length=25&order[0][column]=1&order[0][dir]=desc')
+        return json.loads(rv.data)['recordsFiltered']
+
+    def scenario_datatables_search(self):
+        rv = self._get('/dt/run/?draw=1&start=0&length=25&search[value]=job-1'
+                       '&hasTags=%5B%22bench-1%22%5D')
+        return json.loads(rv.data)['recordsFiltered']
+
+    def scenario_run_list(self):
+        return len(json.loads(self._get('/api/run/').data))
+
+    def scenario_auto_list(self):
+        return len(json.loads(self._get('/api/run/%s/auto/' % self.run_ids[-1]).data))
+
+    def scenario_statistics(self):
+        rows = len(json.loads(self._get('/statistics/auto/').data))
+        rows += len(json.loads(self._get('/statistics/run/').data))
+        return rows
+
+    def scenario_case_history(self):
+        rv = self._get('/statistics/auto/bench.group0.case0?limit=100')
+        return len(json.loads(rv.data)['history'])
+
+    def scenario_diff(self):
+        rv = self._get('/api/diff/%s/%s/' % tuple(self.run_ids[-2:]))
+        return len(json.loads(rv.data)['cases'])
+
+    def scenario_xunit(self):
+        from app.tasks.polarion import _submitted_results, _polarion_counts, _polarion_result
+        run_id = self.run_ids[-1]
+        record = Polarion.TestRunRecord('BENCH', 'bench-run-%s' % run_id)
+        records = _submitted_results(run_id)\
+            .with_entities(ManualResult.case, ManualResult.result,
+                           ManualResult.time, ManualResult.comment)\
+            .order_by(ManualResult.case)\
+            .yield_per(256)
+        record.stream_testcases(((case, _polarion_result(result), time, comment)
+                                 for case, result, time, comment in records),
+                                _polarion_counts(run_id))
+        return sum(len(chunk) for chunk in record.tss.iter_xml())
+
+    def run(self, name):
+        times, rows = [], None
+        for _ in sm.range(self.repeat):
+            # Time cold responses
+            ResponseCache.clear()
+            start = timeit.default_timer()
+            try:
+                rows = getattr(self, 'scenario_' + name)()
+                times.append(timeit.default_timer() - start)
+            finally:
+                db.session.rollback()
+                getattr(self, 'cleanup_' + name, lambda: None)()
+                db.session.remove()
+        times.sort()
+        return {
+            'times': times,
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1],
+            'rows': rows,
+        }
+
+
+def _version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline, tolerance, names=None):
+    """
+    Add ratio of medians against baseline to each scenario, return names
+    of scenarios slower than baseline by more than tolerance, and of
+    scenarios of baseline missing from result, among names if given.
+    """
+    regressions = [name for name in baseline.get('scenarios', {})
+                   if name not in result['scenarios'] and (names is None or name in names)]
+    for name, scenario in result['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base or 'median' not in base or 'median' not in scenario or not base['median']:
+            continue
+        scenario['baseline_ratio'] = scenario['median'] / base['median']
+        if scenario['baseline_ratio'] > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmarks for libvirt-dashboard.')
+    parser.add_argument('--database', dest='database', default='sqlite:////tmp/bench.db',
+                        help='Database URL, sqlite or postgresql.')
+    parser.add_argument('--runs', dest='runs', type=int, default=100,
+                        help='Number of test runs to generate.')
+    parser.add_argument('--cases', dest='cases', type=int, default=500,
+                        help='Number of auto cases of each test run.')
+    parser.add_argument('--failure-size', dest='failure_size', type=int, default=2048,
+                        help='Typical size of failure texts in bytes.')
+    parser.add_argument('--output-size', dest='output_size', type=int, default=8192,
+                        help='Typical size of output texts in bytes.')
+    parser.add_argument('--texts', dest='texts', type=int, default=1000,
+                        help='Number of distinct failure and output texts.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--reuse', dest='reuse', action='store_true', default=False,
+                        help='Use runs already in the database instead of generating.')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                        help='Times to run each scenario.')
+    parser.add_argument('--scenario', dest='scenarios', action='append', default=None,
+                        choices=Bench.scenarios(), help='Scenario to run, default all.')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='Write results to this file instead of stdout.')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='Results of a previous version to compare with.')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='Allowed slow down against baseline, as a ratio.')
+    args = parser.parse_args()
+
+    app.app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.initdb()
+
+    result = {
+        'version': _version(),
+        'python': platform.python_version(),
+        'database': args.database.split(':', 1)[0],
+        'params': {'runs': args.runs, 'cases': args.cases, 'failure_size': args.failure_size,
+                   'output_size': args.output_size, 'texts': args.texts,
+                   'seed': args.seed, 'repeat': args.repeat},
+        'scenarios': {},
+    }
+
+    with app.app.app_context():
+        if args.reuse:
+            run_ids = [run_id for run_id, in db.session.query(Run.id).order_by(Run.date)]
+            result['params']['runs'] = len(run_ids)
+        else:
+            generator = Generator(args.runs, args.cases, args.failure_size, args.output_size,
+                                  args.texts, seed=args.seed)
+            start = timeit.default_timer()
+            run_ids = generator.generate()
+            result['generate'] = {'seconds': timeit.default_timer() - start,
+                                  'auto_results': args.runs * args.cases}
+
+        bench = Bench(run_ids, args.cases, args.repeat)
+        for name in args.scenarios or Bench.scenarios():
+            try:
+                result['scenarios'][name] = bench.run(name)
+            except Exception as error:
+                db.session.rollback()
+                result['scenarios'][name] = {'error': '%s: %s' % (type(error).__name__, error)}
+
+    failures = sorted(name for name, scenario in result['scenarios'].items()
+                      if 'error' in scenario)
+    result['failures'] = failures
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(result, json.load(fp), args.tolerance, args.scenarios)
+        result['regressions'] = regressions
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+    sys.exit(1 if regressions or failures else 0)
+
+if __name__ == '__main__':
+    run()
@@ -1,15 +1,35 @@
-import re
-import caselink as CaseLink
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import validates, load_only, deferred
-from sqlalchemy.orm.session import object_session
-from sqlalchemy import func, ForeignKeyConstraint
+import datetime
+import time
+
+from sqlalchemy.ext.hybrid import hybrid_property, Comparator
+from sqlalchemy.orm import validates, column_property, attributes
+from sqlalchemy.orm.session import Session, object_session
+from sqlalchemy import event, func, and_, or_, select, union, bindparam, ForeignKeyConstraint, DDL
 from flask_sqlalchemy import SQLAlchemy
-from requests import HTTPError, ConnectionError
+
+from ..utils.matcher import get_matcher
+from ..utils import blob as Blobs
 
 
 db = SQLAlchemy()
 
+# Max number of values in a IN clause
+BATCH_SIZE = 500
+
+# Blobs touched within BLOB_TOUCH_INTERVAL seconds are not touched again
+# on save, grace period of Blob.delete_unreferenced must be longer than
+# this plus the longest transaction saving results
+BLOB_TOUCH_INTERVAL = 600
+
+# Session info key of statistics waiting to be saved
+STATISTICS_BACKFILL = 'statistics_backfill'
+
+# Session info key of runs with statistics changed by last flush
+STATISTICS_CHANGED = 'statistics_changed'
+
+# Instance dict key of case names, by name of the id column
+CASE_NAMES = '_case_names'
+
 
 def get_or_create(session, model, **kwargs):
     instance = session.query(model).filter_by(**kwargs).first()
@@ -21,6 +41,72 @@ def get_or_create(session, model, **kwargs):
         return instance, True
 
 
+def insert_ignore(connection, table):
+    """
+    INSERT statement skipping rows conflicting with existing keys.
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    elif dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+
+def manual_result_of(linkage_results):
+    """
+    Result of a manual case according to its linkage results.
+    """
+    if any(r.result == "failed" for r in linkage_results):
+        return "failed"
+
+    elif any(r.result is None for r in linkage_results):
+        return "incomplete"
+
+    elif all(r.result in ["ignored", "skipped", "passed"] for r in linkage_results):
+        if any(r.result == "passed" for r in linkage_results):
+            return "passed"
+        else:
+            return "skipped"
+
+    else:
+        return "incomplete"
+
+
+def linkage_comment_of(linkage_results, linked_id, blocking_fmt):
+    """
+    Generate a human readable text decscripting the linkage results,
+    linked_id is the attribute name of the case on the other side.
+    """
+    comments = []
+    for result in linkage_results:
+        _result = result.result
+        _error = result.error
+        _linked = getattr(result, linked_id)
+        if result.result:
+            if result.detail:
+                comments.append("%s: \"%s\" with detail: %s" %
+                                (_result.title(), _linked, result.detail))
+            else:
+                comments.append("%s: \"%s\"" %
+                                (_result.title(), _linked))
+        else:
+            comments.append(blocking_fmt % (_error, _linked))
+    comments.sort()
+    return "\n".join(comments)
+
+
+def auto_comment_of(linkage_results):
+    return linkage_comment_of(linkage_results, 'manual_result_id', "Blocking with %s: %s")
+
+
+def manual_comment_of(linkage_results):
+    return linkage_comment_of(linkage_results, 'auto_result_id', "Blocking with %s : %s")
+
+
 run_tags_table = \
     db.Table('test_run_tags',
              db.Column('run_id', db.Integer, db.ForeignKey('run.id'), index=True),
@@ -34,7 +120,7 @@ class Property(db.Model):
     run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
     run = db.relationship('Run', back_populates='properties', single_parent=True)
 
-    name = db.Column(db.String(255), nullable=False, primary_key=True, index=True)
+    name = db.Column(db.String(255), nullable=False, primary_key=True)
     value = db.Column(db.String(65535), nullable=False)
 
     def __repr__(self):
@@ -50,7 +136,7 @@ class Tag(db.Model):
     __tablename__ = 'tag'
 
     runs = db.relationship('Run', secondary=run_tags_table, back_populates='tags', lazy='dynamic')
-    name = db.Column(db.String(255), nullable=False, primary_key=True, index=True)
+    name = db.Column(db.String(255), nullable=False, primary_key=True)
     desc = db.Column(db.String(255), nullable=True)
 
     def __repr__(self):
@@ -71,12 +157,19 @@ class Tag(db.Model):
 class Run(db.Model):
     __tablename__ = 'run'
     __table_args__ = (
+        # Also serves lookups by name, and by name in a date range
         db.UniqueConstraint('name', 'date', name='_test_run_id_uc'),
+        # Run lists are ordered by date
+        db.Index('ix_run_date_id', 'date', 'id'),
+        db.Index('ix_run_submit_date_date', 'submit_date', 'date'),
         {'sqlite_autoincrement': True}, # For SQLite support
     )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    name = db.Column(db.String(255), unique=False, nullable=False, index=True)
+    # Load old value on change, needed for keeping the daily rollup
+    # and case history
+    name = column_property(db.Column(db.String(255), unique=False, nullable=False),
+                           active_history=True)
     component = db.Column(db.String(255), unique=False, nullable=False)
     build = db.Column(db.String(255), unique=False, nullable=False)
     product = db.Column(db.String(255), unique=False, nullable=False)
@@ -85,7 +178,8 @@ class Run(db.Model):
     type = db.Column(db.String(255), unique=False, nullable=False)
     framework = db.Column(db.String(255), unique=False, nullable=False)
     project = db.Column(db.String(255), unique=False, nullable=False)
-    date = db.Column(db.DateTime(), unique=False, nullable=False)
+    date = column_property(db.Column(db.DateTime(), unique=False, nullable=False),
+                           active_history=True)
 
     ci_url = db.Column(db.String(65535), unique=False, nullable=False)
     description = db.Column(db.Text(), unique=False, nullable=True)
@@ -93,11 +187,13 @@ class Run(db.Model):
     tags = db.relationship('Tag', secondary=run_tags_table, back_populates='runs', lazy='dynamic')
     properties = db.relationship('Property', back_populates='run', lazy='dynamic')
 
-    submit_date = db.Column(db.DateTime(), nullable=True, index=True)
-    submit_status = db.Column(db.String(4095), nullable=True, index=True)
+    submit_date = db.Column(db.DateTime(), nullable=True)
+    submit_status = db.Column(db.String(4095), nullable=True)
     submit_task = db.Column(db.String(128), nullable=True)
     submit_log = db.Column(db.String(1024), nullable=True)
     polarion_id = db.Column(db.String(65535), unique=False, nullable=True)
+    # Results are archived to this file under ARCHIVE_DIR, see model/archive.py
+    archive_path = db.Column(db.String(4095), nullable=True)
 
     auto_results = db.relationship('AutoResult', back_populates='run', lazy='dynamic')
     manual_results = db.relationship('ManualResult', back_populates='run', lazy='dynamic')
@@ -121,6 +217,9 @@ class Run(db.Model):
         return '<TestRun %s>' % self.name
 
     def __init__(self, **run):
+        # Statistics of a new test run are maintained incrementally from the start
+        for col in self.__statistics_cols:
+            setattr(self, col, 0)
         self.update(**run)
 
     def update(self, **kwargs):
@@ -139,38 +238,135 @@ class Run(db.Model):
             for key, value in kwargs.items():
                 setattr(self, key, value)
 
-    def gen_statistics(self):
-        for col in self.__statistics_cols:
-            setattr(self, col, 0)
+    @classmethod
+    def _count_statistics(cls, run_ids):
+        """
+        Count results of test runs by result with GROUP BY queries,
+        return a dict of run id to statistics.
+        """
+        ret = dict((run_id, dict((col, 0) for col in cls.__statistics_cols))
+                   for run_id in run_ids)
+        for model in [AutoResult, ManualResult]:
+            for run_id, result, count in db.session.query(
+                    model.run_id, model.result, func.count())\
+                    .filter(model.run_id.in_(run_ids))\
+                    .group_by(model.run_id, model.result):
+                col = model.statistics_col(result)
+                if col:
+                    ret[run_id][col] += count
+        return ret
 
-        for result in self.auto_results\
-                .options(load_only("result", "comment"))\
-                .all():
-            if result.result == 'passed':
-                self.auto_passed = (self.auto_passed or 0) + 1
-            elif result.result == 'failed':
-                self.auto_failed = (self.auto_failed or 0) + 1
-            elif result.result == 'skipped':
-                self.auto_skipped = (self.auto_skipped or 0) + 1
-
-        for result in self.manual_results\
-                .options(load_only("result"))\
-                .all():
-            if result.result == 'failed':
-                self.manual_failed = (self.manual_failed or 0) + 1
-            elif result.result == 'passed':
-                self.manual_passed = (self.manual_passed or 0) + 1
-            else:
-                self.manual_error = (self.manual_error or 0) + 1
+    def count_statistics(self):
+        """
+        Count results of this test run by result.
+        """
+        return self._count_statistics([self.id])[self.id]
+
+    def gen_statistics(self):
+        for col, value in self.count_statistics().items():
+            setattr(self, col, value)
 
     def get_statistics(self):
+        """
+        Get statistics of this test run, if they are not generated yet,
+        count them without changing this run, and queue them in the session
+        to be saved later by Run.save_statistics.
+        """
         ret = {}
         for col in self.__statistics_cols:
-            if getattr(self, col) is None:
-                self.gen_statistics()
             ret[col] = getattr(self, col)
+        if any(value is None for value in ret.values()):
+            ret = self.count_statistics()
+            session = object_session(self)
+            if session is not None:
+                session.info.setdefault(STATISTICS_BACKFILL, {})[self.id] = ret
         return ret
 
+    @classmethod
+    def save_statistics(cls, connection, statistics):
+        """
+        Save statistics queued by get_statistics with one batched UPDATE,
+        statistics is a dict of run id to statistics.
+        Runs already have statistics generated are skipped.
+        """
+        if not statistics:
+            return
+        table = cls.__table__
+        stmt = table.update()\
+            .where(table.c.id == bindparam('_id'))\
+            .where(or_(*[table.c[col] == None for col in cls.__statistics_cols]))\
+            .values(dict((col, bindparam(col)) for col in cls.__statistics_cols))
+        connection.execute(stmt, [dict(stat, _id=run_id) for run_id, stat in statistics.items()])
+
+    @classmethod
+    def adjust_statistics(cls, connection, deltas):
+        """
+        Add deltas to statistics in the database, deltas is a dict of
+        run id to {column: delta}. Statistics not generated yet stay None.
+        """
+        table = cls.__table__
+        for run_id, delta in deltas.items():
+            values = dict((col, table.c[col] + value) for col, value in delta.items() if value)
+            if values:
+                connection.execute(table.update().where(table.c.id == run_id).values(values))
+
+    @classmethod
+    def rebuild_statistics(cls, run_ids=None):
+        """
+        Recount statistics of given test runs, or all test runs, and
+        overwrite the stored ones. Used to repair drifted counters.
+        """
+        # Results of archived runs are not in the database
+        query = db.session.query(cls.id).filter(cls.archive_path == None)
+        if run_ids is None:
+            run_ids = [run_id for run_id, in query]
+        else:
+            run_ids = list(run_ids)
+            run_ids = [run_id for idx in range(0, len(run_ids), BATCH_SIZE) for run_id, in
+                       query.filter(cls.id.in_(run_ids[idx:idx + BATCH_SIZE]))]
+        table = cls.__table__
+        stmt = table.update()\
+            .where(table.c.id == bindparam('_id'))\
+            .values(dict((col, bindparam(col)) for col in cls.__statistics_cols))
+        run_ids = list(run_ids)
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            statistics = cls._count_statistics(run_ids[idx:idx + BATCH_SIZE])
+            db.session.execute(stmt, [dict(stat, _id=run_id) for run_id, stat in statistics.items()])
+        _expire_statistics(db.session, run_ids)
+        return len(run_ids)
+
+    @staticmethod
+    def delete_results(run_ids):
+        """
+        Delete auto, manual and linkage results and case history of test
+        runs with set based statements, in current transaction.
+        """
+        run_ids = list(run_ids)
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            chunk = run_ids[idx:idx + BATCH_SIZE]
+            # Foreign keys are not enforced on SQLite, so don't rely on cascading
+            for table in [LinkageResult.__table__, AutoResult.__table__, ManualResult.__table__,
+                          CaseHistory.__table__]:
+                db.session.execute(table.delete().where(table.c.run_id.in_(chunk)))
+
+    @classmethod
+    def delete_runs(cls, run_ids):
+        """
+        Delete test runs with all their results, properties, tags and
+        history with set based statements, in current transaction.
+        Blobs are left for Blob.delete_unreferenced, archive files are
+        left to the caller. Return number of runs deleted.
+        """
+        run_ids, count = list(run_ids), 0
+        cls.delete_results(run_ids)
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            chunk = run_ids[idx:idx + BATCH_SIZE]
+            for table in [Property.__table__, run_tags_table]:
+                db.session.execute(table.delete().where(table.c.run_id.in_(chunk)))
+            count += db.session.execute(
+                cls.__table__.delete().where(cls.__table__.c.id.in_(chunk))).rowcount
+        return count
+
     def blocking_errors(self, exclude=['Missing'], ignore_resulted=True):
         ret = []
         if len(self.linkage_results) == 0:
@@ -186,16 +382,19 @@ class Run(db.Model):
     def short_unique_name(self):
         return "%s %s" % (self.name, self.id)
 
-    def as_dict(self, statistics=False):
+    def as_dict(self, statistics=False, tags=None, properties=None):
         ret = {}
         for c in self.__table__.columns:
             if c.name != 'date':
                 ret[c.name] = getattr(self, c.name)
         ret['date'] = self.date.isoformat()
-        ret['tags'] = [tag.name for tag in self.tags.all()]
-        properties = {}
-        for prop in self.properties.all():
-            properties[prop.name] = prop.value
+        if tags is None:
+            tags = [tag.name for tag in self.tags.all()]
+        ret['tags'] = tags
+        if properties is None:
+            properties = {}
+            for prop in self.properties.all():
+                properties[prop.name] = prop.value
         ret['properties'] = properties
         if self.submit_date:
             ret['submit_date'] = self.submit_date.isoformat()
@@ -204,21 +403,223 @@ class Run(db.Model):
             ret.update(self.get_statistics())
         return ret
 
+    @classmethod
+    def batch_as_dict(cls, runs, statistics=False):
+        """
+        Same as as_dict for a list of runs, but load tags and properties
+        of all runs with one query each, instead of two queries per run.
+        """
+        runs = list(runs)
+        run_ids = [run.id for run in runs]
+        tags, properties = {}, {}
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            chunk = run_ids[idx:idx + BATCH_SIZE]
+            for run_id, tag_name in db.session.query(
+                    run_tags_table.c.run_id, run_tags_table.c.tag_name)\
+                    .filter(run_tags_table.c.run_id.in_(chunk)):
+                tags.setdefault(run_id, []).append(tag_name)
+            for run_id, name, value in db.session.query(
+                    Property.run_id, Property.name, Property.value)\
+                    .filter(Property.run_id.in_(chunk)):
+                properties.setdefault(run_id, {})[name] = value
+        return [run.as_dict(statistics=statistics,
+                            tags=tags.get(run.id, []),
+                            properties=properties.get(run.id, {}))
+                for run in runs]
+
+
+class Blob(db.Model):
+    """
+    Compressed text shared by auto results, keyed by digest of the text.
+    """
+    __tablename__ = 'blob'
+
+    digest = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.String(16), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary(), nullable=False)
+    # Unix time the blob was last saved, NULL for blobs saved before
+    touched = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return '<Blob %s>' % self.digest
+
+    @classmethod
+    def load(cls, digests):
+        """
+        Return a dict of digest to text.
+        """
+        ret = {}
+        digests = list(set(digests))
+        for idx in range(0, len(digests), BATCH_SIZE):
+            for digest, codec, data in db.session.query(cls.digest, cls.codec, cls.data)\
+                    .filter(cls.digest.in_(digests[idx:idx + BATCH_SIZE])):
+                ret[digest] = Blobs.decode(codec, data)
+        return ret
+
+    @classmethod
+    def save(cls, connection, blobs):
+        """
+        Save blobs not stored yet, blobs is a dict of digest to
+        (codec, size, payload).
+
+        Blobs already stored are touched (and locked) unless touched
+        recently, so delete_unreferenced won't delete them under a
+        result being saved.
+        """
+        table = cls.__table__
+        now = int(time.time())
+        digests = list(blobs.keys())
+        for idx in range(0, len(digests), BATCH_SIZE):
+            chunk = digests[idx:idx + BATCH_SIZE]
+            connection.execute(table.update().where(and_(
+                table.c.digest.in_(chunk),
+                or_(table.c.touched == None, table.c.touched < now - BLOB_TOUCH_INTERVAL)
+            )).values(touched=now))
+            existing = set(digest for digest, in connection.execute(
+                select([table.c.digest]).where(table.c.digest.in_(chunk))))
+            rows = [{'digest': digest, 'codec': blobs[digest][0],
+                     'size': blobs[digest][1], 'data': blobs[digest][2], 'touched': now}
+                    for digest in chunk if digest not in existing]
+            if rows:
+                connection.execute(insert_ignore(connection, table), rows)
+
+    @classmethod
+    def unreferenced(cls, grace):
+        """
+        Return digests of blobs no auto result refers to, and not touched
+        in last grace seconds.
+        """
+        table = cls.__table__
+        referenced = union(*[
+            select([column]).where(column != None) for column in
+            [AutoResult.__table__.c[field + '_digest'] for field in AutoResult.TEXT_FIELDS]])
+        return [digest for digest, in db.session.execute(
+            select([table.c.digest]).where(and_(
+                table.c.digest.notin_(referenced), cls._untouched(grace))))]
+
+    @classmethod
+    def delete_unreferenced(cls, digests, grace):
+        """
+        Delete blobs of digests from unreferenced which are still not
+        touched in last grace seconds, return number of blobs deleted.
+
+        Saving a result touches the blobs it refers to, so blobs referred
+        to since unreferenced was called are left.
+        """
+        table = cls.__table__
+        return db.session.execute(table.delete().where(and_(
+            table.c.digest.in_(digests), cls._untouched(grace)))).rowcount
+
+    @classmethod
+    def _untouched(cls, grace):
+        touched = cls.__table__.c.touched
+        return or_(touched == None, touched <= int(time.time()) - grace)
+
+
+def _text_property(name):
+    """
+    Text stored in blob table, referred by column <name>_digest.
+    """
+    digest = name + '_digest'
+
+    def fget(self):
+        return self._get_text(digest)
+
+    def fset(self, value):
+        self._set_text(digest, value)
+
+    def expr(cls):
+        return getattr(cls, digest)
+
+    return hybrid_property(fget, fset, expr=expr)
+
+
+class _CaseComparator(Comparator):
+    """
+    Compare names of cases referred by id, filters on names look up
+    the ids first, so indexes on the id column are used.
+    """
+    def __init__(self, column):
+        self.column = column
+        names = CaseName.__table__
+        super(_CaseComparator, self).__init__(
+            select([names.c.name]).where(names.c.id == column).as_scalar())
+
+    @staticmethod
+    def _ids(clause):
+        return select([CaseName.__table__.c.id]).where(clause)
+
+    def operate(self, op, *other, **kwargs):
+        return op(self.__clause_element__(), *other, **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        return op(other, self.__clause_element__(), **kwargs)
+
+    def __eq__(self, other):
+        return self.column == self._ids(CaseName.__table__.c.name == other).as_scalar()
+
+    def in_(self, other):
+        return self.column.in_(self._ids(CaseName.__table__.c.name.in_(other)))
+
+
+def _case_property(case_id, entry):
+    """
+    Name of an auto case, stored as id of the case in case_name table,
+    referred by column <case_id> and loaded with relationship <entry>.
+    Ids of new names are looked up before flush, see _resolve_case_ids.
+    """
+    def fget(self):
+        names = self.__dict__.get(CASE_NAMES, {})
+        if case_id not in names:
+            value = getattr(self, entry)
+            names = self.__dict__.setdefault(CASE_NAMES, {})
+            names[case_id] = value.name if value is not None else None
+        return names[case_id]
+
+    def fset(self, value):
+        self.__dict__.setdefault(CASE_NAMES, {})[case_id] = value
+        setattr(self, case_id, None)
+
+    def comparator(cls):
+        return _CaseComparator(getattr(cls, case_id))
+
+    return hybrid_property(fget, fset, custom_comparator=comparator)
+
 
 class AutoResult(db.Model):
     __tablename__ = 'auto_result'
+    __table_args__ = (
+        # Runs having a case, and statistics of runs, without reading rows
+        db.Index('ix_auto_result_case_id_run_id', 'case_id', 'run_id'),
+        db.Index('ix_auto_result_run_id_result', 'run_id', 'result'),
+    )
 
-    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True, index=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
     run = db.relationship('Run', back_populates='auto_results', single_parent=True)
 
-    case = db.Column(db.String(65535), nullable=False, primary_key=True, index=True)
+    # Case names are stored once in case_name table
+    case_id = db.Column(db.Integer, db.ForeignKey('case_name.id'), nullable=False, primary_key=True)
+    case_entry = db.relationship('CaseName', lazy='joined', innerjoin=True, viewonly=True)
+    case = _case_property('case_id', 'case_entry')
     time = db.Column(db.Float(), default=0.0, nullable=False)
-    skip = deferred(db.Column(db.Text(), nullable=True))
-    failure = deferred(db.Column(db.Text(), nullable=True))
-    output = deferred(db.Column(db.Text(), nullable=True))
-    source = deferred(db.Column(db.Text(), nullable=True))
+    # Texts are stored in blob table, and only loaded when accessed
+    # or with AutoResult.load_texts
+    TEXT_FIELDS = ['skip', 'failure', 'output', 'source']
+
+    skip_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=True)
+    failure_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=True)
+    output_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=True)
+    source_digest = db.Column(db.String(64), db.ForeignKey('blob.digest'), nullable=True)
+
+    skip = _text_property('skip')
+    failure = _text_property('failure')
+    output = _text_property('output')
+    source = _text_property('source')
     comment = db.Column(db.Text(), nullable=True)
-    result = db.Column(db.String(255), nullable=True, index=True)
+    # Load old value on change, needed for keeping statistics of the run
+    result = column_property(db.Column(db.String(255), nullable=True),
+                             active_history=True)
 
     linkage_results = db.relationship("LinkageResult", back_populates="auto_result", viewonly=True, cascade="all, delete")
 
@@ -237,11 +638,61 @@ class AutoResult(db.Model):
         assert result in ['passed', 'failed', 'skipped', 'missing', 'ignored', None]
         return result
 
+    @staticmethod
+    def statistics_col(result):
+        """
+        Statistics column of Run counting auto results of this result.
+        """
+        if result in ['passed', 'failed', 'skipped']:
+            return 'auto_' + result
+        return None
+
+    def _get_text(self, digest_attr):
+        digest = getattr(self, digest_attr)
+        if digest is None:
+            return None
+        texts = self.__dict__.setdefault('_texts', {})
+        if digest not in texts:
+            texts.update(Blob.load([digest]))
+        return texts[digest]
+
+    def _set_text(self, digest_attr, text):
+        if text is None:
+            setattr(self, digest_attr, None)
+            return
+        digest, codec, size, payload = Blobs.encode(text)
+        self.__dict__.setdefault('_texts', {})[digest] = text
+        self.__dict__.setdefault('_pending_blobs', {})[digest] = (codec, size, payload)
+        setattr(self, digest_attr, digest)
+
+    @classmethod
+    def load_texts(cls, results, fields=None):
+        """
+        Load texts of a batch of results with one query per BATCH_SIZE
+        texts, instead of one query per text accessed.
+        """
+        results = list(results)
+        fields = cls.TEXT_FIELDS if fields is None else fields
+        digests = set()
+        for result in results:
+            texts = result.__dict__.get('_texts', {})
+            for field in fields:
+                digest = getattr(result, field + '_digest')
+                if digest is not None and digest not in texts:
+                    digests.add(digest)
+        loaded = Blob.load(digests)
+        for result in results:
+            result.__dict__.setdefault('_texts', {}).update(loaded)
+
     def as_dict(self, detailed=False):
         ret = {}
         for c in self.__table__.columns:
-            if c.name not in ['output']:
+            if c.name == 'case_id':
+                ret['case'] = self.case
+            elif not c.name.endswith('_digest'):
                 ret[c.name] = getattr(self, c.name)
+        for field in ['skip', 'failure', 'source']:
+            ret[field] = getattr(self, field)
         ret['result'] = self.result
         if not detailed:
             ret['output'] = 'Not showing'
@@ -254,13 +705,13 @@ class AutoResult(db.Model):
         Check if any failure pattern matches
         """
         failures = []
-        for failure in autocase_failures:
-            if re.match(failure.failure_regex, self.failure) is not None:
-                for bl in failure.blacklist_entries:
-                    if bl.json['workitems'] and bl.json['bugs']:
-                        failures.append((bl.json['workitems'], 'failed', bl.json['bugs'], bl.status, bl.description))
-                    else:
-                        failures.append((bl.json['workitems'], 'ignored', bl.json['bugs'], bl.status, bl.description))
+        matcher = get_matcher([failure['regex'] for failure in autocase_failures])
+        for idx in matcher.match(self.failure):
+            for bl in autocase_failures[idx]['blacklist']:
+                if bl['workitems'] and bl['bugs']:
+                    failures.append((bl['workitems'], 'failed', bl['bugs'], bl['status'], bl['description']))
+                else:
+                    failures.append((bl['workitems'], 'ignored', bl['bugs'], bl['status'], bl['description']))
         return failures
 
     def refresh_comment(self):
@@ -268,21 +719,7 @@ class AutoResult(db.Model):
         Generate a human readable text decscripting which manual
         result is beging failed/block by this auto result.
         """
-        comments = []
-        for result in self.linkage_results:
-            _result = result.result
-            _error = result.error
-            if result.result:
-                if result.detail:
-                    comments.append("%s: \"%s\" with detail: %s" %
-                                    (_result.title(), result.manual_result_id, result.detail))
-                else:
-                    comments.append("%s: \"%s\"" %
-                                    (_result.title(), result.manual_result_id))
-            else:
-                comments.append("Blocking with %s: %s" % (_error, result.manual_result_id))
-        comments.sort()
-        self.comment = "\n".join(comments)
+        self.comment = auto_comment_of(self.linkage_results)
 
     def refresh_result(self):
         if self.skip is not None:
@@ -299,44 +736,18 @@ class AutoResult(db.Model):
         else:
             raise RuntimeError('Unexpected auto result status %s' % self.as_dict(detailed=True))
 
-    def gen_linkage_result(self, session=None, gen_manual=True):
+    def linkage_plan(self, autocase):
         """
-        Take a AutoResult instance, rewrite it's error and linkage_result
-        with data in caselink.
+        Take the caselink mapping of this auto case, return a list of
+        (workitems, result, error, detail) to be applied in order,
+        last step is for all workitems linked in caselink.
         """
-        session = session or object_session(self)
-        if not session:
-            raise RuntimeError("Can't gen linkage result on a detached reuslt")
-
-        try:
-            this_autocase = CaseLink.AutoCase(self.case).refresh()
-        except (HTTPError, ConnectionError):
-            self.result = None
-            return
-
-        def _gen_linkage_result(workitems, result, error, detail):
-            for workitem_id in workitems:
-                workitem, _ = get_or_create(session, ManualResult,
-                                            run_id=self.run_id, case=workitem_id)
-                if _:
-                    workitem.gen_linkage_result(session)
-                linkage_result, _ = get_or_create(session, LinkageResult,
-                                                  run_id=self.run_id,
-                                                  manual_result_id=workitem.case,
-                                                  auto_result_id=self.case)
-                linkage_result.result = result
-                linkage_result.error = error
-                linkage_result.detail = detail
-
-                workitem.refresh_result()
-                workitem.refresh_comment()
-                workitem.refresh_duration()
-
+        plan = []
         _linkage_result = self.result
         _linkage_error, _linkage_detail = None, None
 
         if _linkage_result == "failed":
-            known_failures = self._check_failure(this_autocase.autocase_failures)
+            known_failures = self._check_failure(autocase['failures'])
             if not known_failures:
                 _linkage_result, _linkage_error = None, "UnknownIssue"
             else:
@@ -344,7 +755,7 @@ class AutoResult(db.Model):
                     _linkage_result, _linkage_error = result, None
                     _linkage_detail = ("%s: Workitems '%s' %s for bugs %s: %s" %
                                        (status, wis, result, bugs, desc))
-                    _gen_linkage_result(wis, _linkage_result, _linkage_error, _linkage_detail)
+                    plan.append((wis, _linkage_result, _linkage_error, _linkage_detail))
 
         elif _linkage_result == "black-listed":
             _linkage_result, _linkage_error = "ignored", "black-listed"
@@ -355,12 +766,25 @@ class AutoResult(db.Model):
         elif _linkage_result == "ignored":
             _linkage_result, _linkage_error = None, None
 
-        if gen_manual:
-            workitems = [case.id for case in this_autocase.workitems]
-        else:
-            workitems = [r.manual_result_id for r in self.linkage_results]
+        plan.append((autocase['workitems'], _linkage_result, _linkage_error, _linkage_detail))
+        return plan
+
+    def gen_linkage_result(self, session=None, gen_manual=True):
+        """
+        Take a AutoResult instance, rewrite it's comment and linkage_result
+        with data in caselink.
+
+        Use app.model.linkage.LinkageEngine directly for more than one result.
+        """
+        from .linkage import LinkageEngine
+
+        session = session or object_session(self)
+        if not session:
+            raise RuntimeError("Can't gen linkage result on a detached reuslt")
 
-        _gen_linkage_result(workitems, _linkage_result, _linkage_error, _linkage_detail)
+        engine = LinkageEngine(session, self.run_id)
+        engine.resolve([self], gen_manual=gen_manual)
+        engine.flush()
 
 
 class ManualResult(db.Model):
@@ -368,15 +792,20 @@ class ManualResult(db.Model):
     Presents a workitem result on polarion.
     """
     __tablename__ = 'manual_result'
+    __table_args__ = (
+        db.Index('ix_manual_result_case_run_id', 'case', 'run_id'),
+        db.Index('ix_manual_result_run_id_result', 'run_id', 'result'),
+    )
 
-    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True, index=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
     run = db.relationship('Run', back_populates='manual_results', single_parent=True)
 
     case = db.Column(db.String(255), nullable=False, primary_key=True)
     time = db.Column(db.Float(), default=0.0, nullable=False)
     comment = db.Column(db.Text(), nullable=True)
 
-    result = db.Column(db.String(255), nullable=True)
+    result = column_property(db.Column(db.String(255), nullable=True),
+                             active_history=True)
     linkage_results = db.relationship("LinkageResult", back_populates="manual_result", viewonly=True, cascade="all, delete")
 
     @validates('result')
@@ -384,6 +813,15 @@ class ManualResult(db.Model):
         assert result in ['passed', 'failed', 'skipped', 'incomplete', None]
         return result
 
+    @staticmethod
+    def statistics_col(result):
+        """
+        Statistics column of Run counting manual results of this result.
+        """
+        if result in ['passed', 'failed']:
+            return 'manual_' + result
+        return 'manual_error'
+
     def __repr__(self):
         return '<ManualCaseResult %s-%s: %s>' % (self.run_id, self.case, self.result)
 
@@ -397,60 +835,11 @@ class ManualResult(db.Model):
             ret[c.name] = getattr(self, c.name)
         return ret
 
-    def gen_linkage_result(self, session=None):
-        session = session or object_session(self)
-        if not session:
-            raise RuntimeError("Can't gen linkage result on a detached reuslt")
-
-        this_workitem = CaseLink.WorkItem(self.case)
-        for autocase in this_workitem.autocases:
-            auto_result, _ = get_or_create(session, AutoResult,
-                                           run_id=self.run_id,
-                                           case=autocase.id)
-            if _:
-                auto_result.refresh_result()
-                linkage_result, _ = get_or_create(session, LinkageResult,
-                                                  run_id=self.run_id,
-                                                  manual_result_id=self.case,
-                                                  auto_result_id=autocase.id)
-                linkage_result.result = None
-                linkage_result.error = "Missing"
-                auto_result.refresh_comment()
-
     def refresh_result(self, linkage_results=None):
-        linkage_results = self.linkage_results
-
-        if any(r.result == "failed" for r in linkage_results):
-            self.result = "failed"
-
-        elif any(r.result is None for r in linkage_results):
-            self.result = "incomplete"
-
-        elif all(r.result in ["ignored", "skipped", "passed"] for r in linkage_results):
-            if any(r.result == "passed" for r in linkage_results):
-                self.result = "passed"
-            else:
-                self.result = "skipped"
-
-        else:
-            self.result = "incomplete"
+        self.result = manual_result_of(self.linkage_results)
 
     def refresh_comment(self, linkage_results=None):
-        comments = []
-        for result in self.linkage_results:
-            _result = result.result
-            _error = result.error
-            if result.result:
-                if result.detail:
-                    comments.append("%s: \"%s\" with detail: %s" %
-                                    (_result.title(), result.auto_result_id, result.detail))
-                else:
-                    comments.append("%s: \"%s\"" %
-                                    (_result.title(), result.auto_result_id))
-            else:
-                comments.append("Blocking with %s : %s" % (_error, result.auto_result_id))
-        comments.sort()
-        self.comment = "\n".join(comments)
+        self.comment = manual_comment_of(self.linkage_results)
 
     def refresh_duration(self, linkage_results=None):
         self.time = 0
@@ -468,14 +857,16 @@ class LinkageResult(db.Model):
         ForeignKeyConstraint(["run_id", "manual_result_id"],
                              [ManualResult.run_id, ManualResult.case],
                              ondelete="CASCADE"),
-        ForeignKeyConstraint(["run_id", "auto_result_id"],
-                             [AutoResult.run_id, AutoResult.case],
+        ForeignKeyConstraint(["run_id", "auto_case_id"],
+                             [AutoResult.run_id, AutoResult.case_id],
                              ondelete="CASCADE"),
         {})
 
     run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
     manual_result_id = db.Column(db.String(255), primary_key=True, nullable=False)
-    auto_result_id = db.Column(db.String(65535), primary_key=True, nullable=False)
+    auto_case_id = db.Column(db.Integer, db.ForeignKey('case_name.id'), primary_key=True, nullable=False)
+    auto_case = db.relationship('CaseName', lazy='joined', innerjoin=True, viewonly=True)
+    auto_result_id = _case_property('auto_case_id', 'auto_case')
 
     run = db.relationship('Run', back_populates='linkage_results', single_parent=True, viewonly=True)
     manual_result = db.relationship('ManualResult', back_populates='linkage_results',
@@ -523,3 +914,507 @@ class LinkageResult(db.Model):
             "error": self.error,
             "result": self.result,
         }
+
+
+class AutoResultDaily(db.Model):
+    """
+    Daily rollup of auto results, number of results of each case by result,
+    for test runs of the same name in one day.
+    """
+    __tablename__ = 'auto_result_daily'
+
+    day = db.Column(db.Date(), primary_key=True)
+    run_name = db.Column(db.String(255), primary_key=True)
+    case = db.Column(db.String(65535), primary_key=True)
+    result = db.Column(db.String(255), primary_key=True)  # 'invalid' for no result
+    count = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def last_day(cls):
+        """
+        Last day rolled up, None if none is.
+        """
+        return db.session.query(func.max(cls.day)).scalar()
+
+    @classmethod
+    def rollup(cls, start=None, end=None):
+        """
+        Regenerate the rollup of days in [start, end) from auto results,
+        start and end are dates, None for no bound. Return number of rows
+        generated. Counts of purged or archived test runs in these days
+        are dropped.
+        """
+        table = cls.__table__
+        day = func.date(Run.date, type_=db.Date)
+        query = db.session.query(
+            day, Run.name, CaseName.name,
+            func.coalesce(AutoResult.result, 'invalid'), func.count())\
+            .select_from(AutoResult).join(Run, Run.id == AutoResult.run_id)\
+            .join(CaseName, CaseName.id == AutoResult.case_id)
+        delete = table.delete()
+        if start:
+            query = query.filter(Run.date >= datetime.datetime.combine(start, datetime.time()))
+            delete = delete.where(table.c.day >= start)
+        if end:
+            query = query.filter(Run.date < datetime.datetime.combine(end, datetime.time()))
+            delete = delete.where(table.c.day < end)
+        query = query.group_by(day, Run.name, CaseName.name,
+                               func.coalesce(AutoResult.result, 'invalid'))
+
+        db.session.execute(delete)
+        return db.session.execute(table.insert().from_select(
+            ['day', 'run_name', 'case', 'result', 'count'], query.statement)).rowcount
+
+    @staticmethod
+    def _counts(connection, run_ids):
+        """
+        Yield (run_id, case_id, result, count) of auto results of test runs.
+        """
+        auto = AutoResult.__table__
+        run_ids = list(run_ids)
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            for row in connection.execute(
+                    select([auto.c.run_id, auto.c.case_id, auto.c.result, func.count()])
+                    .where(auto.c.run_id.in_(run_ids[idx:idx + BATCH_SIZE]))
+                    .group_by(auto.c.run_id, auto.c.case_id, auto.c.result)):
+                yield tuple(row)
+
+    @classmethod
+    def adjust(cls, connection, changes, moved=None):
+        """
+        Apply changes of auto results to days already rolled up, changes
+        is a list of (run_id, case_id, result, delta). moved is a dict of
+        test run id to (date, name) before the run was moved, its results
+        are moved along, changes of the run are relative to the former.
+        """
+        table, run = cls.__table__, Run.__table__
+        last_day = connection.execute(select([func.max(table.c.day)])).scalar()
+        if last_day is None:
+            return
+        moved = moved or {}
+        changes = list(changes)
+        run_ids = list(set(change[0] for change in changes) | set(moved))
+        runs = {}
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            for run_id, date, name in connection.execute(
+                    select([run.c.id, run.c.date, run.c.name])
+                    .where(run.c.id.in_(run_ids[idx:idx + BATCH_SIZE]))):
+                runs[run_id] = (date, name)
+
+        deltas = {}
+
+        def add(date, name, case_id, result, delta):
+            if date.date() <= last_day:
+                key = (date.date(), name, case_id, result or 'invalid')
+                deltas[key] = deltas.get(key, 0) + delta
+
+        for run_id, case_id, result, count in cls._counts(connection, moved.keys()):
+            add(moved[run_id][0], moved[run_id][1], case_id, result, -count)
+            add(runs[run_id][0], runs[run_id][1], case_id, result, count)
+        for run_id, case_id, result, delta in changes:
+            if run_id in moved:
+                add(moved[run_id][0], moved[run_id][1], case_id, result, delta)
+            elif run_id in runs:
+                add(runs[run_id][0], runs[run_id][1], case_id, result, delta)
+        deltas = dict((key, delta) for key, delta in deltas.items() if delta)
+        if not deltas:
+            return
+
+        case_ids = list(set(key[2] for key in deltas))
+        names = {}
+        for idx in range(0, len(case_ids), BATCH_SIZE):
+            names.update(connection.execute(
+                select([CaseName.__table__.c.id, CaseName.__table__.c.name])
+                .where(CaseName.__table__.c.id.in_(case_ids[idx:idx + BATCH_SIZE]))).fetchall())
+        params = [{'_day': key[0], '_run_name': key[1], '_case': names[key[2]],
+                   '_result': key[3], '_delta': value} for key, value in deltas.items()]
+
+        key = and_(table.c.day == bindparam('_day'), table.c.run_name == bindparam('_run_name'),
+                   table.c.case == bindparam('_case'), table.c.result == bindparam('_result'))
+        added = [param for param in params if param['_delta'] > 0]
+        if added:
+            connection.execute(insert_ignore(connection, table), [
+                {'day': param['_day'], 'run_name': param['_run_name'], 'case': param['_case'],
+                 'result': param['_result'], 'count': 0} for param in added])
+        connection.execute(table.update().where(key).values(count=table.c.count + bindparam('_delta')),
+                           params)
+        removed = [param for param in params if param['_delta'] < 0]
+        if removed:
+            connection.execute(table.delete().where(key).where(table.c.count <= 0), removed)
+
+    @classmethod
+    def forget_runs(cls, connection, run_ids):
+        """
+        Remove auto results of test runs deleted on purpose from days
+        already rolled up. Purged and archived runs stay in the rollup.
+        """
+        cls.adjust(connection, [(run_id, case_id, result, -count) for run_id, case_id, result, count
+                                in cls._counts(connection, run_ids)])
+
+
+class CacheGeneration(db.Model):
+    """
+    Generation of a scope of the API response cache, replaced on
+    invalidation, see utils.response_cache.
+    """
+    __tablename__ = 'cache_generation'
+
+    scope = db.Column(db.String(255), primary_key=True)
+    generation = db.Column(db.String(32), nullable=False)
+
+
+class CaseHistory(db.Model):
+    """
+    History of auto cases, one row for each test run a case ran in,
+    maintained along with auto results.
+    """
+    __tablename__ = 'case_history'
+    __table_args__ = (
+        db.Index('ix_case_history_case_id_date', 'case_id', 'date'),
+    )
+
+    case_id = db.Column(db.Integer, db.ForeignKey('case_name.id'), primary_key=True)
+    case_entry = db.relationship('CaseName', lazy='joined', innerjoin=True, viewonly=True)
+    case = _case_property('case_id', 'case_entry')
+    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
+    date = db.Column(db.DateTime(), nullable=False)
+    result = db.Column(db.String(255), nullable=True)
+    time = db.Column(db.Float(), default=0.0, nullable=False)
+
+    def as_dict(self):
+        return {
+            'run_id': self.run_id,
+            'date': self.date.isoformat(),
+            'result': self.result,
+            'time': self.time,
+        }
+
+    @classmethod
+    def record(cls, connection, results):
+        """
+        Add history of new auto results, results is a list of
+        dicts with run_id, case_id, result and time.
+        """
+        if not results:
+            return
+        table, run = cls.__table__, Run.__table__
+        stmt = table.insert().from_select(
+            ['case_id', 'run_id', 'date', 'result', 'time'],
+            select([bindparam('_case_id', type_=table.c.case_id.type), run.c.id, run.c.date,
+                    bindparam('_result', type_=table.c.result.type),
+                    bindparam('_time', type_=table.c.time.type)])
+            .where(run.c.id == bindparam('_run_id')))
+        connection.execute(stmt, [cls._params(result) for result in results])
+
+    @classmethod
+    def update(cls, connection, results):
+        """
+        Update history of changed auto results, same format as record.
+        """
+        if not results:
+            return
+        table = cls.__table__
+        stmt = table.update()\
+            .where(table.c.case_id == bindparam('_case_id'))\
+            .where(table.c.run_id == bindparam('_run_id'))\
+            .values(result=bindparam('_result'), time=bindparam('_time'))
+        connection.execute(stmt, [cls._params(result) for result in results])
+
+    @classmethod
+    def redate(cls, connection, runs):
+        """
+        Follow test runs moved to another date, runs is a dict of run id
+        to new date.
+        """
+        if not runs:
+            return
+        table = cls.__table__
+        stmt = table.update()\
+            .where(table.c.run_id == bindparam('_run_id'))\
+            .values(date=bindparam('_date'))
+        connection.execute(stmt, [{'_run_id': run_id, '_date': date} for run_id, date in runs.items()])
+
+    @classmethod
+    def forget(cls, connection, results):
+        """
+        Drop history of deleted auto results, results is a list of
+        dicts with run_id and case_id.
+        """
+        if not results:
+            return
+        table = cls.__table__
+        stmt = table.delete()\
+            .where(table.c.case_id == bindparam('_case_id'))\
+            .where(table.c.run_id == bindparam('_run_id'))
+        connection.execute(stmt, [{'_case_id': result['case_id'], '_run_id': result['run_id']}
+                                  for result in results])
+
+    @staticmethod
+    def _params(result):
+        return {
+            '_case_id': result['case_id'],
+            '_run_id': result['run_id'],
+            '_result': result['result'],
+            '_time': result['time'] or 0.0,
+        }
+
+    @classmethod
+    def rebuild(cls, run_ids=None):
+        """
+        Regenerate history of given test runs, or all test runs,
+        from auto results.
+        """
+        table, auto = cls.__table__, AutoResult.__table__
+        query = select([auto.c.case_id, auto.c.run_id, Run.__table__.c.date,
+                        auto.c.result, auto.c.time])\
+            .where(Run.__table__.c.id == auto.c.run_id)
+        if run_ids is None:
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                ['case_id', 'run_id', 'date', 'result', 'time'], query))
+            return
+        run_ids = list(run_ids)
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            chunk = run_ids[idx:idx + BATCH_SIZE]
+            db.session.execute(table.delete().where(table.c.run_id.in_(chunk)))
+            db.session.execute(table.insert().from_select(
+                ['case_id', 'run_id', 'date', 'result', 'time'],
+                query.where(auto.c.run_id.in_(chunk))))
+
+
+class CaseName(db.Model):
+    """
+    Dictionary of distinct auto and manual case names, searched for
+    cases instead of scanning results, see model/search.py. Auto
+    results, their linkage and history refer to cases by id.
+    """
+    __tablename__ = 'case_name'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(65535), nullable=False, unique=True)
+
+    @classmethod
+    def record(cls, connection, names):
+        """
+        Add names not in the dictionary yet.
+        """
+        names = list(set(names))
+        for idx in range(0, len(names), BATCH_SIZE):
+            connection.execute(insert_ignore(connection, cls.__table__),
+                               [{'name': name} for name in names[idx:idx + BATCH_SIZE]])
+
+    @classmethod
+    def ids(cls, connection, names):
+        """
+        Map case names to their ids, adding names not in the dictionary yet.
+        """
+        names, table, ret = list(set(names)), cls.__table__, {}
+        cls.record(connection, names)
+        for idx in range(0, len(names), BATCH_SIZE):
+            ret.update(connection.execute(select([table.c.name, table.c.id]).where(
+                table.c.name.in_(names[idx:idx + BATCH_SIZE]))).fetchall())
+        return ret
+
+
+def _sqlite_fts5(ddl, target, bind, **kw):
+    """
+    If FTS5 with the trigram tokenizer is available on SQLite.
+    """
+    if bind.dialect.name != 'sqlite' or bind.dialect.dbapi.sqlite_version_info < (3, 34, 0):
+        return False
+    return 'ENABLE_FTS5' in [row[0] for row in bind.execute("PRAGMA compile_options")]
+
+
+def _search_index(table, column, fts):
+    """
+    Index for substring search on a column, a trigram GIN index on
+    PostgreSQL, a FTS5 trigram table kept in sync by triggers on SQLite.
+    """
+    names = {'table': table.name, 'column': column, 'fts': fts,
+             'key': table.primary_key.columns.keys()[0]}
+    for statement in [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX ix_%(table)s_%(column)s_trgm ON %(table)s USING gin (%(column)s gin_trgm_ops)"]:
+        event.listen(table, 'after_create',
+                     DDL(statement % names).execute_if(dialect='postgresql'))
+    for statement in [
+            "CREATE VIRTUAL TABLE %(fts)s USING fts5(%(column)s, content='%(table)s', "
+            "content_rowid='%(key)s', tokenize='trigram')",
+            "CREATE TRIGGER %(fts)s_ai AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(rowid, %(column)s) VALUES (new.%(key)s, new.%(column)s); END",
+            "CREATE TRIGGER %(fts)s_ad AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) VALUES ('delete', old.%(key)s, old.%(column)s); END",
+            "CREATE TRIGGER %(fts)s_au AFTER UPDATE OF %(column)s ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s(%(fts)s, rowid, %(column)s) VALUES ('delete', old.%(key)s, old.%(column)s); "
+            "INSERT INTO %(fts)s(rowid, %(column)s) VALUES (new.%(key)s, new.%(column)s); END"]:
+        event.listen(table, 'after_create',
+                     DDL(statement % names).execute_if(callable_=_sqlite_fts5))
+    event.listen(table, 'before_drop',
+                 DDL("DROP TABLE IF EXISTS %(fts)s" % names).execute_if(dialect='sqlite'))
+
+
+_search_index(Run.__table__, 'name', 'run_name_fts')
+_search_index(CaseName.__table__, 'name', 'case_name_fts')
+
+
+def _expire_statistics(session, run_ids):
+    run_ids = set(run_ids)
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, Run) and instance.id in run_ids:
+            session.expire(instance, Run._Run__statistics_cols)
+
+
+def _result_changes(session):
+    """
+    Yield (model, run_id, removed results, added results) of
+    results changed in a flush.
+    """
+    for instance in session.new:
+        if isinstance(instance, (AutoResult, ManualResult)):
+            yield type(instance), instance.run_id, [], [instance.result]
+    for instance in session.dirty:
+        if isinstance(instance, (AutoResult, ManualResult)):
+            history = attributes.get_history(instance, 'result')
+            if history.has_changes():
+                yield type(instance), instance.run_id, list(history.deleted), [instance.result]
+    for instance in session.deleted:
+        if isinstance(instance, (AutoResult, ManualResult)):
+            history = attributes.get_history(instance, 'result')
+            yield type(instance), instance.run_id, [(history.deleted or history.unchanged)[0]], []
+
+
+@event.listens_for(Session, 'before_flush')
+def _save_blobs(session, flush_context, instances):
+    """
+    Save texts of new or changed auto results before the results
+    referring to them are written.
+    """
+    blobs = {}
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, AutoResult):
+            blobs.update(instance.__dict__.pop('_pending_blobs', {}))
+    if blobs:
+        Blob.save(session.connection(), blobs)
+
+
+@event.listens_for(Session, 'before_flush')
+def _resolve_case_ids(session, flush_context, instances):
+    """
+    Set ids of case names assigned to new or changed instances, adding
+    names not in the dictionary yet.
+    """
+    pending = []
+    for instance in list(session.new) + list(session.dirty):
+        for case_id, name in instance.__dict__.get(CASE_NAMES, {}).items():
+            if getattr(instance, case_id) is None and name is not None:
+                pending.append((instance, case_id, name))
+    if pending:
+        ids = CaseName.ids(session.connection(), [name for _, _, name in pending])
+        for instance, case_id, name in pending:
+            setattr(instance, case_id, ids[name])
+
+
+@event.listens_for(Session, 'before_flush')
+def _load_deleted_results(session, flush_context, instances):
+    # Result of a deleted row can't be loaded after the flush
+    for instance in session.deleted:
+        if isinstance(instance, (AutoResult, ManualResult)):
+            instance.result
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_statistics(session, flush_context):
+    """
+    Apply result changes of a flush to statistics of test runs,
+    in the same transaction.
+    """
+    deltas = {}
+    for model, run_id, removed, added in _result_changes(session):
+        delta = deltas.setdefault(run_id, {})
+        for results, value in [(removed, -1), (added, 1)]:
+            for result in results:
+                col = model.statistics_col(result)
+                if col:
+                    delta[col] = delta.get(col, 0) + value
+    if deltas:
+        Run.adjust_statistics(session.connection(), deltas)
+        session.info.setdefault(STATISTICS_CHANGED, set()).update(deltas.keys())
+
+
+def _history_of(instance):
+    return {'run_id': instance.run_id, 'case_id': instance.case_id,
+            'result': instance.result, 'time': instance.time}
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_case_history(session, flush_context):
+    """
+    Apply auto result changes, and date changes of test runs, of a flush
+    to case history.
+    """
+    new, changed, deleted, redated = [], [], [], {}
+    for instance in session.new:
+        if isinstance(instance, AutoResult):
+            new.append(_history_of(instance))
+    for instance in session.dirty:
+        if isinstance(instance, AutoResult) and any(
+                attributes.get_history(instance, key).has_changes()
+                for key in ['result', 'time']):
+            changed.append(_history_of(instance))
+        elif isinstance(instance, Run) and attributes.get_history(instance, 'date').has_changes():
+            redated[instance.id] = instance.date
+    for instance in session.deleted:
+        if isinstance(instance, AutoResult):
+            deleted.append({'run_id': instance.run_id, 'case_id': instance.case_id})
+    if new or changed or deleted or redated:
+        connection = session.connection()
+        CaseHistory.record(connection, new)
+        CaseHistory.update(connection, changed)
+        CaseHistory.forget(connection, deleted)
+        CaseHistory.redate(connection, redated)
+
+
+def _previous(instance, key):
+    history = attributes.get_history(instance, key)
+    return (list(history.deleted) + list(history.unchanged) + [getattr(instance, key)])[0]
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_daily_rollup(session, flush_context):
+    """
+    Apply auto result changes of a flush, and test runs moved to another
+    day or name, to the daily rollup.
+    """
+    changes, moved = [], {}
+    for instance in session.new:
+        if isinstance(instance, AutoResult):
+            changes.append((instance.run_id, instance.case_id, instance.result, 1))
+    for instance in session.dirty:
+        if isinstance(instance, AutoResult) and any(
+                attributes.get_history(instance, key).has_changes() for key in ['case_id', 'result']):
+            changes.append((instance.run_id, _previous(instance, 'case_id'),
+                            _previous(instance, 'result'), -1))
+            changes.append((instance.run_id, instance.case_id, instance.result, 1))
+        elif isinstance(instance, Run) and any(
+                attributes.get_history(instance, key).has_changes() for key in ['date', 'name']):
+            moved[instance.id] = (_previous(instance, 'date'), _previous(instance, 'name'))
+    for instance in session.deleted:
+        if isinstance(instance, AutoResult):
+            changes.append((instance.run_id, instance.case_id, instance.result, -1))
+    if changes or moved:
+        AutoResultDaily.adjust(session.connection(), changes, moved)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_case_names(session, flush_context):
+    # Names of auto cases are recorded by _resolve_case_ids
+    names = [instance.case for instance in session.new if isinstance(instance, ManualResult)]
+    if names:
+        CaseName.record(session.connection(), names)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _expire_changed_statistics(session, flush_context):
+    run_ids = session.info.pop(STATISTICS_CHANGED, None)
+    if run_ids:
+        _expire_statistics(session, run_ids)
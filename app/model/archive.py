@@ -0,0 +1,214 @@
+"""
+Cold storage of test runs
+
+Results of an archived test run, auto results with their blobs, manual
+and linkage results, are moved to a gzipped JSON lines file under
+ARCHIVE_DIR. The file starts with a copy of the run with its tags and
+properties. The run row stays in the database as a stub with its
+statistics, tags and properties, and results are restored into the
+database when the run is opened again. Auto cases are written by name,
+and mapped to ids of the case name dictionary when restored.
+"""
+import os
+import gzip
+import json
+import base64
+import logging
+
+from sqlalchemy import select
+
+from config import ActiveConfig
+from . import db, Run, Blob, AutoResult, ManualResult, LinkageResult, CaseHistory, CaseName, BATCH_SIZE
+
+ARCHIVE_DIR = ActiveConfig.ARCHIVE_DIR
+
+# Bump on incompatible changes of the file format
+ARCHIVE_VERSION = 1
+
+# In the order they are written and restored, rows referred to come first
+RESULT_TABLES = [Blob.__table__, AutoResult.__table__, ManualResult.__table__,
+                 LinkageResult.__table__]
+
+# Columns referring to auto cases by id, and keys of case names in files
+CASE_COLUMNS = {AutoResult.__table__.name: ('case_id', 'case'),
+                LinkageResult.__table__.name: ('auto_case_id', 'auto_result_id')}
+
+LOGGER = logging.getLogger('lib-dash.archive')
+
+
+def archive_file(run_id):
+    """
+    Path of archive file of a test run, relative to ARCHIVE_DIR.
+    """
+    return os.path.join(str(run_id // 1000), '%s.jsonl.gz' % run_id)
+
+
+def _dump(table, row):
+    ret = {}
+    for column in table.columns:
+        value = row[column.name]
+        if value is not None and isinstance(column.type, db.LargeBinary):
+            value = base64.b64encode(bytes(value)).decode('ascii')
+        ret[column.name] = value
+    return ret
+
+
+def _load(table, data):
+    ret = {}
+    for column in table.columns:
+        value = data.get(column.name)
+        if value is not None and isinstance(column.type, db.LargeBinary):
+            value = base64.b64decode(value)
+        ret[column.name] = value
+    return ret
+
+
+def _records(run):
+    yield {'version': ARCHIVE_VERSION, 'run': run.as_dict()}
+
+    auto = AutoResult.__table__
+    digests = set()
+    for row in db.session.execute(
+            select([auto.c[field + '_digest'] for field in AutoResult.TEXT_FIELDS])
+            .where(auto.c.run_id == run.id)):
+        digests.update(digest for digest in row if digest)
+    digests, blob = list(digests), Blob.__table__
+    for idx in range(0, len(digests), BATCH_SIZE):
+        for row in db.session.execute(
+                blob.select().where(blob.c.digest.in_(digests[idx:idx + BATCH_SIZE]))):
+            yield {'table': blob.name, 'row': _dump(blob, row)}
+
+    names = CaseName.__table__
+    for table in RESULT_TABLES[1:]:
+        column, key = CASE_COLUMNS.get(table.name, (None, None))
+        query = table.select()
+        if column:
+            query = select([table, names.c.name]).select_from(
+                table.join(names, names.c.id == table.c[column]))
+        for row in db.session.execute(query.where(table.c.run_id == run.id)):
+            data = _dump(table, row)
+            if column:
+                del data[column]
+                data[key] = row[names.c.name]
+            yield {'table': table.name, 'row': data}
+
+
+def _write(run, path):
+    path = os.path.join(ARCHIVE_DIR, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # Never leave a partial file at path
+    with gzip.open(path + '.tmp', 'wb') as archive:
+        for record in _records(run):
+            archive.write((json.dumps(record) + '\n').encode('utf-8'))
+    os.rename(path + '.tmp', path)
+
+
+def _insert(connection, table, records):
+    rows = [_load(table, data) for data in records]
+    if table.name in CASE_COLUMNS:
+        column, key = CASE_COLUMNS[table.name]
+        ids = CaseName.ids(connection, [data[key] for data in records])
+        for row, data in zip(rows, records):
+            row[column] = ids[data[key]]
+    if table is Blob.__table__:
+        # Blobs may be shared with runs in the database
+        Blob.save(connection, dict((row['digest'], (row['codec'], row['size'], row['data']))
+                                   for row in rows))
+    else:
+        connection.execute(table.insert(), rows)
+
+
+def _read(path):
+    tables = dict((table.name, table) for table in RESULT_TABLES)
+    connection = db.session.connection()
+    table, rows = None, []
+    with gzip.open(os.path.join(ARCHIVE_DIR, path), 'rb') as archive:
+        for line in archive:
+            record = json.loads(line.decode('utf-8'))
+            if 'version' in record:
+                if record['version'] > ARCHIVE_VERSION:
+                    raise ValueError("Unsupported archive version %s of %s" % (
+                        record['version'], path))
+                continue
+            if table is None or record['table'] != table.name or len(rows) >= BATCH_SIZE:
+                if rows:
+                    _insert(connection, table, rows)
+                table, rows = tables[record['table']], []
+            rows.append(record['row'])
+    if rows:
+        _insert(connection, table, rows)
+
+
+def archive_runs(run_ids):
+    """
+    Write results of test runs not archived yet to archive files, and
+    delete them from the database, in current transaction. Return ids of
+    runs archived.
+
+    Files are written before the transaction is committed, a rolled back
+    archive leaves files which are overwritten by the next one.
+    """
+    if not ARCHIVE_DIR:
+        raise RuntimeError("ARCHIVE_DIR must be set to archive test runs")
+    run_ids, archived = list(run_ids), []
+    for idx in range(0, len(run_ids), BATCH_SIZE):
+        for run in Run.query.filter(Run.id.in_(run_ids[idx:idx + BATCH_SIZE]),
+                                    Run.archive_path == None).with_for_update():
+            # Statistics can't be counted once results are gone
+            run.update(**run.get_statistics())
+            run.archive_path = archive_file(run.id)
+            _write(run, run.archive_path)
+            archived.append(run.id)
+    Run.delete_results(archived)
+    db.session.flush()
+    return archived
+
+
+def restore_runs(run_ids):
+    """
+    Restore results of archived test runs into the database, in current
+    transaction. Return archive files of runs restored, to be removed
+    with remove_files once committed.
+    """
+    run_ids, restored = list(run_ids), {}
+    for idx in range(0, len(run_ids), BATCH_SIZE):
+        for run in Run.query.filter(Run.id.in_(run_ids[idx:idx + BATCH_SIZE]),
+                                    Run.archive_path != None).with_for_update():
+            _read(run.archive_path)
+            restored[run.id] = run.archive_path
+            run.archive_path = None
+    if restored:
+        CaseHistory.rebuild(restored.keys())
+    db.session.flush()
+    return list(restored.values())
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, path))
+        except OSError as error:
+            LOGGER.warning("Failed to remove archive file %s: %s", path, error)
+
+
+def restore(run_ids):
+    """
+    Restore test runs which are archived and commit, return True if any
+    run was restored. Cheap for runs not archived.
+    """
+    run_ids = list(run_ids)
+    archived = [run_id for idx in range(0, len(run_ids), BATCH_SIZE) for run_id, in
+                db.session.query(Run.id).filter(Run.id.in_(run_ids[idx:idx + BATCH_SIZE]),
+                                                Run.archive_path != None)]
+    if not archived:
+        return False
+    try:
+        paths = restore_runs(archived)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    remove_files(paths)
+    LOGGER.info("Restored archived test runs %s", archived)
+    return True
@@ -0,0 +1,85 @@
+"""
+Diff of auto results across test runs
+
+Results of all runs are lined up by case with one GROUP BY query, so the
+join is done by the database, rows are streamed and only changed cases
+are kept.
+"""
+from sqlalchemy import func, case as case_when
+
+from . import db, AutoResult, CaseName
+
+CHUNK_SIZE = 500
+
+CHANGES = ['newly_failing', 'fixed', 'missing', 'new', 'changed', 'time_regression']
+
+
+def _line_up(run_ids):
+    """
+    Query (case, present, result, time, present, result, time, ...)
+    for each case in any of the runs, ordered by case.
+    """
+    columns = []
+    for run_id in run_ids:
+        in_run = AutoResult.run_id == run_id
+        columns.append(func.max(case_when([(in_run, 1)], else_=0)))
+        columns.append(func.max(case_when([(in_run, AutoResult.result)])))
+        columns.append(func.max(case_when([(in_run, AutoResult.time)])))
+    return db.session.query(CaseName.name, *columns)\
+        .select_from(AutoResult).join(CaseName, CaseName.id == AutoResult.case_id)\
+        .filter(AutoResult.run_id.in_(run_ids))\
+        .group_by(CaseName.name)\
+        .order_by(CaseName.name)
+
+
+def compare(old, new, time_threshold, time_min):
+    """
+    Compare two (result, time) of a case, None if absent,
+    return list of changes.
+    """
+    old_ran = old is not None and old[0] != 'missing'
+    new_ran = new is not None and new[0] != 'missing'
+    if not old_ran and not new_ran:
+        return []
+    if not new_ran:
+        return ['missing']
+    if not old_ran:
+        return ['new']
+
+    (old_result, old_time), (new_result, new_time) = old, new
+    if old_result != new_result:
+        if new_result == 'failed':
+            return ['newly_failing']
+        if old_result == 'failed' and new_result == 'passed':
+            return ['fixed']
+        return ['changed']
+    if (old_time and new_time and new_time - old_time >= time_min and
+            new_time > old_time * (1 + time_threshold)):
+        return ['time_regression']
+    return []
+
+
+def diff_runs(run_ids, time_threshold, time_min=0.0):
+    """
+    Yield changed cases between each run and the one before it in run_ids.
+
+    A time regression is reported when time grows by more than
+    time_threshold (a ratio) and at least time_min seconds.
+    """
+    for row in _line_up(run_ids).yield_per(CHUNK_SIZE):
+        lined = []
+        for idx in range(len(run_ids)):
+            present, result, time = row[1 + idx * 3:4 + idx * 3]
+            lined.append((result, time) if present else None)
+
+        changes = []
+        for idx in range(1, len(run_ids)):
+            for change in compare(lined[idx - 1], lined[idx], time_threshold, time_min):
+                changes.append({'from': run_ids[idx - 1], 'to': run_ids[idx], 'type': change})
+        if changes:
+            yield {
+                'case': row[0],
+                'results': [entry and entry[0] for entry in lined],
+                'times': [entry and entry[1] for entry in lined],
+                'changes': changes,
+            }
@@ -0,0 +1,308 @@
+"""
+Set based linkage generation
+
+Linkage of a batch of auto results is resolved in memory, only rows
+involved are loaded (with chunked IN queries), then manual results and
+linkage results are written with bulk inserts and updates. Bulk writes
+bypass session events, so statistics of the run, case history, the
+daily rollup, texts and ids of auto cases are maintained here. Cases are kept by name in memory.
+"""
+from collections import defaultdict
+
+from requests import HTTPError, ConnectionError
+
+from . import Run, AutoResult, ManualResult, LinkageResult, CaseHistory, CaseName, Blob, \
+    AutoResultDaily, manual_result_of, manual_comment_of, auto_comment_of
+from ..utils import caselink as CaseLink
+
+CHUNK_SIZE = 500
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for idx in range(0, len(values), size):
+        yield values[idx:idx + size]
+
+
+class Linkage(object):
+    """
+    In memory linkage result row.
+    """
+    __slots__ = ['manual_result_id', 'auto_result_id', 'result', 'error', 'detail']
+
+    def __init__(self, manual_result_id, auto_result_id, result=None, error=None, detail=None):
+        self.manual_result_id = manual_result_id
+        self.auto_result_id = auto_result_id
+        self.result = result
+        self.error = error
+        self.detail = detail
+
+    def as_mapping(self, run_id, case_ids):
+        return {
+            'run_id': run_id,
+            'manual_result_id': self.manual_result_id,
+            'auto_case_id': case_ids[self.auto_result_id],
+            'result': self.result,
+            'error': self.error,
+            'detail': self.detail,
+        }
+
+
+class LinkageEngine(object):
+    """
+    Generate linkage for auto results of one test run.
+
+    resolve() can be called for several batches of auto results,
+    state is kept between calls, flush() writes pending changes.
+    """
+    def __init__(self, session, run_id):
+        self.session = session
+        self.run_id = run_id
+
+        self.autos = {}  # case -> {'time', 'result', 'comment'}
+        self.manuals = {}  # case -> {'time', 'result', 'comment'}
+        self.by_manual = defaultdict(dict)  # manual case -> auto case -> Linkage
+        self.by_auto = defaultdict(dict)  # auto case -> manual case -> Linkage
+
+        self._loaded_autos = set()
+        self._loaded_manuals = set()
+        self._loaded_manual_linkages = set()
+        self._loaded_auto_linkages = set()
+
+        self._instances = {}
+        self._submitted = {}
+        self._new_autos = set()
+        self._new_manuals = set()
+        self._new_linkages = set()
+        self._dirty_linkages = set()
+        self._touched_autos = set()
+        self._touched_manuals = set()
+        self._statistics = defaultdict(int)
+
+    def _load_autos(self, cases):
+        cases = set(cases) - self._loaded_autos
+        for chunk in _chunks(cases):
+            for case, time, result, comment in self.session.query(
+                    CaseName.name, AutoResult.time, AutoResult.result, AutoResult.comment)\
+                    .select_from(AutoResult).join(CaseName, CaseName.id == AutoResult.case_id)\
+                    .filter(AutoResult.run_id == self.run_id, CaseName.name.in_(chunk)):
+                self.autos[case] = {'time': time, 'result': result, 'comment': comment}
+        self._loaded_autos.update(cases)
+
+    def _load_manuals(self, cases):
+        cases = set(cases) - self._loaded_manuals
+        for chunk in _chunks(cases):
+            for case, time, result, comment in self.session.query(
+                    ManualResult.case, ManualResult.time, ManualResult.result, ManualResult.comment)\
+                    .filter(ManualResult.run_id == self.run_id, ManualResult.case.in_(chunk)):
+                self.manuals[case] = {'time': time, 'result': result, 'comment': comment}
+        self._loaded_manuals.update(cases)
+
+    def _load_linkages(self, column, cases, loaded):
+        cases = set(cases) - loaded
+        for chunk in _chunks(cases):
+            for row in self.session.query(
+                    LinkageResult.manual_result_id, CaseName.name,
+                    LinkageResult.result, LinkageResult.error, LinkageResult.detail)\
+                    .select_from(LinkageResult)\
+                    .join(CaseName, CaseName.id == LinkageResult.auto_case_id)\
+                    .filter(LinkageResult.run_id == self.run_id, column.in_(chunk)):
+                # Never override linkage changed in memory
+                if row[1] not in self.by_manual[row[0]]:
+                    linkage = Linkage(*row)
+                    self.by_manual[row[0]][row[1]] = linkage
+                    self.by_auto[row[1]][row[0]] = linkage
+        loaded.update(cases)
+
+    def _set_linkage(self, manual_case, auto_case, result, error, detail):
+        linkage = self.by_manual[manual_case].get(auto_case)
+        if linkage is None:
+            linkage = Linkage(manual_case, auto_case)
+            self.by_manual[manual_case][auto_case] = linkage
+            self.by_auto[auto_case][manual_case] = linkage
+            self._new_linkages.add(linkage)
+        elif linkage not in self._new_linkages:
+            self._dirty_linkages.add(linkage)
+        linkage.result, linkage.error, linkage.detail = result, error, detail
+        self._touched_manuals.add(manual_case)
+        self._touched_autos.add(auto_case)
+
+    def _count(self, model, result, value):
+        col = model.statistics_col(result)
+        if col:
+            self._statistics[col] += value
+
+    def _gen_manual(self, manual_case, workitem):
+        """
+        Create a manual result, and mark its autocases
+        not in this run as missing.
+        """
+        self.manuals[manual_case] = {'time': 0.0, 'result': None, 'comment': None}
+        self._new_manuals.add(manual_case)
+        self._count(ManualResult, None, 1)
+        for auto_case in workitem['autocases']:
+            if auto_case not in self.autos:
+                self.autos[auto_case] = {'time': 0.0, 'result': 'missing', 'comment': None}
+                self._new_autos.add(auto_case)
+                self._set_linkage(manual_case, auto_case, None, "Missing", None)
+
+    def add(self, auto_results):
+        """
+        Take new AutoResult instances which are not added to the session,
+        flush() writes them and their texts with bulk inserts. Resolve
+        them like other auto results.
+        """
+        for instance in auto_results:
+            self._submitted[instance.case] = instance
+
+    def resolve(self, auto_results, gen_manual=True):
+        """
+        Generate linkage for AutoResult instances of this test run.
+
+        Result of an auto result is set to None if caselink is not
+        reachable for it, same as AutoResult.gen_linkage_result used to do.
+        """
+        self.session.flush()
+
+        auto_results = list(auto_results)
+        AutoResult.load_texts([instance for instance in auto_results
+                               if instance.result == 'failed'], ['failure'])
+
+        plans = []
+        for instance in auto_results:
+            self.autos[instance.case] = {'time': instance.time, 'result': instance.result,
+                                         'comment': instance.comment}
+            self._loaded_autos.add(instance.case)
+            try:
+                autocase = CaseLink.get_autocase(instance.case)
+            except (HTTPError, ConnectionError):
+                instance.result = self.autos[instance.case]['result'] = None
+                continue
+            self._instances[instance.case] = instance
+            plans.append((instance.case, instance.linkage_plan(autocase)))
+
+        self._load_linkages(CaseName.name,
+                            [case for case, _ in plans], self._loaded_auto_linkages)
+
+        workitems = set()
+        for case, plan in plans:
+            if not gen_manual:
+                last_wis, result, error, detail = plan[-1]
+                linked = set(self.by_auto[case].keys())
+                for wis, _, _, _ in plan[:-1]:
+                    linked.update(wis)
+                plan[-1] = (sorted(linked), result, error, detail)
+            for wis, _, _, _ in plan:
+                workitems.update(wis)
+
+        self._load_manuals(workitems)
+        self._load_linkages(LinkageResult.manual_result_id, workitems,
+                            self._loaded_manual_linkages)
+
+        new_workitems = workitems - set(self.manuals.keys())
+        CaseLink.prefetch_workitems(new_workitems)
+        mappings = dict((wi, CaseLink.get_workitem(wi)) for wi in new_workitems)
+
+        linked_autos = set()
+        for wi in workitems:
+            linked_autos.update(self.by_manual[wi].keys())
+        for workitem in mappings.values():
+            linked_autos.update(workitem['autocases'])
+        self._load_autos(linked_autos)
+
+        for case, plan in plans:
+            for wis, result, error, detail in plan:
+                for wi in wis:
+                    if wi not in self.manuals:
+                        self._gen_manual(wi, mappings[wi])
+                    self._set_linkage(wi, case, result, error, detail)
+            self._touched_autos.add(case)
+
+    def _refresh(self):
+        """
+        Regenerate result, comment and duration of touched manual results,
+        and comment of touched auto results.
+        """
+        for case in self._touched_manuals:
+            linkages = list(self.by_manual[case].values())
+            manual = self.manuals[case]
+            self._count(ManualResult, manual['result'], -1)
+            manual['result'] = manual_result_of(linkages)
+            self._count(ManualResult, manual['result'], 1)
+            manual['comment'] = manual_comment_of(linkages)
+            manual['time'] = sum(float(self.autos[l.auto_result_id]['time']) for l in linkages)
+        for case in self._touched_autos:
+            self.autos[case]['comment'] = auto_comment_of(self.by_auto[case].values())
+
+    def flush(self):
+        """
+        Write all pending changes with bulk inserts and updates.
+        """
+        self._refresh()
+        session, run_id = self.session, self.run_id
+
+        # Ids of auto cases written, new auto cases are added to the dictionary
+        case_ids = CaseName.ids(session.connection(), self._new_autos.union(
+            self._submitted,
+            (l.auto_result_id for l in self._new_linkages | self._dirty_linkages)))
+
+        new_autos, updated_manuals = [], []
+        for case in self._touched_autos:
+            auto = self.autos[case]
+            if case in self._new_autos:
+                new_autos.append({'run_id': run_id, 'case_id': case_ids[case], 'time': auto['time'],
+                                  'result': auto['result'], 'comment': auto['comment']})
+            elif case in self._instances:
+                self._instances[case].comment = auto['comment']
+
+        blobs = {}
+        for case, instance in self._submitted.items():
+            mapping = {'run_id': run_id, 'case_id': case_ids[case], 'time': instance.time or 0.0,
+                       'result': instance.result, 'comment': instance.comment}
+            for field in AutoResult.TEXT_FIELDS:
+                mapping[field + '_digest'] = getattr(instance, field + '_digest')
+            new_autos.append(mapping)
+            blobs.update(instance.__dict__.get('_pending_blobs', {}))
+            self._count(AutoResult, instance.result, 1)
+
+        new_manuals = []
+        for case in self._touched_manuals:
+            mapping = dict(self.manuals[case], run_id=run_id, case=case)
+            if case in self._new_manuals:
+                new_manuals.append(mapping)
+            else:
+                updated_manuals.append(mapping)
+
+        Blob.save(session.connection(), blobs)
+        session.bulk_insert_mappings(AutoResult, new_autos)
+        session.bulk_insert_mappings(ManualResult, new_manuals)
+        session.bulk_insert_mappings(LinkageResult,
+                                     [l.as_mapping(run_id, case_ids) for l in self._new_linkages])
+        session.bulk_update_mappings(ManualResult, updated_manuals)
+        session.bulk_update_mappings(LinkageResult,
+                                     [l.as_mapping(run_id, case_ids) for l in self._dirty_linkages])
+        Run.adjust_statistics(session.connection(), {run_id: self._statistics})
+        CaseHistory.record(session.connection(), new_autos)
+        AutoResultDaily.adjust(session.connection(), [
+            (run_id, row['case_id'], row['result'], 1) for row in new_autos])
+        CaseName.record(session.connection(), [result['case'] for result in new_manuals])
+
+        # Bulk operations bypass the identity map, expire stale instances
+        for instance in list(session.identity_map.values()):
+            if isinstance(instance, (ManualResult, LinkageResult)) and instance.run_id == run_id:
+                session.expire(instance)
+            elif isinstance(instance, AutoResult) and instance.run_id == run_id:
+                session.expire(instance, ['linkage_results'])
+            elif isinstance(instance, Run) and instance.id == run_id and self._statistics:
+                session.expire(instance, list(self._statistics.keys()))
+
+        self._new_autos.clear()
+        self._new_manuals.clear()
+        self._new_linkages.clear()
+        self._dirty_linkages.clear()
+        self._touched_autos.clear()
+        self._touched_manuals.clear()
+        self._instances.clear()
+        self._submitted.clear()
+        self._statistics.clear()
+        self.session.flush()
@@ -0,0 +1,75 @@
+"""
+Indexed search of run and case names
+
+Substring search goes through FTS5 trigram tables on SQLite, or ILIKE
+backed by trigram GIN indexes on PostgreSQL, see _search_index. Regex
+search is only supported on PostgreSQL, elsewhere the pattern is
+searched as a substring. Results are found by case through the
+CaseName dictionary, so result tables are never scanned.
+"""
+from sqlalchemy import text, column as sql_column, Integer
+
+from . import db, Run, AutoResult, CaseName
+
+# FTS5 trigram tables can't match less than 3 characters
+FTS_MIN_LENGTH = 3
+
+_fts_tables = {}
+
+
+def _has_fts(session, fts):
+    bind = session.get_bind()
+    key = (str(bind.url), fts)
+    if key not in _fts_tables:
+        _fts_tables[key] = session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': fts}).first() is not None
+    return _fts_tables[key]
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _match(column, key, fts, value, regex=False):
+    """
+    Filter on column containing value, or matching value as a regex,
+    key is the primary key of the table indexed by fts.
+    """
+    session = db.session
+    dialect = session.get_bind().dialect.name
+    if regex and dialect == 'postgresql':
+        return column.op('~')(value)
+    if dialect == 'sqlite' and len(value) >= FTS_MIN_LENGTH and _has_fts(session, fts):
+        return key.in_(text("SELECT rowid FROM %s WHERE %s MATCH :_fts_query" % (fts, fts))
+                       .bindparams(_fts_query='"%s"' % value.replace('"', '""'))
+                       .columns(sql_column('rowid', Integer)))
+    return column.ilike('%%%s%%' % _escape_like(value), escape='\\')
+
+
+def run_name_filter(value, regex=False):
+    """
+    Filter on runs with a name containing (or matching) value.
+    """
+    return _match(Run.name, Run.id, 'run_name_fts', value, regex)
+
+
+def case_name_query(value, regex=False, column=CaseName.name):
+    """
+    Query names (or another column) of cases containing (or matching) value.
+    """
+    return db.session.query(column)\
+        .filter(_match(CaseName.name, CaseName.id, 'case_name_fts', value, regex))
+
+
+def contains_case_filter(model, value, regex=False):
+    """
+    Filter on runs having a result of model, whose case name contains
+    (or matches) value.
+    """
+    if model is AutoResult:
+        # Auto results refer to cases by id
+        cases = AutoResult.case_id.in_(case_name_query(value, regex, CaseName.id))
+    else:
+        cases = model.case.in_(case_name_query(value, regex))
+    return Run.id.in_(db.session.query(model.run_id).filter(cases))
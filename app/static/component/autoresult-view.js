@@ -12,9 +12,7 @@ export default {
   methods: {
     refreshResult(){
       let vm = this;
-      dashboard.refreshAutoCase(d.case).done(function(data){
-        dashboard.autoCaseAPI("GET", this.runId, this.dtData.case).done(vm.refreshData);
-      });
+      dashboard.refreshAutoCase(this.runId, this.dtData.case).done(vm.refreshData);
     },
     deleteResult(){
       let vm = this;
@@ -18,6 +18,27 @@
     });
   }
 
+  // Celery states of finished tasks
+  const TASK_READY_STATES = ["SUCCESS", "FAILURE", "REVOKED"];
+  const TASK_POLL_INTERVAL = 1000;
+
+  function _waitTask(taskId){
+    let deferred = $.Deferred();
+    (function poll(){
+      $.getJSON("/tasks/" + taskId).done(function(task){
+        if (TASK_READY_STATES.indexOf(task.state) === -1){
+          deferred.notify(task);
+          setTimeout(poll, TASK_POLL_INTERVAL);
+        } else if (task.state === "SUCCESS"){
+          deferred.resolve(task);
+        } else {
+          deferred.reject(task);
+        }
+      }).fail(deferred.reject);
+    })();
+    return deferred.promise();
+  }
+
   function _Trigger(method, url, data){
     return $.ajax(url, {
       contentType: "application/json; charset=utf-8",
@@ -35,6 +56,14 @@
         text += "Error: " + data.error + "\n";
       }
       alert(text);
+    }).then(function(data){
+      // Triggers queuing a task are done once the task is
+      if (!data.task_id){
+        return data;
+      }
+      return _waitTask(data.task_id).fail(function(task){
+        alert("Task failed with: " + JSON.stringify(task.meta || task));
+      }).then(() => data);
     });
   }
 
@@ -1,58 +1,36 @@
-var dtMixins = require('datatables-mixins');
-var htmlify = require("./lib/htmlify.js");
-var Cookies = require('js-cookie');
 var Vue = require("vue");
-var _p = require("./lib/sharedParameters.js");
-var _ = require("lodash");
-
-var dashboard = require("./lib/dashboard.js");
 
 var vm = new Vue({
   el: "#testrun-diff",
   delimiters: ['${', '}'],
-  props: {
-    testRunIds: [1, 2],
-  },
   data: function() {
     return {
       ready: false,
-      testRuns: [],
-      testAttrs: ["case", "comment", "result"],
-      testAttrsKeys: ["case", "comment", "result"]
+      runs: [],
+      counts: {},
+      cases: [],
     };
   },
   methods: {
   },
   created: function(){
-    this.testRuns = this.testRunIds.map((value, idx, arr) =>
-      window.fetch(`/api/run/${value}/auto/`)
-        .then(res => res.json()
-            .then(data => this.testRuns[idx] = data)
-            .catch(err => alert(`Failing json parsing with ${err}`))
-        )
-    );
-    Promise.all(this.testRuns).then(() => {
-      let casesByName = _.groupBy(_.concat(...this.testRuns), testcase => testcase.case);
-      let commonCases = _.intersectionBy(...this.testRuns, "case");
-      let commonCasesByName = _.groupBy(commonCases, testcase => testcase.case);
-      _.forEach(this.testRuns, testrun => {
-        _.forEach(testrun, testcase => {
-          if(!commonCasesByName[testcase.case])
-            testcase.different = "new";
-          else if(_.some(casesByName[testcase.case], (otherTestcase) => {console.log(otherTestcase);return otherTestcase.result != testcase.result;}))
-            testcase.different = "diff";
-          else
-            testcase.different = "";
-        });
-      });
-      this.ready = true;
-    });
+    let params = new URLSearchParams(window.location.search);
+    window.fetch(`/api/diff/?runs=${params.get("runs") || ""}`)
+      .then(res => res.json())
+      .then(data => {
+        if (!data.cases) {
+          alert(data.message);
+          return;
+        }
+        this.runs = data.runs;
+        this.counts = data.counts;
+        this.cases = data.cases;
+        this.ready = true;
+      })
+      .catch(err => alert(`Failing json parsing with ${err}`));
   },
   watch: {
   },
   mounted: function(){
   }
 });
-
-var TestRunChildRow = Vue.extend({
-});
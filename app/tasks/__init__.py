@@ -1,7 +1,10 @@
 from celery.task.control import inspect
 from celery.result import AsyncResult
 
-from .polarion import submit_to_polarion
+from .polarion import submit_to_polarion, submit_run_to_polarion
+from .refresh import refresh_testrun, refresh_auto, refresh_manual
+from .statistics import rollup_statistics, rollup_statistics_daily
+from .retention import purge_runs, archive_runs
 
 def get_workers():
     workers = inspect(['celery@localhost']).active()
@@ -9,14 +12,18 @@ def get_workers():
         return {}
     return workers.items()
 
+def _task_info(res):
+    if isinstance(res.info, Exception):
+        return str(res.info)
+    return res.info
+
 def get_task_status(task_uuid):
     res = AsyncResult(task_uuid)
-    rerutn ({
-        'name': task['name'],
-        'id': task['id'],
+    return {
+        'id': task_uuid,
         'state': res.state,
-        'meta': res.info
-    })
+        'meta': _task_info(res)
+    }
 
 def get_running_tasks_status():
     task_status = []
@@ -27,7 +34,7 @@ def get_running_tasks_status():
                 'name': task['name'],
                 'id': task['id'],
                 'state': res.state,
-                'meta': res.info
+                'meta': _task_info(res)
             })
     return task_status
 
@@ -36,7 +43,7 @@ def cancel_task(task_id):
     res.revoke(terminate=True)
     return {
         'state': res.state,
-        'meta': res.info,
+        'meta': _task_info(res),
         'cancelled': True
     }
 
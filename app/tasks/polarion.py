@@ -1,12 +1,13 @@
 import re
 import datetime
-from sqlalchemy import func
-from celery import current_task
+from sqlalchemy import func, or_
+from celery import current_task, group as task_group
 import traceback
 
 from .. import celery
-from ..model import db, Tag, Run
+from ..model import db, Tag, Run, ManualResult
 from ..utils import polarion as Polarion
+from ..utils import response_cache as ResponseCache
 
 from config import ActiveConfig
 
@@ -15,6 +16,7 @@ POLARION_USER = ActiveConfig.POLARION_USER
 POLARION_PLANS = ActiveConfig.POLARION_PLANS
 POLARION_PROJECT = ActiveConfig.POLARION_PROJECT
 POLARION_PASSWORD = ActiveConfig.POLARION_PASSWORD
+POLARION_QUEUE = ActiveConfig.POLARION_QUEUE
 
 CHUNK_SIZE = 256
 
@@ -28,117 +30,183 @@ def update_status(state, meta=None):
         current_task.update_state(state=state, meta=meta)
 
 
-@celery.task()
-def submit_to_polarion(testrun_ids, forced=False):
-    if not ActiveConfig.POLARION_ENABLED:
+def _submitted_results(run_id):
+    """
+    Query manual results of a run which should be submitted to Polarion.
+    """
+    return ManualResult.query.filter(
+        ManualResult.run_id == run_id,
+        or_(ManualResult.result == None,
+            ManualResult.result.notin_(['ignored', 'skipped'])))
+
+
+def _polarion_result(result):
+    if result not in ['passed', 'failed']:
+        return 'blocked'
+    return result
+
+
+def _polarion_counts(run_id):
+    """
+    Testsuite counts of the results to submit, counted by the database,
+    as the XUnit document is streamed and counts are written first.
+    """
+    counts = {'tests': 0, 'failures': 0, 'errors': 0, 'skipped': 0, 'time': 0.0}
+    query = _submitted_results(run_id)\
+        .with_entities(ManualResult.result, func.count(), func.sum(ManualResult.time))\
+        .group_by(ManualResult.result)
+    for result, count, time in query:
+        counts['tests'] += count
+        counts['time'] += time or 0.0
+        polarion_result = _polarion_result(result)
+        if polarion_result == 'failed':
+            counts['failures'] += count
+        elif polarion_result == 'blocked':
+            counts['errors'] += count
+    return counts
+
+
+def _gen_polarion_testrun(testrun):
+    def get_nearest_plan(product, version, date):
+        query = ActiveConfig.POLARION_PLAN_QUERY["%s-%s" % (product, version)]
+        return Polarion.get_nearest_plan(query, date)
+
+    testrun_description = 'Dashboard ID: "%s", Tags: "%s" ' % (
+        testrun.id, " ".join('"%s"' % t.name for t in testrun.tags.all()))
+
+    testrun_tags = ", ".join(tag.name.lstrip("polarion:").strip()
+                             for tag in testrun.tags.filter(Tag.name.like("polarion:%")) or [])
+
+    testrun_properties = {}
+    for test_property in testrun.properties.all():
+        name, value = test_property.name, test_property.value
+        group_name, prop_name = name.split('-', 1)
+        prop_group = testrun_properties.setdefault(group_name, {})
+        prop_group[prop_name] = value
+
+    for group_name, group in testrun_properties.items():
+        if group_name in ["package"]:
+            for name, value in group.items():
+                testrun_description += "%s: (%s: %s)" % ((
+                    group_name.title(), name, value))
+
+    testrun_id = '{name} {framework} {build} {date} {extra}'.format(
+        name=testrun.name,
+        framework=testrun.framework,
+        build=testrun.build,
+        date=testrun.date.isoformat(),
+        extra=" ".join([tag.name for tag in testrun.tags.all()])
+    )
+
+    testrun_id = re.sub(r'[.\/:*"<>|~!@#$?%^&\'*()+`,=]', '-', testrun_id)
+    testrun_name = testrun_id
+
+    if testrun.arch == "x86_64":
+        testarch = 'x8664'
+    else:
+        testarch = testrun.arch
+
+    testrun_record = Polarion.TestRunRecord(
+        POLARION_PROJECT,
+        testrun_name,
+
+        # Custom fields
+        description=testrun_description,
+        assignee="kasong",
+        plannedin=get_nearest_plan(testrun.product, testrun.version, testrun.date),
+        isautomated=True,
+        build=testrun.build,
+        arch=testarch,
+        component=testrun.component,
+        jenkinsjobs=testrun.ci_url,
+        tags=testrun_tags
+    )
+
+    testrun_record.set_polarion_property("group-id", testrun.build)
+    testrun_record.set_polarion_property("testrun-id", testrun_id)
+    # testrun_record.set_polarion_property("testrun-type-id", testrun.type)
+    testrun_record.set_polarion_property("testrun-template-id", "libvirt-autotest")
+    testrun_record.set_polarion_response("libvirt_dashboard_submitted", "true")
+    testrun_record.set_polarion_response("libvirt_dashboard_id", testrun.id)
+    testrun_record.set_polarion_response("polarion_testrun", testrun_id)
+    testrun_record.set_polarion_response("libvirt_dashboard_build", testrun.build)
+
+    return testrun_record
+
+
+def _lock_run(testrun_id):
+    # Read-only lock for updating the row, released on commit
+    return Run.query.with_for_update(read=True).filter(Run.id == testrun_id).first()
+
+
+@celery.task(rate_limit=ActiveConfig.POLARION_RATE_LIMIT)
+def submit_run_to_polarion(testrun_id, forced=False):
+    """
+    Submit one test run to Polarion, the run is only locked while
+    updating its status, not during the upload.
+    """
+    test_run = _lock_run(testrun_id)
+    if test_run is None:
+        db.session.commit()
         return
+    test_run.submit_status = "Task running"
+    db.session.commit()
+    ResponseCache.invalidate_runs([testrun_id])
 
-    def _gen_polarion_testrun(testrun):
-        def get_nearest_plan(product, version, date):
-            query = ActiveConfig.POLARION_PLAN_QUERY["%s-%s" % (product, version)]
-            return Polarion.get_nearest_plan(query, date)
-
-        testrun_description = 'Dashboard ID: "%s", Tags: "%s" ' % (
-            testrun.id, " ".join('"%s"' % t.name for t in testrun.tags.all()))
-
-        testrun_tags = ", ".join(tag.name.lstrip("polarion:").strip()
-                                 for tag in testrun.tags.filter(Tag.name.like("polarion:%")) or [])
-
-        testrun_properties = {}
-        for test_property in testrun.properties.all():
-            name, value = test_property.name, test_property.value
-            group_name, prop_name = name.split('-', 1)
-            prop_group = testrun_properties.setdefault(group_name, {})
-            prop_group[prop_name] = value
-
-        for group_name, group in testrun_properties.items():
-            if group_name in ["package"]:
-                for name, value in group.items():
-                    testrun_description += "%s: (%s: %s)" % ((
-                        group_name.title(), name, value))
-
-        testrun_id = '{name} {framework} {build} {date} {extra}'.format(
-            name=testrun.name,
-            framework=testrun.framework,
-            build=testrun.build,
-            date=testrun.date.isoformat(),
-            extra=" ".join([tag.name for tag in test_run.tags.all()])
-        )
-
-        testrun_id = re.sub(r'[.\/:*"<>|~!@#$?%^&\'*()+`,=]', '-', testrun_id)
-        testrun_name = testrun_id
-
-        if testrun.arch == "x86_64":
-            testarch = 'x8664'
+    try:
+        polarion_testrun = _gen_polarion_testrun(test_run)
+        # Results are streamed from database into the upload body
+        records = _submitted_results(testrun_id)\
+            .with_entities(ManualResult.case, ManualResult.result,
+                           ManualResult.time, ManualResult.comment)\
+            .order_by(ManualResult.case)\
+            .yield_per(CHUNK_SIZE)
+        polarion_testrun.stream_testcases(
+            ((case, _polarion_result(result), time, comment)
+             for case, result, time, comment in records),
+            _polarion_counts(testrun_id))
+
+        res = polarion_testrun.submit()
+        if res:
+            raise Exception(str(res))
+
+    except Exception as error:
+        db.session.rollback()
+        submit_status = (
+            "Failed: %s: %s" % (type(error), getattr(error, 'message', None) or str(error))
+        )  # TODO
+        polarion_id = None
+        if hasattr(error, "__traceback__"):
+            traceback.print_tb(error.__traceback__)
         else:
-            testarch = testrun.arch
-
-        testrun_record = Polarion.TestRunRecord(
-            POLARION_PROJECT,
-            testrun_name,
-
-            # Custom fields
-            description=testrun_description,
-            assignee="kasong",
-            plannedin=get_nearest_plan(testrun.product, testrun.version, testrun.date),
-            isautomated=True,
-            build=testrun.build,
-            arch=testarch,
-            component=test_run.component,
-            jenkinsjobs=test_run.ci_url,
-            tags=testrun_tags
-        )
-
-        testrun_record.set_polarion_property("group-id", test_run.build)
-        testrun_record.set_polarion_property("testrun-id", testrun_id)
-        # testrun_record.set_polarion_property("testrun-type-id", testrun.type)
-        testrun_record.set_polarion_property("testrun-template-id", "libvirt-autotest")
-        testrun_record.set_polarion_response("libvirt_dashboard_submitted", "true")
-        testrun_record.set_polarion_response("libvirt_dashboard_id", test_run.id)
-        testrun_record.set_polarion_response("polarion_testrun", testrun_id)
-        testrun_record.set_polarion_response("libvirt_dashboard_build", test_run.build)
-
-        return testrun_record
+            traceback.print_exc()
+        # TODO: Error Detail
+
+    else:
+        # No exception, means everything went well
+        submit_status = "Waiting For Feedback"
+        polarion_id = polarion_testrun.get_polarion_property('testrun-id')
 
     try:
-        # Read-only lock for updating rows
-        query = Run.query.with_for_update(read=True).filter(Run.id.in_(testrun_ids))
-        for test_run in query.all():
-            test_run.submit_status = "Task running"
-            try:
-                polarion_testrun = _gen_polarion_testrun(test_run)
-                for record in test_run.manual_results:
-                    polarion_result = record.result
-                    if polarion_result in ['ignored', 'skipped']:
-                        continue
-                    if polarion_result not in ['passed', 'failed']:
-                        polarion_result = 'blocked'
-
-                    polarion_testrun.add_testcase(
-                        case=record.case,
-                        result=polarion_result,
-                        comment=record.comment,
-                        elapsed_sec=record.time,
-                    )
-
-                res = polarion_testrun.submit()
-                if res:
-                    raise Exception(str(res))
-
-            except Exception as error:
-                test_run.submit_status = (
-                    "Failed: %s: %s" % (type(error), error.message or str(error))
-                )  # TODO
-                if hasattr(error, "__traceback__"):
-                    traceback.print_tb(error.__traceback__)
-                else:
-                    traceback.print_exc()
-                # TODO: Error Detail
-
-            else:
-                # No exception, means everything went well
-                test_run.polarion_id = polarion_testrun.get_polarion_property('testrun-id')
-                test_run.submit_status = "Waiting For Feedback"
+        test_run = _lock_run(testrun_id)
+        if test_run is not None:
+            test_run.submit_status = submit_status
+            if polarion_id:
+                test_run.polarion_id = polarion_id
     finally:
         # Always Release the lock
-        query.session.commit()
+        db.session.commit()
+        ResponseCache.invalidate_runs([testrun_id])
+
+
+@celery.task()
+def submit_to_polarion(testrun_ids, forced=False):
+    """
+    Fan out submission of test runs, one task per run, sent to
+    POLARION_QUEUE if set.
+    """
+    if not ActiveConfig.POLARION_ENABLED:
+        return
+    options = {'queue': POLARION_QUEUE} if POLARION_QUEUE else {}
+    return task_group(submit_run_to_polarion.s(testrun_id, forced).set(**options)
+                      for testrun_id in testrun_ids).apply_async().id
@@ -0,0 +1,96 @@
+from .. import celery
+from ..model import db, Run, AutoResult, ManualResult, LinkageResult, CaseHistory, CaseName
+from ..model.linkage import LinkageEngine
+from ..utils import caselink as CaseLink
+from ..utils import response_cache as ResponseCache
+from .polarion import update_status
+
+CHUNK_SIZE = 256
+
+
+def _prefetch_caselink(query, invalidate=False):
+    """
+    Warm up caselink cache for all cases in query, return the case list.
+    """
+    cases = [case for case, in query.join(CaseName, CaseName.id == AutoResult.case_id)
+             .with_entities(CaseName.name)]
+    CaseLink.prefetch(cases, invalidate=invalidate)
+    return cases
+
+
+def _refresh_results(run_id, query, refresh_result=True, gen_manual=True, invalidate=False):
+    """
+    Regenerate linkage of auto results in query, chunk by chunk.
+    """
+    cases = _prefetch_caselink(query, invalidate)
+    total = len(cases)
+    engine = LinkageEngine(db.session, run_id)
+    try:
+        for idx in range(0, total, CHUNK_SIZE):
+            chunk = query.filter(AutoResult.case.in_(cases[idx:idx + CHUNK_SIZE])).all()
+            if refresh_result:
+                AutoResult.load_texts(chunk, ['skip', 'failure', 'output'])
+                for result_instance in chunk:
+                    result_instance.refresh_result()
+            engine.resolve(chunk, gen_manual=gen_manual)
+            engine.flush()
+            update_status('PROGRESS', {
+                'run_id': run_id,
+                'current': idx + len(chunk),
+                'total': total,
+            })
+        # Bulk deletes above bypass incremental statistics and case history
+        Run.rebuild_statistics([run_id])
+        CaseHistory.rebuild([run_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        ResponseCache.invalidate_runs([run_id])
+    return {'run_id': run_id, 'total': total}
+
+
+@celery.task()
+def refresh_testrun(run_id, invalidate=False):
+    """
+    Drop all linkage and manual results of a test run and regenerate them.
+    """
+    LinkageResult.query.filter(LinkageResult.run_id == run_id).\
+        delete(synchronize_session=False)
+    ManualResult.query.filter(ManualResult.run_id == run_id).\
+        delete(synchronize_session=False)
+    AutoResult.query.filter(
+        AutoResult.run_id == run_id,
+        AutoResult.output == None,
+        AutoResult.failure == None,
+        AutoResult.skip == None).\
+        delete(synchronize_session=False)
+
+    query = AutoResult.query.filter(AutoResult.run_id == run_id)
+    return _refresh_results(run_id, query, invalidate=invalidate)
+
+
+@celery.task()
+def refresh_auto(run_id, case=None, invalidate=False):
+    """
+    Regenerate result and linkage of auto results in a test run,
+    existing manual results are kept.
+    """
+    query = AutoResult.query.filter(AutoResult.run_id == run_id)
+    if case:
+        query = query.filter(AutoResult.case == case)
+    return _refresh_results(run_id, query, gen_manual=False, invalidate=invalidate)
+
+
+@celery.task()
+def refresh_manual(run_id, invalidate=False):
+    """
+    Drop manual results of a test run and regenerate them from auto results.
+    """
+    ManualResult.query.filter(ManualResult.run_id == run_id).\
+        delete(synchronize_session=False)
+
+    query = AutoResult.query.filter(AutoResult.run_id == run_id)
+    return _refresh_results(run_id, query, refresh_result=False, gen_manual=False,
+                            invalidate=invalidate)
@@ -0,0 +1,99 @@
+import datetime
+import logging
+
+from .. import celery
+from ..model import db, Run, Blob, BATCH_SIZE
+from ..model import archive as Archive
+from ..utils import response_cache as ResponseCache
+from ..utils.response_cache import run_scope, tags_scope, runs_scope
+
+from config import ActiveConfig
+
+RETENTION_DAYS = ActiveConfig.RETENTION_DAYS
+RETENTION_BATCH_SIZE = ActiveConfig.RETENTION_BATCH_SIZE
+ARCHIVE_DAYS = ActiveConfig.ARCHIVE_DAYS
+BLOB_GRACE_PERIOD = ActiveConfig.BLOB_GRACE_PERIOD
+
+LOGGER = logging.getLogger('lib-dash.retention')
+
+
+def _old_runs(days, batch_size, *criterion):
+    before = datetime.datetime.now() - datetime.timedelta(days=days)
+    return [run_id for run_id, in db.session.query(Run.id)
+            .filter(Run.date < before, *criterion).order_by(Run.date).limit(batch_size)]
+
+
+def _delete_blobs():
+    """
+    Delete blobs unreferenced for BLOB_GRACE_PERIOD in batches, return
+    number of blobs deleted. Runs are already gone, so a failure here is
+    logged, not raised.
+    """
+    deleted = 0
+    try:
+        digests = Blob.unreferenced(BLOB_GRACE_PERIOD)
+        for idx in range(0, len(digests), BATCH_SIZE):
+            deleted += Blob.delete_unreferenced(digests[idx:idx + BATCH_SIZE], BLOB_GRACE_PERIOD)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        LOGGER.exception("Failed deleting unreferenced blobs")
+    return deleted
+
+
+@celery.task()
+def purge_runs(days=RETENTION_DAYS, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Delete test runs older than days, batch_size runs per transaction so
+    locks are held shortly, then blobs no longer referred to.
+    """
+    if not days:
+        return {'runs': 0, 'blobs': 0}
+    deleted = 0
+    while True:
+        run_ids = _old_runs(days, batch_size)
+        if not run_ids:
+            break
+        try:
+            paths = [path for path, in db.session.query(Run.archive_path)
+                     .filter(Run.id.in_(run_ids), Run.archive_path != None)]
+            deleted += Run.delete_runs(run_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        Archive.remove_files(paths)
+        ResponseCache.invalidate(tags_scope(), runs_scope(),
+                                 *[run_scope(run_id) for run_id in run_ids])
+    if not deleted:
+        return {'runs': 0, 'blobs': 0}
+
+    blobs = _delete_blobs()
+    return {'runs': deleted, 'blobs': blobs}
+
+
+@celery.task()
+def archive_runs(days=ARCHIVE_DAYS, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Move results of test runs older than days to archive files,
+    batch_size runs per transaction, then blobs no longer referred to.
+    """
+    if not days:
+        return {'runs': 0, 'blobs': 0}
+    archived = 0
+    while True:
+        run_ids = _old_runs(days, batch_size, Run.archive_path == None)
+        if not run_ids:
+            break
+        try:
+            archived += len(Archive.archive_runs(run_ids))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ResponseCache.invalidate_runs(run_ids)
+    if not archived:
+        return {'runs': 0, 'blobs': 0}
+
+    blobs = _delete_blobs()
+    return {'runs': archived, 'blobs': blobs}
@@ -0,0 +1,42 @@
+import datetime
+
+from .. import celery
+from ..model import db, AutoResultDaily
+
+from config import ActiveConfig
+
+STATISTICS_ROLLUP = ActiveConfig.STATISTICS_ROLLUP
+
+
+@celery.task()
+def rollup_statistics_daily():
+    """
+    Periodic rollup of days since the last rolled up one, if
+    STATISTICS_ROLLUP is enabled. Rolled up days are kept up to date
+    by applying changes of auto results.
+    """
+    if not STATISTICS_ROLLUP:
+        return {'rows': 0}
+    last_day = AutoResultDaily.last_day()
+    return _rollup(last_day and last_day + datetime.timedelta(days=1), datetime.date.today())
+
+
+@celery.task()
+def rollup_statistics(days=None):
+    """
+    Regenerate daily rollup of auto results of last days, today
+    excluded, days is None for all days. Counts of purged or archived
+    test runs in these days are lost.
+    """
+    end = datetime.date.today()
+    return _rollup(end - datetime.timedelta(days=days) if days else None, end)
+
+
+def _rollup(start, end):
+    try:
+        rows = AutoResultDaily.rollup(start, end)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {'start': start and start.isoformat(), 'end': end.isoformat(), 'rows': rows}
@@ -1,9 +1,13 @@
 #!/bin/env python
 import sys
 import os
+import re
 import app
+import glob
 import math
 import random
+import shutil
+import subprocess
 import unittest
 import datetime
 import tempfile
@@ -11,6 +15,7 @@ import argparse
 
 import six.moves as sm
 from flask import json, jsonify
+from sqlalchemy import event
 
 class randFilledBoolList(list):
     """Generate a List of random booleans, with a given True ratio, and length. """
@@ -166,6 +171,629 @@ class FixtureTest(DashboardTestCase):
                                           name=name, tags=tags, build=build)
 
 
+class BulkSubmitTest(FixtureTest):
+    def test_bulk_submit(self):
+        self.submit_test_run()
+        results = [{"case": "a.bulk.%s.test" % idx, "time": "1.2345", "output": "Passed output"}
+                   for idx in sm.range(5)]
+        results.append({"case": "a.bulk.0.test", "time": "1.2345", "output": "Duplicated"})
+        results.append({"case": "a.bulk.invalid.test", "time": "bad", "output": "Passed output"})
+
+        rv = self.app.post('/api/run/' + self.last_run_id + '/bulk/auto/',
+                           data=json.dumps(results), content_type='application/json')
+        rv_data = json.loads(rv.data)
+        assert rv_data['created'] == 5
+        assert rv_data['invalid'] == 2
+        assert [r['case'] for r in rv_data['results']] == [r['case'] for r in results]
+
+        ndjson = "\n".join(json.dumps(r) for r in results[:2])
+        rv = self.app.post('/api/run/' + self.last_run_id + '/bulk/auto/',
+                           data=ndjson, content_type='application/x-ndjson')
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 400
+        assert rv_data['conflict'] == 2
+
+        rv = self.app.get('/api/run/' + self.last_run_id + '/auto/')
+        assert len(json.loads(rv.data)) == 5
+
+    def test_bulk_submit_chunk_failure(self):
+        from app.utils import caselink
+        self.submit_test_run()
+        results = [{"case": "a.bulk.%s.test" % idx, "time": "1.2345", "output": "Passed output"}
+                   for idx in sm.range(4)]
+        url = '/api/run/' + self.last_run_id + '/bulk/auto/?chunk_size=2'
+
+        get_autocase = caselink.get_autocase
+
+        def broken_autocase(case_id):
+            if case_id == "a.bulk.3.test":
+                raise RuntimeError("Broken linkage")
+            return get_autocase(case_id)
+
+        caselink.get_autocase = broken_autocase
+        try:
+            rv = self.app.post(url, data=json.dumps(results), content_type='application/json')
+        finally:
+            caselink.get_autocase = get_autocase
+        rv_data = json.loads(rv.data)
+        assert rv.status_code == 200
+        assert [r['status'] for r in rv_data['results']] == ['created', 'created', 'error', 'error']
+        rv = self.app.get('/api/run/' + self.last_run_id + '/auto/')
+        assert sorted(r['case'] for r in json.loads(rv.data)) == ["a.bulk.0.test", "a.bulk.1.test"]
+
+        # Failed chunk can be submitted again
+        rv = self.app.post(url, data=json.dumps(results[2:]), content_type='application/json')
+        assert json.loads(rv.data)['created'] == 2
+        rv = self.app.get('/api/run/' + self.last_run_id + '/')
+        assert json.loads(rv.data)['auto_passed'] == 4
+
+
+class CaseNameTest(FixtureTest):
+    def test_case_ids(self):
+        for _ in sm.range(2):
+            self.submit_test_run()
+            self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+        with app.app.app_context():
+            names = app.model.CaseName.query.filter_by(name="a.pass.0.test").count()
+            case_ids = set(app.db.session.query(app.model.AutoResult.case_id))
+        assert names == 1
+        assert len(case_ids) == 1
+
+        url = '/api/run/' + self.last_run_id + '/auto/'
+        assert [r['case'] for r in json.loads(self.app.get(url).data)] == ["a.pass.0.test"]
+        assert json.loads(self.app.get(url + '?fields=case,result').data) == \
+            [{'case': "a.pass.0.test", 'result': 'passed'}]
+        assert json.loads(self.app.get(url + 'a.pass.0.test/').data)['case'] == "a.pass.0.test"
+
+
+class PaginationTest(FixtureTest):
+    def test_run_pagination(self):
+        for idx in sm.range(5):
+            self.submit_test_run(name="Dev-Test-Run-%s" % idx)
+
+        seen, cursor = [], None
+        while True:
+            url = '/api/run/?limit=2&fields=id,name'
+            if cursor:
+                url += '&cursor=' + cursor
+            rv = self.app.get(url)
+            page = json.loads(rv.data)
+            assert len(page) <= 2
+            assert all(set(run.keys()) == set(['id', 'name']) for run in page)
+            seen.extend(run['id'] for run in page)
+            cursor = rv.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        assert len(seen) == len(set(seen)) == 5
+
+        rv = self.app.get('/api/run/?format=ndjson')
+        lines = [line for line in rv.data.decode('utf-8').split("\n") if line]
+        assert [json.loads(line)['id'] for line in lines] == seen
+
+
+class BlobTest(FixtureTest):
+    def test_deduplicated_output(self):
+        for _ in sm.range(2):
+            self.submit_test_run()
+            self.submit_case_result("a.pass.0.test", "Shared output " * 100, "passed")
+            self.submit_case_result("a.fail.0.test", "Shared output " * 100, "failed")
+
+        rv = self.app.get('/api/run/' + self.last_run_id + '/auto/a.fail.0.test/')
+        rv_data = json.loads(rv.data)
+        assert rv_data['output'] == "Shared output " * 100
+        assert rv_data['failure'] == "Shared output " * 100
+        assert 'output_digest' not in rv_data
+
+        with app.app.app_context():
+            assert app.model.Blob.query.count() == 1
+
+
+class RetentionTest(FixtureTest):
+    def test_delete_and_purge(self):
+        old = datetime.datetime.now() - datetime.timedelta(days=10)
+        run_ids = []
+        for date in [old, old + datetime.timedelta(hours=1), datetime.datetime.now()]:
+            self.submit_test_run(date=date.isoformat())
+            self.submit_case_result("a.pass.0.test", "Output of %s" % date, "passed")
+            run_ids.append(int(self.last_run_id))
+
+        rv = self.app.delete('/api/run/%s/' % run_ids[0])
+        assert json.loads(rv.data)['id'] == run_ids[0]
+        assert self.app.get('/api/run/%s/' % run_ids[0]).status_code == 400
+
+        app.purge_runs(5)
+        rv = self.app.get('/api/run/')
+        assert [run['id'] for run in json.loads(rv.data)] == run_ids[2:]
+        with app.app.app_context():
+            assert app.model.AutoResult.query.count() == 1
+            assert app.model.CaseHistory.query.count() == 1
+            # Blobs of purged runs are kept for the grace period
+            assert app.model.Blob.query.count() == 3
+
+        from app.tasks import retention
+        grace, retention.BLOB_GRACE_PERIOD = retention.BLOB_GRACE_PERIOD, 0
+        try:
+            with app.app.app_context():
+                assert retention._delete_blobs() == 2
+                assert app.model.Blob.query.count() == 1
+        finally:
+            retention.BLOB_GRACE_PERIOD = grace
+
+    def test_archive_and_restore(self):
+        from app.model import archive
+        self.submit_test_run(date=(datetime.datetime.now() - datetime.timedelta(days=10)).isoformat())
+        self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+        self.submit_case_result("a.fail.0.test", "Failed output", "failed")
+        url = '/api/run/' + self.last_run_id + '/auto/'
+        results = sorted(json.loads(self.app.get(url).data), key=lambda result: result['case'])
+
+        from app.tasks import retention
+        grace, retention.BLOB_GRACE_PERIOD = retention.BLOB_GRACE_PERIOD, 0
+        archive_dir, archive.ARCHIVE_DIR = archive.ARCHIVE_DIR, tempfile.mkdtemp()
+        try:
+            app.archive_runs(5)
+            with app.app.app_context():
+                run = app.model.Run.query.get(int(self.last_run_id))
+                assert run.archive_path
+                assert run.auto_passed == run.auto_failed == 1
+                assert app.model.AutoResult.query.count() == 0
+                assert app.model.Blob.query.count() == 0
+
+            # Its details don't need results
+            etag = self.app.get('/api/run/' + self.last_run_id + '/').headers['ETag']
+            rv = self.app.get('/api/run/' + self.last_run_id + '/', headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            with app.app.app_context():
+                assert app.model.Run.query.get(int(self.last_run_id)).archive_path
+
+            # Opening its results restores it
+            restored = sorted(json.loads(self.app.get(url).data), key=lambda result: result['case'])
+            assert restored == results
+            with app.app.app_context():
+                assert app.model.Run.query.get(int(self.last_run_id)).archive_path is None
+                assert app.model.CaseHistory.query.count() == 2
+            assert not os.listdir(os.path.join(archive.ARCHIVE_DIR, '0'))
+        finally:
+            shutil.rmtree(archive.ARCHIVE_DIR)
+            archive.ARCHIVE_DIR = archive_dir
+            retention.BLOB_GRACE_PERIOD = grace
+
+
+class ResponseCacheTest(FixtureTest):
+    def test_etag_invalidated_on_write(self):
+        self.submit_test_run()
+        self.submit_case_result("a.pass.0.test", "Output", "passed")
+
+        url = '/api/run/' + self.last_run_id + '/auto/'
+        rv = self.app.get(url)
+        etag = rv.headers['ETag']
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+        self.submit_case_result("a.fail.0.test", "Output", "failed")
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
+        assert len(json.loads(rv.data)) == 2
+
+    def test_invalidated_by_other_process(self):
+        self.submit_test_run()
+        url = '/api/run/' + self.last_run_id + '/'
+        etag = self.app.get(url).headers['ETag']
+        # As a celery worker would
+        subprocess.check_call([sys.executable, '-c', "\n".join([
+            "import app",
+            "from app.utils import response_cache",
+            "app.app.config['SQLALCHEMY_DATABASE_URI'] = %r" % app.app.config['SQLALCHEMY_DATABASE_URI'],
+            "with app.app.app_context():",
+            "    app.model.Run.query.get(%s).submit_status = 'submitted'" % self.last_run_id,
+            "    app.db.session.commit()",
+            "    response_cache.invalidate_runs([%s])" % self.last_run_id])],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        rv = self.app.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
+        assert json.loads(rv.data)['submit_status'] == 'submitted'
+
+
+class SearchTest(FixtureTest):
+    def test_datatables_search(self):
+        self.submit_test_run(name="libvirt-rhel7-x86")
+        self.submit_case_result("virsh.start.normal", "Output", "passed")
+        self.submit_test_run(name="qemu_50%")
+        self.submit_case_result("virsh.destroy", "Output", "passed")
+
+        def search(query):
+            rv = self.app.get('/dt/run/?draw=1&start=0&length=10&' + query)
+            return sorted(run['name'] for run in json.loads(rv.data)['data'])
+
+        assert search('search[value]=rhel7') == ["libvirt-rhel7-x86"]
+        assert search('search[value]=50%25') == ["qemu_50%"]
+        assert search('search[value]=&containsAutocases=start') == ["libvirt-rhel7-x86"]
+        assert search('search[value]=&containsAutocases=virsh') == ["libvirt-rhel7-x86", "qemu_50%"]
+        assert search('search[value]=&containsManualcases=virsh') == []
+
+    def test_cached_counts(self):
+        def counts(query):
+            rv = self.app.get('/dt/run/?draw=1&start=0&length=1&' + query)
+            rv_data = json.loads(rv.data)
+            return rv_data['recordsTotal'], rv_data['recordsFiltered']
+
+        self.submit_test_run(name="Dev-Test-Run-0")
+        assert counts('search[value]=') == (1, 1)
+        assert counts('search[value]=Run-1') == (1, 0)
+
+        # Adding a run refreshes both counts
+        self.submit_test_run(name="Dev-Test-Run-1")
+        assert counts('search[value]=') == (2, 2)
+        assert counts('search[value]=Run-1') == (2, 1)
+        assert counts('search[value]=&submitStatus=submitted') == (2, 0)
+
+
+class MetricsTest(FixtureTest):
+    def test_metrics(self):
+        self.submit_test_run()
+        self.app.get('/api/run/')
+
+        rv = self.app.get('/metrics')
+        assert rv.status_code == 200
+        metrics = rv.data.decode('utf-8')
+        assert 'dashboard_request_duration_seconds_count{endpoint="restful_api.test_run_list",method="GET"}' in metrics
+        assert 'dashboard_request_queries_bucket{endpoint="restful_api.test_run_list",le="+Inf"}' in metrics
+        assert 'dashboard_sql_duration_seconds_count' in metrics
+
+    def test_worker_metrics(self):
+        from app.utils import metrics as Metrics
+        metrics_dir, Metrics.METRICS_DIR = Metrics.METRICS_DIR, tempfile.mkdtemp()
+        try:
+            # Celery workers calling Polarion, the second one exits
+            for done in ["metrics._write_worker_metrics()", "metrics._shutdown_worker()"]:
+                subprocess.check_call([sys.executable, '-c', "\n".join([
+                    "from app.utils import metrics",
+                    "metrics.METRICS_DIR = %r" % Metrics.METRICS_DIR,
+                    "with metrics.timed('polarion'):",
+                    "    pass",
+                    done])],
+                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            assert len(glob.glob(os.path.join(Metrics.METRICS_DIR, '*.json'))) == 2
+            metrics = self.app.get('/metrics').data.decode('utf-8')
+            assert 'dashboard_outbound_duration_seconds_count{service="polarion"} 2\n' in metrics
+            assert 'dashboard_requests_total' in metrics
+        finally:
+            shutil.rmtree(Metrics.METRICS_DIR)
+            Metrics.METRICS_DIR = metrics_dir
+
+
+class DiffTest(FixtureTest):
+    def test_run_diff(self):
+        run_ids = []
+        for results in [{"a.fix.0.test": "failed", "a.regress.0.test": "passed",
+                         "a.same.0.test": "passed", "a.gone.0.test": "passed"},
+                        {"a.fix.0.test": "passed", "a.regress.0.test": "failed",
+                         "a.same.0.test": "passed", "a.new.0.test": "passed"}]:
+            self.submit_test_run()
+            for case, result in results.items():
+                self.submit_case_result(case, "Output", result)
+            run_ids.append(self.last_run_id)
+
+        rv = self.app.get('/api/diff/%s/%s/' % tuple(run_ids))
+        rv_data = json.loads(rv.data)
+        changes = dict((case['case'], case['changes'][0]['type']) for case in rv_data['cases'])
+        assert changes == {"a.fix.0.test": "fixed", "a.regress.0.test": "newly_failing",
+                           "a.gone.0.test": "missing", "a.new.0.test": "new"}
+        assert rv_data['counts']['fixed'] == 1
+
+        rv = self.app.get('/api/diff/?runs=%s' % ','.join(run_ids + run_ids[:1]))
+        assert len(json.loads(rv.data)['cases']) == 4
+        rv = self.app.get('/api/diff/?runs=%s' % run_ids[0])
+        assert rv.status_code == 400
+
+
+class CaseLinkTest(unittest.TestCase):
+    def test_prefetch_invalidate(self):
+        from app.utils import caselink
+        links = {'a.link.0.test': ['WI-1']}
+
+        def fetch_autocase(case_id):
+            return {'id': case_id, 'workitems': links[case_id], 'failures': []}
+
+        def fetch_workitem(workitem_id):
+            return {'id': workitem_id, 'autocases': [
+                case_id for case_id, workitems in links.items() if workitem_id in workitems]}
+
+        fetches = caselink._fetch_autocase, caselink._fetch_workitem
+        caselink._fetch_autocase, caselink._fetch_workitem = fetch_autocase, fetch_workitem
+        try:
+            caselink.invalidate_all()
+            caselink.prefetch(['a.link.0.test'])
+            assert caselink.get_workitem('WI-1')['autocases'] == ['a.link.0.test']
+
+            # Case is moved to another workitem in caselink
+            links['a.link.0.test'] = ['WI-2']
+            caselink.prefetch(['a.link.0.test'], invalidate=True)
+            assert caselink.get_autocase('a.link.0.test')['workitems'] == ['WI-2']
+            assert caselink.get_workitem('WI-1')['autocases'] == []
+            assert caselink.get_workitem('WI-2')['autocases'] == ['a.link.0.test']
+        finally:
+            caselink._fetch_autocase, caselink._fetch_workitem = fetches
+            caselink.invalidate_all()
+
+
+class PolarionXUnitTest(unittest.TestCase):
+    def test_streamed_xunit(self):
+        from xml.dom import minidom
+        from app.utils import polarion
+
+        record = polarion.TestRunRecord('project', 'run')
+        record.stream_testcases(
+            iter([('a.fail.0.test', 'failed', 1.0, u'Bad \x00output\x1b <x>'),
+                  ('a.pass.0.test', 'passed', 2.0, None)]),
+            {'tests': 2, 'failures': 1, 'errors': 0, 'skipped': 0, 'time': 3.0})
+        chunks = list(record.tss.iter_xml())
+        assert len(chunks) > 2
+
+        document = minidom.parseString(b''.join(chunks))
+        testsuite = document.getElementsByTagName('testsuite')[0]
+        assert testsuite.getAttribute('failures') == '1'
+        failure = document.getElementsByTagName('failure')[0]
+        assert failure.getAttribute('message') == 'Bad output <x>'
+
+
+class FakeConnection(object):
+    """Bus connection notifying listeners on DISCONNECT, as stomp does on its receipt. """
+    created = []
+
+    def __init__(self, hosts):
+        self.listeners = {}
+        self.connected = False
+        FakeConnection.created.append(self)
+
+    def set_listener(self, name, listener):
+        self.listeners[name] = listener
+
+    def remove_listener(self, name):
+        del self.listeners[name]
+
+    def start(self):
+        pass
+
+    def connect(self, **kwargs):
+        self.connected = True
+
+    def subscribe(self, **kwargs):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+        for listener in list(self.listeners.values()):
+            listener.on_disconnected()
+
+
+class MessageRouterTest(unittest.TestCase):
+    def test_reconnect_once(self):
+        from app.utils import msg
+        connection, msg.stomp.Connection = msg.stomp.Connection, FakeConnection
+        FakeConnection.created = []
+        try:
+            router = msg.MessageRouter()
+            router.connect()
+            # An error frame leaves the connection up
+            router.on_error({}, '')
+            assert router._disconnected.is_set()
+            router._disconnected.clear()
+            router.reconnect()
+            assert not router._disconnected.is_set()
+            assert len(FakeConnection.created) == 2
+            assert not FakeConnection.created[0].connected
+            assert router.conn is FakeConnection.created[1] and router.conn.connected
+
+            # Losing the new connection is still noticed
+            router.conn.disconnect()
+            assert router._disconnected.is_set()
+        finally:
+            msg.stomp.Connection = connection
+
+
+class QueryCountTest(FixtureTest):
+    def count_queries(self, url):
+        queries = []
+
+        def _count(*_):
+            queries.append(1)
+
+        with app.app.app_context():
+            engine = app.db.engine
+        event.listen(engine, 'before_cursor_execute', _count)
+        try:
+            rv = self.app.get(url)
+            assert rv.status_code == 200
+        finally:
+            event.remove(engine, 'before_cursor_execute', _count)
+        return len(queries)
+
+    def test_run_list_queries(self):
+        counts, submitted = [], 0
+        for run_number in [2, 8]:
+            while submitted < run_number:
+                self.submit_test_run()
+                submitted += 1
+            for url in ['/api/run/', '/dt/run/', '/statistics/run/last/']:
+                # First request may generate statistics, saved once closed
+                self.app.get(url, buffered=True)
+            counts.append([self.count_queries(url) for url in
+                           ['/api/run/', '/dt/run/', '/statistics/run/last/']])
+        assert counts[0] == counts[1], counts
+
+
+class QueryPlanTest(FixtureTest):
+    # Tables growing with submitted results, never scanned without an index
+    LARGE_TABLES = ['run', 'auto_result', 'manual_result', 'linkage_results', 'case_history',
+                    'case_name']
+
+    def test_index_scans(self):
+        run_ids = []
+        for _ in sm.range(2):
+            self.submit_test_run()
+            self.submit_case_result("a.pass.0.test", "Output", "passed")
+            self.submit_case_result("a.fail.0.test", "Output", "failed")
+            run_ids.append(self.last_run_id)
+
+        statements = []
+
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        with app.app.app_context():
+            engine = app.db.engine
+        event.listen(engine, 'before_cursor_execute', _record)
+        try:
+            for url in ['/api/run/?limit=10', '/api/run/%s/' % run_ids[0],
+                        '/api/run/%s/auto/' % run_ids[0], '/api/run/%s/manual/' % run_ids[0],
+                        '/dt/run/?order[0][column]=1&order[0][dir]=desc',
+                        '/dt/run/?submitStatus=notsubmitted&containsAutocases=fail',
+                        '/statistics/auto/a.fail.0.test?limit=1',
+                        '/api/diff/%s/%s/' % tuple(run_ids)]:
+                assert self.app.get(url).status_code == 200, url
+        finally:
+            event.remove(engine, 'before_cursor_execute', _record)
+
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in statements:
+                for row in cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall():
+                    scan = re.match(r'SCAN (?:TABLE )?(\w+)$', row[-1])
+                    assert not (scan and scan.group(1) in self.LARGE_TABLES), (row[-1], statement)
+        finally:
+            connection.close()
+
+
+class StatisticsTest(FixtureTest):
+    def get_statistics(self):
+        rv = self.app.get('/api/run/' + self.last_run_id + '/')
+        rv_data = json.loads(rv.data)
+        return dict((key, rv_data[key]) for key in ['auto_passed', 'auto_failed', 'auto_skipped'])
+
+    def test_incremental_statistics(self):
+        self.submit_test_run()
+        assert self.get_statistics() == {'auto_passed': 0, 'auto_failed': 0, 'auto_skipped': 0}
+
+        self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+        self.submit_case_result("a.pass.1.test", "Passed output", "passed")
+        self.submit_case_result("a.fail.0.test", "Failed output", "failed")
+        assert self.get_statistics() == {'auto_passed': 2, 'auto_failed': 1, 'auto_skipped': 0}
+
+        self.app.delete('/api/run/' + self.last_run_id + '/auto/a.pass.1.test/')
+        assert self.get_statistics() == {'auto_passed': 1, 'auto_failed': 1, 'auto_skipped': 0}
+
+        with app.app.app_context():
+            app.db.session.execute(app.model.Run.__table__.update().values(auto_passed=10))
+            app.db.session.commit()
+        app.rebuild_statistics()
+        assert self.get_statistics() == {'auto_passed': 1, 'auto_failed': 1, 'auto_skipped': 0}
+
+    def test_streamed_statistics_saved(self):
+        self.submit_test_run()
+        self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+        with app.app.app_context():
+            app.db.session.execute(app.model.Run.__table__.update().values(auto_passed=None))
+            app.db.session.commit()
+
+        rv = self.app.get('/api/run/?format=ndjson')
+        assert json.loads(rv.data.splitlines()[0])['auto_passed'] == 1
+        with app.app.app_context():
+            assert app.model.Run.query.get(int(self.last_run_id)).auto_passed == 1
+
+    def test_autocase_statistics(self):
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        for date in [yesterday, datetime.datetime.now()]:
+            self.submit_test_run(date=date.isoformat())
+            self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+            self.submit_case_result("a.fail.0.test", "Failed output", "failed")
+
+        url = '/statistics/auto/?after=%s' % (yesterday - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        live = json.loads(self.app.get(url).data)
+        assert live['a.pass.0.test']['passed'] == 2
+        assert live['a.fail.0.test'] == {'failed': 2, 'passed': 0, 'skipped': 0,
+                                         'invalid': 0, 'total': 2}
+
+        app.rollup_statistics()
+        app.app.config['STATISTICS_ROLLUP'] = True
+        try:
+            assert json.loads(self.app.get(url).data) == live
+        finally:
+            app.app.config['STATISTICS_ROLLUP'] = False
+
+    def test_rollup_deltas(self):
+        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time()) - \
+            datetime.timedelta(days=1)
+        self.submit_test_run(date=(midnight - datetime.timedelta(days=10)).isoformat())
+        self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+        for date in [midnight, midnight + datetime.timedelta(hours=1)]:
+            self.submit_test_run(date=date.isoformat())
+            self.submit_case_result("a.pass.0.test", "Passed output", "passed")
+            self.submit_case_result("a.fail.0.test", "Failed output", "failed")
+        app.rollup_statistics()
+
+        url = '/statistics/auto/?after=%s' % (midnight - datetime.timedelta(days=11)).strftime('%Y-%m-%d')
+
+        def get(rollup):
+            app.app.config['STATISTICS_ROLLUP'] = rollup
+            try:
+                ret = json.loads(self.app.get(url).data)
+            finally:
+                app.app.config['STATISTICS_ROLLUP'] = False
+            return ret['a.pass.0.test']['passed'], ret['a.fail.0.test']['failed']
+
+        assert get(False) == get(True) == (3, 2)
+        self.app.put('/api/run/' + self.last_run_id + '/auto/a.fail.0.test/',
+                     data=json.dumps({'result': 'passed'}), content_type='application/json')
+        self.app.delete('/api/run/' + self.last_run_id + '/auto/a.pass.0.test/')
+        assert get(False) == get(True) == (2, 1)
+
+        app.purge_runs(5)
+        assert get(False) == (1, 1)
+        assert get(True) == (2, 1)
+
+    def test_case_history(self):
+        run_ids = []
+        for result in ['passed', 'failed', 'passed']:
+            self.submit_test_run()
+            self.submit_case_result("a.flaky.0.test", "Output", result)
+            run_ids.append(int(self.last_run_id))
+
+        rv = self.app.get('/statistics/auto/a.flaky.0.test?limit=2&expand=run')
+        rv_data = json.loads(rv.data)
+        assert rv_data['summary']['total'] == 3
+        assert rv_data['summary']['failed'] == 1
+        assert [entry['run_id'] for entry in rv_data['history']] == run_ids[:0:-1]
+        assert all(entry['run']['id'] == entry['run_id'] for entry in rv_data['history'])
+
+        rv = self.app.get('/statistics/auto/a.flaky.0.test?limit=2&cursor=' +
+                          rv.headers['X-Next-Cursor'])
+        rv_data = json.loads(rv.data)
+        assert [entry['run_id'] for entry in rv_data['history']] == run_ids[:1]
+        assert 'run' not in rv_data['history'][0]
+        assert 'X-Next-Cursor' not in rv.headers
+
+    def test_case_history_follows_run_date(self):
+        self.submit_test_run()
+        self.submit_case_result("a.pass.0.test", "Output", "passed")
+        run = json.loads(self.app.get('/api/run/' + self.last_run_id + '/').data)
+        run['date'] = (datetime.datetime.now() - datetime.timedelta(days=3)).replace(microsecond=0)\
+            .isoformat()
+        rv = self.app.put('/api/run/' + self.last_run_id + '/',
+                          data=json.dumps(run), content_type='application/json')
+        assert rv.status_code == 201
+
+        rv_data = json.loads(self.app.get('/statistics/auto/a.pass.0.test').data)
+        assert [entry['date'] for entry in rv_data['history']] == [run['date']]
+
+
 def run():
     parser = argparse.ArgumentParser(description='Unit tests and fixtures for libvirt-dashboard.')
     parser.add_argument('--fixture', dest='fixture', action='store_true',
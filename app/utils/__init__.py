@@ -1 +1 @@
-__all__ = ['caselink', 'polarion', ]
+__all__ = ['blob', 'cache', 'caselink', 'count_cache', 'matcher', 'metrics', 'polarion', 'response_cache', ]
@@ -0,0 +1,61 @@
+"""
+Content addressed, compressed text payloads
+
+Texts are keyed by the SHA-256 digest of their UTF-8 encoding. Payloads
+are compressed with zlib, or zstd if BLOB_CODEC is "zstd" (needs the
+zstandard module), and kept raw when compression doesn't help.
+"""
+import zlib
+import hashlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from config import ActiveConfig
+
+BLOB_CODEC = ActiveConfig.BLOB_CODEC
+
+
+def _to_bytes(text):
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return text
+
+
+def _compress(data):
+    if BLOB_CODEC == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("BLOB_CODEC zstd requires zstandard module")
+        return 'zstd', zstandard.ZstdCompressor().compress(data)
+    return 'zlib', zlib.compress(data)
+
+
+def encode(text):
+    """
+    Return (digest, codec, size, payload) of a text.
+    """
+    data = _to_bytes(text)
+    codec, payload = _compress(data)
+    if len(payload) >= len(data):
+        codec, payload = 'raw', data
+    return hashlib.sha256(data).hexdigest(), codec, len(data), payload
+
+
+def decode(codec, payload):
+    """
+    Return the text of a payload.
+    """
+    payload = bytes(payload)
+    if codec == 'zlib':
+        data = zlib.decompress(payload)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Blob compressed with zstd, zstandard module required")
+        data = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == 'raw':
+        data = payload
+    else:
+        raise ValueError("Unknown blob codec %s" % codec)
+    return data.decode('utf-8')
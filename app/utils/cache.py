@@ -0,0 +1,127 @@
+"""
+Key-value caches with TTL
+
+LRUCache lives in process memory, RedisCache is shared between
+processes (web and celery workers) if redis is installed,
+TieredCache chains them so the LRU is checked first.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache, entries expire after ttl seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expire, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expire is not None and expire < time.time():
+                return default
+            self._data[key] = (expire, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expire = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expire, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    """
+    Cache stored in redis, values must be JSON serializable.
+    """
+    def __init__(self, url, prefix='', ttl=None):
+        if redis is None:
+            raise RuntimeError("redis is required for a shared cache")
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return default
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class TieredCache(object):
+    """
+    Look up the local cache first, then the shared one if there is one.
+    """
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+
+def make_cache(prefix, maxsize, ttl=None, url=None):
+    """
+    Build a LRU cache, backed by redis if url is given.
+    """
+    shared = RedisCache(url, prefix=prefix, ttl=ttl) if url else None
+    return TieredCache(LRUCache(maxsize, ttl), shared)
@@ -0,0 +1,170 @@
+"""
+Cached access to caselink
+
+Autocase and workitem mappings are snapshotted into plain dicts, and
+kept in a LRU with TTL, shared through redis if CASELINK_CACHE_URL is set.
+Errors from caselink are never cached.
+"""
+from __future__ import absolute_import
+
+from multiprocessing.dummy import Pool
+
+import caselink as CaseLink
+from requests import HTTPError, ConnectionError
+
+from config import ActiveConfig
+from .cache import make_cache
+from .metrics import timed
+
+CASELINK_CACHE_SIZE = ActiveConfig.CASELINK_CACHE_SIZE
+CASELINK_CACHE_TTL = ActiveConfig.CASELINK_CACHE_TTL
+CASELINK_CACHE_URL = ActiveConfig.CASELINK_CACHE_URL
+CASELINK_PREFETCH_WORKERS = ActiveConfig.CASELINK_PREFETCH_WORKERS
+
+_cache = make_cache('caselink:', CASELINK_CACHE_SIZE,
+                    ttl=CASELINK_CACHE_TTL, url=CASELINK_CACHE_URL)
+
+
+def _autocase_key(case_id):
+    return 'auto:%s' % case_id
+
+
+def _workitem_key(workitem_id):
+    return 'workitem:%s' % workitem_id
+
+
+def _fetch_autocase(case_id):
+    with timed('caselink'):
+        autocase = CaseLink.AutoCase(case_id).refresh()
+        return {
+            'id': case_id,
+            'workitems': [workitem.id for workitem in autocase.workitems],
+            'failures': [{
+                'regex': failure.failure_regex,
+                'blacklist': [{
+                    'workitems': bl.json['workitems'],
+                    'bugs': bl.json['bugs'],
+                    'status': bl.status,
+                    'description': bl.description,
+                } for bl in failure.blacklist_entries],
+            } for failure in autocase.autocase_failures],
+        }
+
+
+def _fetch_workitem(workitem_id):
+    with timed('caselink'):
+        workitem = CaseLink.WorkItem(workitem_id)
+        return {
+            'id': workitem_id,
+            'autocases': [autocase.id for autocase in workitem.autocases],
+        }
+
+
+def get_autocase(case_id):
+    """
+    Get the mapping of an autocase: linked workitems and failure patterns.
+    Raise HTTPError or ConnectionError if caselink can't be reached.
+    """
+    key = _autocase_key(case_id)
+    autocase = _cache.get(key)
+    if autocase is None:
+        autocase = _fetch_autocase(case_id)
+        _cache.set(key, autocase)
+    return autocase
+
+
+def get_workitem(workitem_id):
+    """
+    Get the mapping of a workitem: linked autocases.
+    """
+    key = _workitem_key(workitem_id)
+    workitem = _cache.get(key)
+    if workitem is None:
+        workitem = _fetch_workitem(workitem_id)
+        _cache.set(key, workitem)
+    return workitem
+
+
+def _prefetch(ids, key_func, fetch_func):
+    missing = [_id for _id in set(ids) if _cache.get(key_func(_id)) is None]
+    if not missing:
+        return 0
+
+    def _fetch(_id):
+        try:
+            _cache.set(key_func(_id), fetch_func(_id))
+            return True
+        except (HTTPError, ConnectionError):
+            return False
+
+    pool = Pool(min(CASELINK_PREFETCH_WORKERS, len(missing)))
+    try:
+        return sum(pool.map(_fetch, missing))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def prefetch_autocases(case_ids):
+    """
+    Fetch all not cached autocases in parallel, each distinct case only once,
+    return the number of autocases fetched.
+    """
+    return _prefetch(case_ids, _autocase_key, _fetch_autocase)
+
+
+def prefetch_workitems(workitem_ids):
+    """
+    Fetch all not cached workitems in parallel, each distinct workitem only once,
+    return the number of workitems fetched.
+    """
+    return _prefetch(workitem_ids, _workitem_key, _fetch_workitem)
+
+
+def _linked_workitems(case_ids):
+    """
+    Workitems linked to cached autocases or to their failure patterns.
+    """
+    workitem_ids = set()
+    for case_id in set(case_ids):
+        autocase = _cache.get(_autocase_key(case_id))
+        if autocase is None:
+            continue
+        workitem_ids.update(autocase['workitems'])
+        for failure in autocase['failures']:
+            for bl in failure['blacklist']:
+                workitem_ids.update(bl['workitems'] or [])
+    return workitem_ids
+
+
+def prefetch(case_ids, invalidate=False):
+    """
+    Prefetch autocases, and all workitems linked to them or to their
+    failure patterns, so generating linkage for these cases hit no network.
+
+    With invalidate, cached autocases are fetched again, and so are
+    workitems they were or are now linked to, as their autocase lists
+    change with the links.
+    """
+    if invalidate:
+        invalidate_workitems(_linked_workitems(case_ids))
+        invalidate_autocases(case_ids)
+    fetched = prefetch_autocases(case_ids)
+    workitem_ids = _linked_workitems(case_ids)
+    if invalidate:
+        invalidate_workitems(workitem_ids)
+    return fetched + prefetch_workitems(workitem_ids)
+
+
+def invalidate_autocases(case_ids):
+    for case_id in case_ids:
+        _cache.delete(_autocase_key(case_id))
+
+
+def invalidate_workitems(workitem_ids):
+    for workitem_id in workitem_ids:
+        _cache.delete(_workitem_key(workitem_id))
+
+
+def invalidate_all():
+    _cache.clear()
@@ -0,0 +1,59 @@
+"""
+Cached counts of test runs
+
+The total count is cached until a run is added or removed (RUNS_SCOPE
+of response cache is invalidated), counts of filtered runs are cached
+per filter for COUNT_CACHE_TTL seconds. With COUNT_ESTIMATE, counts
+over COUNT_ESTIMATE_THRESHOLD are taken from the PostgreSQL planner.
+"""
+import json
+import hashlib
+
+from config import ActiveConfig
+from .cache import make_cache
+from .response_cache import generation, RUNS_SCOPE
+
+COUNT_CACHE_SIZE = ActiveConfig.COUNT_CACHE_SIZE
+COUNT_CACHE_TTL = ActiveConfig.COUNT_CACHE_TTL
+COUNT_ESTIMATE = ActiveConfig.COUNT_ESTIMATE
+COUNT_ESTIMATE_THRESHOLD = ActiveConfig.COUNT_ESTIMATE_THRESHOLD
+RESPONSE_CACHE_TTL = ActiveConfig.RESPONSE_CACHE_TTL
+RESPONSE_CACHE_URL = ActiveConfig.RESPONSE_CACHE_URL
+
+_counts = make_cache('count:', COUNT_CACHE_SIZE, COUNT_CACHE_TTL, RESPONSE_CACHE_URL)
+
+
+def estimate(query):
+    """
+    Row count of query estimated by the planner, None if not supported.
+    """
+    connection = query.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return None
+    compiled = query.statement.compile(dialect=connection.dialect)
+    plan = connection.execute("EXPLAIN (FORMAT JSON) %s" % compiled, compiled.params).scalar()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _count(query):
+    if COUNT_ESTIMATE:
+        rows = estimate(query)
+        if rows is not None and rows >= COUNT_ESTIMATE_THRESHOLD:
+            return rows
+    return query.count()
+
+
+def count(query, filters=None):
+    """
+    Count rows of a query on runs, filters identifies the query, and
+    should be JSON serializable. An unfiltered query counts all runs.
+    """
+    key = hashlib.sha1(("%s %s" % (
+        generation(RUNS_SCOPE), json.dumps(filters, sort_keys=True))).encode('utf-8')).hexdigest()
+    value = _counts.get(key)
+    if value is None:
+        value = _count(query)
+        _counts.set(key, value, None if filters else RESPONSE_CACHE_TTL)
+    return value
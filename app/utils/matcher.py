@@ -0,0 +1,94 @@
+"""
+Failure pattern matching for auto case failures
+
+Patterns are compiled once per distinct pattern set, and combined into
+one alternation when possible, so a failure matching none of them is
+rejected with a single scan. Only the first FAILURE_MATCH_WINDOW
+characters of a failure are scanned if it's set.
+"""
+import re
+import threading
+
+from config import ActiveConfig
+from .cache import LRUCache
+
+FAILURE_MATCH_WINDOW = ActiveConfig.FAILURE_MATCH_WINDOW
+FAILURE_MATCHER_CACHE_SIZE = ActiveConfig.FAILURE_MATCHER_CACHE_SIZE
+
+# Backreferences, named groups and inline flags change meaning
+# or are illegal once patterns are joined together
+UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)')
+
+_matchers = LRUCache(FAILURE_MATCHER_CACHE_SIZE)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _combine(patterns):
+    if not patterns or any(UNCOMBINABLE_RE.search(p) for p in patterns):
+        return None
+    try:
+        return re.compile('|'.join('(?:%s)' % p for p in patterns))
+    except (re.error, AssertionError, OverflowError):
+        # Python 2 can't compile more than 100 groups
+        return None
+
+
+class FailureMatcher(object):
+    """
+    Match a failure text against a list of patterns, same as
+    calling re.match with each of them.
+    """
+    def __init__(self, patterns, window=None):
+        self.patterns = list(patterns)
+        self.window = window
+        self.compiled = [re.compile(p) for p in self.patterns]
+        self.combined = _combine(self.patterns)
+
+    def match(self, text):
+        """
+        Return indexes of patterns matching text.
+        """
+        if self.window:
+            text = text[:self.window]
+        if self.combined is not None and self.combined.match(text) is None:
+            hits = []
+        else:
+            hits = [idx for idx, regex in enumerate(self.compiled)
+                    if regex.match(text) is not None]
+        _record(self.patterns, hits)
+        return hits
+
+
+def _record(patterns, hits):
+    with _stats_lock:
+        for pattern in patterns:
+            stat = _stats.setdefault(pattern, {'tries': 0, 'hits': 0})
+            stat['tries'] += 1
+        for idx in hits:
+            _stats[patterns[idx]]['hits'] += 1
+
+
+def get_matcher(patterns):
+    """
+    Get a compiled matcher for patterns, reused while the patterns stay the same.
+    """
+    key = tuple(patterns)
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = FailureMatcher(key, window=FAILURE_MATCH_WINDOW)
+        _matchers.set(key, matcher)
+    return matcher
+
+
+def pattern_stats():
+    """
+    Tries and hits of each pattern since started or last reset.
+    """
+    with _stats_lock:
+        return dict((pattern, dict(stat)) for pattern, stat in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
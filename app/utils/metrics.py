@@ -0,0 +1,339 @@
+"""
+Request, SQL and outbound call metrics
+
+Latency of requests by endpoint, SQL statements run by each request and
+time spent on caselink / Polarion calls are kept in histograms, and
+exposed in Prometheus text format on /metrics. Metrics are per process,
+celery workers write theirs to files under METRICS_DIR after each task,
+merged into /metrics of the web app. Files of exited workers are folded
+into one file of retired workers, so counters never go backwards.
+
+Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged together
+with their slowest SQL statements.
+"""
+import os
+import glob
+import fcntl
+import json
+import bisect
+import logging
+import threading
+from timeit import default_timer
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import ActiveConfig
+
+SLOW_REQUEST_THRESHOLD = ActiveConfig.SLOW_REQUEST_THRESHOLD
+SLOW_REQUEST_TOP_QUERIES = ActiveConfig.SLOW_REQUEST_TOP_QUERIES
+METRICS_DIR = ActiveConfig.METRICS_DIR
+
+LOGGER = logging.getLogger('lib-dash.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+REQUEST_DURATION = 'dashboard_request_duration_seconds'
+REQUEST_QUERIES = 'dashboard_request_queries'
+REQUEST_SQL_DURATION = 'dashboard_request_sql_duration_seconds'
+REQUESTS = 'dashboard_requests_total'
+SQL_DURATION = 'dashboard_sql_duration_seconds'
+OUTBOUND_DURATION = 'dashboard_outbound_duration_seconds'
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry(object):
+    """
+    Thread safe store of histograms and counters, each with labels.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, name, kind, doc, buckets=None):
+        self._metrics[name] = (kind, doc, buckets, {})
+
+    def observe(self, name, value, **labels):
+        _, _, buckets, series = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        _, _, _, series = self._metrics[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series[key] = series.get(key, 0) + value
+
+    def clear(self):
+        with self._lock:
+            for _, _, _, series in self._metrics.values():
+                series.clear()
+
+    def copy(self):
+        """
+        Registry of the same metrics, without values.
+        """
+        registry = Registry()
+        for name, (kind, doc, buckets, _) in self._metrics.items():
+            registry.register(name, kind, doc, buckets)
+        return registry
+
+    def dump(self):
+        """
+        Values of all metrics, JSON serializable, to be added to
+        another registry with load.
+        """
+        ret = {}
+        with self._lock:
+            for name, (kind, _, _, series) in self._metrics.items():
+                ret[name] = [[key, value if kind == 'counter' else [value.counts, value.sum]]
+                             for key, value in series.items()]
+        return ret
+
+    def load(self, data):
+        """
+        Add values dumped by another registry, unknown metrics are skipped.
+        """
+        with self._lock:
+            for name, values in data.items():
+                if name not in self._metrics:
+                    continue
+                kind, _, buckets, series = self._metrics[name]
+                for key, value in values:
+                    key = tuple(tuple(pair) for pair in key)
+                    if kind == 'counter':
+                        series[key] = series.get(key, 0) + value
+                        continue
+                    histogram = series.get(key)
+                    if histogram is None:
+                        histogram = series[key] = Histogram(buckets)
+                    histogram.counts = [a + b for a, b in zip(histogram.counts, value[0])]
+                    histogram.sum += value[1]
+
+    def render(self):
+        """
+        Render all metrics in Prometheus text format.
+        """
+        def _labels(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in pairs)
+
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                kind, doc, buckets, series = self._metrics[name]
+                lines.append('# HELP %s %s' % (name, doc))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key in sorted(series):
+                    if kind == 'counter':
+                        lines.append('%s%s %s' % (name, _labels(key), series[key]))
+                        continue
+                    histogram, total = series[key], 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], histogram.counts):
+                        total += count
+                        lines.append('%s_bucket%s %s' % (name, _labels(key, [('le', bound)]), total))
+                    lines.append('%s_sum%s %s' % (name, _labels(key), histogram.sum))
+                    lines.append('%s_count%s %s' % (name, _labels(key), total))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.register(REQUEST_DURATION, 'histogram', 'Request latency by endpoint.', LATENCY_BUCKETS)
+REGISTRY.register(REQUEST_QUERIES, 'histogram', 'SQL statements run by a request.', COUNT_BUCKETS)
+REGISTRY.register(REQUEST_SQL_DURATION, 'histogram', 'Time a request spent in SQL.', LATENCY_BUCKETS)
+REGISTRY.register(REQUESTS, 'counter', 'Requests by endpoint and status.')
+REGISTRY.register(SQL_DURATION, 'histogram', 'SQL statement latency.', LATENCY_BUCKETS)
+REGISTRY.register(OUTBOUND_DURATION, 'histogram', 'Latency of calls to other services.', LATENCY_BUCKETS)
+
+
+@contextmanager
+def timed(service):
+    """
+    Record time spent in the block as a call to service.
+    """
+    start = default_timer()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(OUTBOUND_DURATION, default_timer() - start, service=service)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = default_timer()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    elapsed = default_timer() - start
+    REGISTRY.observe(SQL_DURATION, elapsed)
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_queries += 1
+        g.metrics_sql_time += elapsed
+        if SLOW_REQUEST_THRESHOLD is not None:
+            g.metrics_statements.append((elapsed, statement))
+
+
+def _before_request():
+    g.metrics_start = default_timer()
+    g.metrics_queries = 0
+    g.metrics_sql_time = 0.0
+    g.metrics_statements = []
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = default_timer() - g.metrics_start
+    endpoint = request.endpoint or 'unknown'
+    REGISTRY.observe(REQUEST_DURATION, elapsed, endpoint=endpoint, method=request.method)
+    REGISTRY.observe(REQUEST_QUERIES, g.metrics_queries, endpoint=endpoint)
+    REGISTRY.observe(REQUEST_SQL_DURATION, g.metrics_sql_time, endpoint=endpoint)
+    REGISTRY.inc(REQUESTS, endpoint=endpoint, method=request.method, status=response.status_code)
+
+    if SLOW_REQUEST_THRESHOLD is not None and elapsed >= SLOW_REQUEST_THRESHOLD:
+        top = sorted(g.metrics_statements, key=lambda query: query[0], reverse=True)
+        LOGGER.warning("Slow request %s %s: %.3fs, %s queries, %.3fs in SQL\n%s",
+                       request.method, request.full_path, elapsed,
+                       g.metrics_queries, g.metrics_sql_time,
+                       "\n".join("  %.3fs %s" % (query_time, " ".join(statement.split())[:500])
+                                 for query_time, statement in top[:SLOW_REQUEST_TOP_QUERIES]))
+    return response
+
+
+# Metrics of exited workers
+RETIRED = 'retired'
+
+
+def _worker_file(pid):
+    return os.path.join(METRICS_DIR, '%s.json' % pid)
+
+
+@contextmanager
+def _locked(operation):
+    """
+    Hold the lock of METRICS_DIR, exclusively to retire a worker file,
+    shared to read them all.
+    """
+    with open(os.path.join(METRICS_DIR, 'lock'), 'a') as fp:
+        fcntl.flock(fp, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _load_file(registry, path):
+    try:
+        with open(path) as fp:
+            registry.load(json.load(fp))
+    except (IOError, OSError, ValueError) as error:
+        LOGGER.warning("Failed to read metrics from %s: %s", path, error)
+
+
+def _write_worker_metrics(**_):
+    """
+    Write metrics of this process to METRICS_DIR, replacing the last ones.
+    """
+    path = _worker_file(os.getpid())
+    try:
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(REGISTRY.dump(), fp)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as error:
+        LOGGER.warning("Failed to write metrics to %s: %s", path, error)
+
+
+def _retire_worker_metrics(**_):
+    """
+    Add the metrics file of this pid to metrics of retired workers and
+    remove it. Done when a worker exits, and when it starts for the file of
+    a killed worker with the same pid, which would be overwritten.
+    """
+    path, retired = _worker_file(os.getpid()), _worker_file(RETIRED)
+    try:
+        with _locked(fcntl.LOCK_EX):
+            if not os.path.exists(path):
+                return
+            registry = REGISTRY.copy()
+            if os.path.exists(retired):
+                _load_file(registry, retired)
+            _load_file(registry, path)
+            with open(retired + '.tmp', 'w') as fp:
+                json.dump(registry.dump(), fp)
+            os.rename(retired + '.tmp', retired)
+            os.remove(path)
+    except (IOError, OSError) as error:
+        LOGGER.warning("Failed to retire metrics of %s: %s", path, error)
+
+
+def _shutdown_worker(**_):
+    _write_worker_metrics()
+    _retire_worker_metrics()
+
+
+def _collect():
+    """
+    Registry of metrics of this process and of workers, if any.
+    """
+    if not METRICS_DIR:
+        return REGISTRY
+    registry = REGISTRY.copy()
+    registry.load(REGISTRY.dump())
+    with _locked(fcntl.LOCK_SH):
+        for path in glob.glob(_worker_file('*')):
+            # This process may run tasks eagerly
+            if path == _worker_file(os.getpid()):
+                continue
+            _load_file(registry, path)
+    return registry
+
+
+def metrics():
+    return Response(_collect().render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """
+    Instrument the app, and all SQLAlchemy engines.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+
+
+def init_celery(celery):
+    """
+    Write metrics of worker processes to METRICS_DIR after each task,
+    retire them when the process exits.
+    """
+    from celery.signals import task_postrun, worker_process_init, worker_process_shutdown
+    if METRICS_DIR:
+        worker_process_init.connect(_retire_worker_metrics, weak=False)
+        task_postrun.connect(_write_worker_metrics, weak=False)
+        worker_process_shutdown.connect(_shutdown_worker, weak=False)
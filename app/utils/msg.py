@@ -1,4 +1,9 @@
 """
+Consumer of Polarion feedback from the message bus
+
+Messages are acked by client after their updates are committed, updates
+are coalesced per test run and applied in one transaction every
+BUS_BATCH_SIZE messages or BUS_FLUSH_INTERVAL milliseconds.
 """
 import stomp
 import datetime
@@ -6,10 +11,13 @@ import time
 import sys
 import signal
 import json
+import threading
+from collections import OrderedDict
 
 from app import app
 from app import logger as LOGGER
-from app.model import Run
+from app.model import db, Run
+from app.utils import response_cache as ResponseCache
 from config import ActiveConfig
 
 
@@ -19,25 +27,68 @@ BUS_USER = ActiveConfig.BUS_USER
 BUS_PASSWORD = ActiveConfig.BUS_PASSWORD
 BUS_TIMEOUT = ActiveConfig.BUS_TIMEOUT
 BUS_DISTINATION = ActiveConfig.BUS_DISTINATION
+BUS_BATCH_SIZE = ActiveConfig.BUS_BATCH_SIZE
+BUS_FLUSH_INTERVAL = ActiveConfig.BUS_FLUSH_INTERVAL
+BUS_BUFFER_SIZE = ActiveConfig.BUS_BUFFER_SIZE
+BUS_RECONNECT_MAX = ActiveConfig.BUS_RECONNECT_MAX
+
+SUBSCRIPTION_ID = 1
+LISTENER_NAME = 'CI Listener'
 
 
 class MessageRouter(object):
     def __init__(self):
         self.listenning = True
         self.conn = None
+        # run id -> column values, ids of messages to ack after commit
+        self._pending = OrderedDict()
+        self._acks = []
+        self._cond = threading.Condition()
+        self._disconnected = threading.Event()
 
     def connect(self):
         self.conn = stomp.Connection([(BUS_HOST, BUS_PORT)])
-        self.conn.set_listener('CI Listener', self)
+        self.conn.set_listener(LISTENER_NAME, self)
         self.conn.start()
         self.conn.connect(login=BUS_USER, passcode=BUS_PASSWORD)
         self.conn.subscribe(
             destination=BUS_DISTINATION,
-            id=1,
-            ack='auto',
+            id=SUBSCRIPTION_ID,
+            ack='client-individual',
             headers={'selector': "(libvirt_dashboard_submitted = 'true')"}
         )
 
+    def disconnect(self):
+        """
+        Disconnect on purpose, without notifying a disconnection.
+        """
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            # Receipt of DISCONNECT calls on_disconnected from the receiver thread
+            conn.remove_listener(LISTENER_NAME)
+            if conn.is_connected():
+                conn.disconnect()
+
+    def reconnect(self):
+        """
+        Reconnect with exponential backoff, until connected or stopped.
+        """
+        # Unacked messages will be redelivered on new connection
+        with self._cond:
+            self._pending, self._acks = OrderedDict(), []
+            self._cond.notify_all()
+
+        delay = 1
+        while self.listenning:
+            try:
+                self.disconnect()
+                self.connect()
+                return
+            except Exception as error:
+                LOGGER.error("Failed to connect to message bus: %s, retry in %ss", error, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, BUS_RECONNECT_MAX)
+
     def start(self):
         def _signal_handler(*_):
             """
@@ -45,12 +96,72 @@ class MessageRouter(object):
             """
             LOGGER.info('Terminating subscription.')
             self.listenning = False
-            self.conn.disconnect()
+            with self._cond:
+                self._cond.notify_all()
+            self.flush()
+            self.disconnect()
             sys.exit(0)
 
         self.connect()
         signal.signal(signal.SIGINT, _signal_handler)
-        signal.pause()
+
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+        while self.listenning:
+            # Wait with timeout, so signals are handled
+            if self._disconnected.wait(1):
+                self._disconnected.clear()
+                self.reconnect()
+
+    def _flush_loop(self):
+        while self.listenning:
+            with self._cond:
+                if len(self._acks) < BUS_BATCH_SIZE:
+                    self._cond.wait(BUS_FLUSH_INTERVAL / 1000.0)
+            self.flush()
+
+    def flush(self):
+        """
+        Apply buffered updates in one transaction, and ack their messages.
+        """
+        with self._cond:
+            pending, acks = self._pending, self._acks
+            self._pending, self._acks = OrderedDict(), []
+        if not acks:
+            return
+
+        try:
+            with app.app_context():
+                for run_id, values in pending.items():
+                    count = Run.query.filter(Run.id == run_id).update(
+                        values, synchronize_session=False)
+                    if not count:
+                        LOGGER.error("No matching test run for ID: {}".format(run_id))
+                    else:
+                        LOGGER.info("Updated Test run ID: {}".format(run_id))
+                db.session.commit()
+        except Exception:
+            LOGGER.exception("Failed to apply %s messages, will retry", len(acks))
+            # Put them back before newer updates
+            with self._cond:
+                for run_id, values in self._pending.items():
+                    pending.setdefault(run_id, {}).update(values)
+                self._pending, self._acks = pending, acks + self._acks
+            return
+        with app.app_context():
+            ResponseCache.invalidate_runs(pending.keys())
+
+        try:
+            for message_id in acks:
+                self.conn.ack(message_id, SUBSCRIPTION_ID)
+        except Exception:
+            # Reconnected meanwhile, messages will be redelivered
+            LOGGER.exception("Failed to ack messages")
+
+        with self._cond:
+            self._cond.notify_all()
 
     def on_message(self, headers, message):
         """
@@ -65,23 +176,22 @@ class MessageRouter(object):
         message = json.loads(message)
         status = message.get('status')
         log_url = message.get('log-url')
-        with app.app_context():
-            if status == "passed":
-                count = Run.query.filter(Run.id == libvirt_dashboard_id).update({
-                    "submit_status": status,
-                    "submit_log": log_url,
-                    "submit_date": datetime.datetime.now()
-                })
-            else:
-                count = Run.query.filter(Run.id == libvirt_dashboard_id).update({
-                    "submit_status": status,
-                    "submit_log": log_url,
-                })
-            Run.query.session.commit()
-            if not count:
-                LOGGER.error("No matching test run for ID: {}".format(libvirt_dashboard_id))
-            else:
-                LOGGER.info("Updated Test run ID: {}".format(libvirt_dashboard_id))
+
+        values = {
+            "submit_status": status,
+            "submit_log": log_url,
+        }
+        if status == "passed":
+            values["submit_date"] = datetime.datetime.now()
+
+        with self._cond:
+            while self.listenning and len(self._acks) >= BUS_BUFFER_SIZE:
+                self._cond.wait()
+            # Later messages of a run overrides earlier ones
+            self._pending.setdefault(libvirt_dashboard_id, {}).update(values)
+            self._acks.append(headers['message-id'])
+            if len(self._acks) >= BUS_BATCH_SIZE:
+                self._cond.notify_all()
 
         # TODO: a task to set Polarion build id?
 
@@ -90,9 +200,12 @@ class MessageRouter(object):
         LOGGER.info("=" * 72)
         LOGGER.info('Message headers:\n%s', headers)
         LOGGER.info('Message body:\n%s', message)
-        time.sleep(10)
-        self.conn.disconnect()
-        self.connect()
+        self._disconnected.set()
+
+    def on_disconnected(self):
+        if self.listenning:
+            LOGGER.info('Disconnected from message bus.')
+            self._disconnected.set()
 
 
 if __name__ == "__main__":
@@ -4,21 +4,23 @@ Wrapper for Pylaroin
 """
 import logging
 import datetime
-import tempfile
+import uuid
 
-import os
 import sys
-import re
 import ssl
+import threading
 import traceback
 
+import six
 import requests
+from requests.adapters import HTTPAdapter
 
 import xml.etree.ElementTree as ET
-import xml.dom.minidom
+from xml.sax.saxutils import quoteattr
 
 from config import ActiveConfig
 from app import celery
+from .metrics import timed
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s|%(message)s',
@@ -34,12 +36,48 @@ POLARION_PLANS = ActiveConfig.POLARION_PLANS
 POLARION_PROJECT = ActiveConfig.POLARION_PROJECT
 POLARION_PASSWORD = ActiveConfig.POLARION_PASSWORD
 POLARION_DEFAULT_PLANNED_IN = ActiveConfig.POLARION_DEFAULT_PLANNED_IN
+POLARION_PRETTY_XML = ActiveConfig.POLARION_PRETTY_XML
+
+# Shared by all submissions of a worker process, reuses connections
+_session = None
+_session_lock = threading.Lock()
+
+# Characters not allowed in XML documents, see
+# http://stackoverflow.com/questions/1707890/fast-way-to-filter-illegal-xml-unicode-chars-in-python
+_ILLEGAL_XML_CHARS = dict(
+    (code, None) for low, high in [
+        (0x00, 0x08), (0x0B, 0x1F), (0x7F, 0x84), (0x86, 0x9F),
+        (0xD800, 0xDFFF), (0xFDD0, 0xFDDF), (0xFFFE, 0xFFFF),
+        (0x1FFFE, 0x1FFFF), (0x2FFFE, 0x2FFFF), (0x3FFFE, 0x3FFFF),
+        (0x4FFFE, 0x4FFFF), (0x5FFFE, 0x5FFFF), (0x6FFFE, 0x6FFFF),
+        (0x7FFFE, 0x7FFFF), (0x8FFFE, 0x8FFFF), (0x9FFFE, 0x9FFFF),
+        (0xAFFFE, 0xAFFFF), (0xBFFFE, 0xBFFFF), (0xCFFFE, 0xCFFFF),
+        (0xDFFFE, 0xDFFFF), (0xEFFFE, 0xEFFFF), (0xFFFFE, 0xFFFFF),
+        (0x10FFFE, 0x10FFFF)]
+    for code in range(low, high + 1) if code <= sys.maxunicode)
 
 
 class PolarionException(Exception):
     pass
 
 
+def get_session():
+    """
+    Get the shared requests session, with a keep-alive connection pool.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.auth = (POLARION_USER, POLARION_PASSWORD)
+            session.verify = False  # FIXME
+            adapter = HTTPAdapter(pool_connections=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
 def get_nearest_plan(kw, date=None):
     """
     Get next nearest next plan ID
@@ -79,6 +117,50 @@ def get_nearest_plan(kw, date=None):
         raise PolarionException("Unable to find a planned in.")
 
 
+def clean_xml_text(value):
+    """
+    Text of value, with characters illegal in XML removed.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    else:
+        value = six.text_type(value)
+    return value.translate(_ILLEGAL_XML_CHARS)
+
+
+def _indent(element, level):
+    """
+    Indent sub elements in place, for pretty printing.
+    """
+    padding = "\n" + "  " * (level + 1)
+    children = list(element)
+    if children:
+        if not (element.text or "").strip():
+            element.text = padding
+        for child in children:
+            _indent(child, level + 1)
+            child.tail = padding
+        children[-1].tail = padding[:-2]
+
+
+def _serialize(element, level, pretty):
+    if pretty:
+        _indent(element, level)
+        return b"  " * level + ET.tostring(element, encoding='utf-8') + b"\n"
+    return ET.tostring(element, encoding='utf-8')
+
+
+def _tag(tag, attrs, level, pretty, close=False):
+    if close:
+        text = "</%s>" % tag
+    else:
+        text = "<%s%s>" % (tag, "".join(" %s=%s" % (k, quoteattr(clean_xml_text(v)))
+                                        for k, v in sorted(attrs.items())))
+    if pretty:
+        text = "  " * level + text + "\n"
+    return text.encode('utf-8')
+
+
 class TestSuites(object):
     POLARION_PROPERTIES = [
         "polarion-testrun-id",
@@ -114,73 +196,64 @@ class TestSuites(object):
             key = "polarion-custom-{}".format(key)
         self.properties[key] = value
 
-    def build_xml_str(self):
-        xml_element = ET.Element("testsuites")
+    def iter_xml(self, pretty=False):
+        """
+        Yield the XUnit document in chunks of UTF-8 bytes, one testcase
+        per chunk, testcases are never held in memory all together.
+        """
+        yield b'<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield _tag("testsuites", {}, 0, pretty)
 
         if self.properties:
-            props_element = ET.SubElement(xml_element, "properties")
+            props_element = ET.Element("properties")
             for k, v in self.properties.items():
-                attrs = {'name': str(k), 'value': str(v)}
+                attrs = {'name': clean_xml_text(k), 'value': clean_xml_text(v)}
                 ET.SubElement(props_element, "property", attrs)
+            yield _serialize(props_element, 1, pretty)
 
         for suite in self.testsuites:
-            xml_element.append(suite.build_xml_doc())
-
-        xml_string = ET.tostring(xml_element)
-        xml_string = TestSuites._clean_illegal_xml_chars(xml_string.decode('utf-8'))
-        xml_string = xml.dom.minidom.parseString(xml_string).toprettyxml()
-
-        return xml_string
-
-    @staticmethod
-    def _clean_illegal_xml_chars(string_to_clean):
-        """
-        Removes any illegal unicode characters from the given XML string, Copy & paste code
-        """
-        # see http://stackoverflow.com/questions/1707890/fast-way-to-filter-illegal-xml-unicode-chars-in-python
-        illegal_unichrs = [(0x00, 0x08), (0x0B, 0x1F), (0x7F, 0x84), (0x86, 0x9F),
-                           (0xD800, 0xDFFF), (0xFDD0, 0xFDDF), (0xFFFE, 0xFFFF),
-                           (0x1FFFE, 0x1FFFF), (0x2FFFE, 0x2FFFF), (0x3FFFE, 0x3FFFF),
-                           (0x4FFFE, 0x4FFFF), (0x5FFFE, 0x5FFFF), (0x6FFFE, 0x6FFFF),
-                           (0x7FFFE, 0x7FFFF), (0x8FFFE, 0x8FFFF), (0x9FFFE, 0x9FFFF),
-                           (0xAFFFE, 0xAFFFF), (0xBFFFE, 0xBFFFF), (0xCFFFE, 0xCFFFF),
-                           (0xDFFFE, 0xDFFFF), (0xEFFFE, 0xEFFFF), (0xFFFFE, 0xFFFFF),
-                           (0x10FFFE, 0x10FFFF)]
+            for chunk in suite.iter_xml(1, pretty):
+                yield chunk
 
-        illegal_ranges = ["%s-%s" % (unichr(low), unichr(high))
-                          for (low, high) in illegal_unichrs
-                          if low < sys.maxunicode]
+        yield _tag("testsuites", {}, 0, pretty, close=True)
 
-        illegal_xml_re = re.compile(u'[%s]' % u''.join(illegal_ranges))
-        return illegal_xml_re.sub('', string_to_clean)
+    def build_xml_str(self, pretty=True):
+        return b"".join(self.iter_xml(pretty)).decode('utf-8')
 
 
 class TestSuite(object):
     """
     Contains a set of TestCase object
+
+    testcases can be any iterable of TestCase, then counts of the suite,
+    a dict of tests, failures, errors, skipped and time, must be given
+    as they are written before the testcases.
     """
-    def __init__(self, name):
+    def __init__(self, name, testcases=None, counts=None):
         self.name = name
-        self.testcases = []
+        self.testcases = [] if testcases is None else testcases
+        self.counts = counts
 
     def add_testcase(self, testcase):
         assert isinstance(testcase, TestCase)
         self.testcases.append(testcase)
 
-    def build_xml_doc(self):
-        xml_element = ET.Element("testsuite", {
-            'failures': str(self.failures),
-            'errors': str(self.errors),
-            'skipped': str(self.skipped),
-            'tests': str(len(self.testcases)),
-            'time': str(self.time),
-            'name': str(self.name)
-        })
+    def iter_xml(self, level=0, pretty=False):
+        counts = self.counts or {
+            'failures': self.failures,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'tests': len(self.testcases),
+            'time': self.time,
+        }
+        attrs = dict((key, str(value)) for key, value in counts.items())
+        attrs['name'] = self.name
+        yield _tag("testsuite", attrs, level, pretty)
 
         for testcase in self.testcases:
-            xml_element.append(testcase.build_xml_doc())
+            yield _serialize(testcase.build_xml_doc(), level + 1, pretty)
 
-        return xml_element
+        yield _tag("testsuite", {}, level, pretty, close=True)
 
     @property
     def failures(self):
@@ -238,30 +311,30 @@ class TestCase(object):
         status = iter([self.failure, self.skipped, self.error])
         assert self.passed or any(status) and not any(status)
 
-        attrs = {"name": str(self.name)}
+        attrs = {"name": clean_xml_text(self.name)}
         if self.classname:
-            attrs["classname"] = str(self.classname)
+            attrs["classname"] = clean_xml_text(self.classname)
         if self.elapsed_sec:
             attrs["time"] = str(self.elapsed_sec)
 
         xml_element = ET.Element("testcase", attrs)
 
         if self.failure:
-            ET.SubElement(xml_element, "failure", {"type": "failure", "message": str(self.failure)})
+            ET.SubElement(xml_element, "failure", {"type": "failure", "message": clean_xml_text(self.failure)})
 
         if self.skipped:
-            ET.SubElement(xml_element, "skipped", {"type": "skipped", "message": str(self.skipped)})
+            ET.SubElement(xml_element, "skipped", {"type": "skipped", "message": clean_xml_text(self.skipped)})
 
         if self.error:
-            ET.SubElement(xml_element, "error", {"type": "error", "message": str(self.error)})
+            ET.SubElement(xml_element, "error", {"type": "error", "message": clean_xml_text(self.error)})
 
-        ET.SubElement(xml_element, "system-out").text = str(self.stdout or "")
-        ET.SubElement(xml_element, "system-err").text = str(self.stderr or "")
+        ET.SubElement(xml_element, "system-out").text = clean_xml_text(self.stdout or "")
+        ET.SubElement(xml_element, "system-err").text = clean_xml_text(self.stderr or "")
 
         if self.properties:
             props_element = ET.SubElement(xml_element, "properties")
             for k, v in self.properties.items():
-                attrs = {'name': str(k), 'value': str(v)}
+                attrs = {'name': clean_xml_text(k), 'value': clean_xml_text(v)}
                 ET.SubElement(props_element, "property", attrs)
 
         return xml_element
@@ -287,12 +360,8 @@ class TestRunRecord(object):
             key = "polarion-{}".format(key)
         return self.tss.properties[key]
 
-    def add_testcase(
-            self, case, result, elapsed_sec, comment=None):
-        """
-        Update test run content according to the test cases.
-        """
-
+    @staticmethod
+    def _make_testcase(case, result, elapsed_sec, comment=None):
         if result not in ['failed', 'passed', 'blocked']:
             raise PolarionException('Result can only be "failed", "passed" or "blocked"')
 
@@ -304,27 +373,47 @@ class TestRunRecord(object):
             record.failure = comment
         elif result == "blocked":
             record.error = comment
+        return record
 
+    def add_testcase(
+            self, case, result, elapsed_sec, comment=None):
+        """
+        Update test run content according to the test cases.
+        """
+        record = self._make_testcase(case, result, elapsed_sec, comment)
         self.ts.add_testcase(record)
         return record
 
-    def submit(self):
+    def stream_testcases(self, records, counts):
         """
-        Submit / Update a test run on polarion.
+        Use an iterable of (case, result, elapsed_sec, comment) as test
+        cases, they are consumed only when submitting. counts is a dict
+        of tests, failures, errors, skipped and time of these records.
         """
-        xmldoc = self.tss.build_xml_str()
-        fd, temp_path = tempfile.mkstemp()
-
-        with open(temp_path, "w") as fp:
-            fp.write(xmldoc)
+        self.ts.testcases = (self._make_testcase(*record) for record in records)
+        self.ts.counts = counts
 
-        with open(temp_path, "r") as fp:
-            res = requests.post("{}/import/xunit".format(POLARION_URL),
-                                auth=(POLARION_USER, POLARION_PASSWORD),
-                                files={"temp_path": fp}, verify=False)  # FIXME
-            if res.status_code != requests.status_codes.codes.ok:
-                return res.text
+    def submit(self, pretty=POLARION_PRETTY_XML):
+        """
+        Submit / Update a test run on polarion.
 
-        os.close(fd)
+        The XUnit document is streamed as the upload body while generated.
+        """
+        boundary = uuid.uuid4().hex
+
+        def _body():
+            yield ('--%s\r\n'
+                   'Content-Disposition: form-data; name="temp_path"; filename="xunit.xml"\r\n'
+                   'Content-Type: application/xml\r\n\r\n' % boundary).encode('utf-8')
+            for chunk in self.tss.iter_xml(pretty):
+                yield chunk
+            yield ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
+        with timed('polarion'):
+            res = get_session().post(
+                "{}/import/xunit".format(POLARION_URL), data=_body(),
+                headers={'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+        if res.status_code != requests.status_codes.codes.ok:
+            return res.text
 
         return None
@@ -0,0 +1,139 @@
+"""
+Cache of API responses, scoped by test run
+
+Each scope (a test run, or the tag list) has a generation, cache keys
+and ETags are derived from it, so invalidating a scope just replaces its
+generation. Generations are shared through redis if RESPONSE_CACHE_URL
+is set, else through the database, so invalidations done by other
+processes (celery workers, the bus consumer, other web workers) are seen
+by all of them. Invalidations need an app context.
+"""
+import uuid
+import hashlib
+import functools
+
+from flask import request, Response
+from flask_restful.utils import unpack
+from sqlalchemy import select
+
+from config import ActiveConfig
+from .cache import make_cache, RedisCache
+from ..model import db, CacheGeneration, insert_ignore
+
+RESPONSE_CACHE_SIZE = ActiveConfig.RESPONSE_CACHE_SIZE
+RESPONSE_CACHE_TTL = ActiveConfig.RESPONSE_CACHE_TTL
+RESPONSE_CACHE_URL = ActiveConfig.RESPONSE_CACHE_URL
+
+TAGS_SCOPE = 'tags'
+# Any run added or removed
+RUNS_SCOPE = 'runs'
+
+
+
+class DatabaseGenerations(object):
+    """
+    Generations stored in the database. Read in the session of the
+    request, written in their own transactions, so they are not rolled
+    back along with the caller.
+    """
+    table = CacheGeneration.__table__
+
+    def get(self, key, default=None):
+        value = db.session.execute(select([self.table.c.generation])
+                                   .where(self.table.c.scope == key)).scalar()
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        with db.engine.begin() as connection:
+            connection.execute(insert_ignore(connection, self.table), scope=key, generation=value)
+
+    def delete(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete().where(self.table.c.scope == key))
+
+    def clear(self):
+        with db.engine.begin() as connection:
+            connection.execute(self.table.delete())
+
+
+_responses = make_cache('response:', RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_URL)
+# Never looked up in a local cache first, a stale generation is a stale response
+_generations = (RedisCache(RESPONSE_CACHE_URL, prefix='generation:') if RESPONSE_CACHE_URL
+                else DatabaseGenerations())
+
+
+def run_scope(run_id, **_):
+    return 'run:%s' % run_id
+
+
+def tags_scope(**_):
+    return TAGS_SCOPE
+
+
+def runs_scope(**_):
+    return RUNS_SCOPE
+
+
+def generation(scope):
+    generation = _generations.get(scope)
+    if generation is None:
+        _generations.set(scope, uuid.uuid4().hex)
+        # Another process may have set it first
+        generation = _generations.get(scope)
+    return generation
+
+
+def invalidate(*scopes):
+    """
+    Invalidate all cached responses of scopes, call after commit.
+    """
+    for scope in scopes:
+        _generations.delete(scope)
+
+
+def invalidate_runs(run_ids):
+    invalidate(*[run_scope(run_id) for run_id in run_ids])
+
+
+def clear():
+    _responses.clear()
+    _generations.clear()
+
+
+def cached(scope):
+    """
+    Cache successful responses of a resource method, scope is a function
+    which takes the view arguments and returns the scope of response.
+
+    Responses carry an ETag, a request with a matching If-None-Match
+    gets a 304 without touching the database.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not RESPONSE_CACHE_SIZE:
+                return func(*args, **kwargs)
+
+            key = hashlib.sha1(("%s %s %s" % (
+                generation(scope(**kwargs)), request.full_path,
+                request.accept_mimetypes)).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(key):
+                return Response(status=304, headers={'ETag': '"%s"' % key})
+
+            entry = _responses.get(key)
+            if entry is None:
+                ret = func(*args, **kwargs)
+                if isinstance(ret, Response):
+                    # Streamed, not cached
+                    return ret
+                data, status, headers = unpack(ret)
+                if status != 200:
+                    return ret
+                entry = {'data': data, 'headers': dict(headers)}
+                _responses.set(key, entry)
+
+            headers = dict(entry['headers'])
+            headers['ETag'] = '"%s"' % key
+            return entry['data'], 200, headers
+        return wrapper
+    return decorator
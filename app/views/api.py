@@ -1,8 +1,24 @@
-from flask import Blueprint, request
+import re
+import json
+import logging
+import functools
+
+from flask import Blueprint, request, current_app
 from flask_restful import Resource, Api, reqparse, inputs
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, contains_eager
+
+from ..model import db, AutoResult, AutoResultDaily, CaseName, ManualResult, Run, Tag, BATCH_SIZE
+from ..model.linkage import LinkageEngine
+from ..model.diff import diff_runs, CHANGES
+from ..model import archive as Archive
+from ..utils import caselink as CaseLink
+from ..utils import response_cache as ResponseCache
+from ..utils.response_cache import cached, run_scope, tags_scope, runs_scope
+from .pagination import parse_fields, select_fields, parse_datetime, \
+    wants_stream, wants_page, stream_response, paginate
 
-from ..model import db, AutoResult, ManualResult, LinkageResult, Run, Tag, Property
+LOGGER = logging.getLogger('lib-dash.api')
 
 restful_api = Blueprint('restful_api', __name__)
 
@@ -42,18 +58,152 @@ AutoResultUpdateParser.replace_argument('case', required=False)
 AutoResultUpdateParser.replace_argument('time', type=inputs.regex('^[0-9]+.[0-9]+$'), required=False)
 
 
+AUTO_RESULT_FIELDS = ['time', 'output', 'failure', 'source', 'skip']
+
+TIME_RE = re.compile('^[0-9]+.[0-9]+$')
+
+# Max number of test runs in one diff
+DIFF_MAX_RUNS = 50
+
+
 ManualResultUpdateParser = reqparse.RequestParser(bundle_errors=True)
 ManualResultUpdateParser.add_argument('result', required=False)
 
 
+def restoring(func):
+    """
+    Restore results of an archived test run before a resource method
+    accesses them. Goes under cached, so cache hits don't restore.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if Archive.restore([kwargs['run_id']]):
+            ResponseCache.invalidate(run_scope(kwargs['run_id']))
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def _load_bulk_records():
+    """
+    Yield result dicts from a JSON array or NDJSON request body.
+    """
+    if request.mimetype in ['application/x-ndjson', 'application/jsonlines']:
+        for line in request.stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+    else:
+        records = request.get_json(force=True, silent=True)
+        if not isinstance(records, list):
+            raise ValueError('Expecting a JSON array')
+        for record in records:
+            yield record
+
+
+def _validate_auto_result(record):
+    """
+    Validate a submitted auto result like AutoResultParser does,
+    return a status dict and the cleaned result (None if invalid).
+    """
+    if not isinstance(record, dict):
+        return {'case': None, 'status': 'invalid', 'message': 'Result should be an object'}, None
+    case = record.get('case')
+    status = {'case': case, 'status': 'invalid'}
+    if not case:
+        status['message'] = 'Missing required parameter: case'
+        return status, None
+    if 'output' not in record:
+        status['message'] = 'Missing required parameter: output'
+        return status, None
+    if not TIME_RE.match(str(record.get('time', ''))):
+        status['message'] = 'Invalid parameter: time'
+        return status, None
+    result = dict((key, record.get(key)) for key in AUTO_RESULT_FIELDS)
+    result['case'] = case
+    result['time'] = float(result['time'])
+    return status, result
+
+
+def _load_column(model, field):
+    # Texts are loaded by digest, names of auto cases by id
+    if field in getattr(model, 'TEXT_FIELDS', []):
+        return field + '_digest'
+    if field == 'case' and model is AutoResult:
+        return 'case_id'
+    return field
+
+
+def _result_list(model, run_id):
+    """
+    List results of a test run, paginated by case if asked to.
+    """
+    fields = parse_fields()
+    text_fields = getattr(model, 'TEXT_FIELDS', [])
+    query = model.query.filter(model.run_id == run_id)
+    case = model.case
+    if model is AutoResult:
+        # Order by names of auto cases joined once, instead of a subquery per row
+        query = query.join(CaseName, CaseName.id == model.case_id)\
+            .options(contains_eager(model.case_entry))
+        case = CaseName.name
+    if fields:
+        # Output is never listed, see AutoResult.as_dict
+        fields = [field for field in fields
+                  if (field in model.__table__.columns.keys() or field in text_fields or
+                      field == 'case') and field != 'output']
+        query = query.options(load_only(*[_load_column(model, field)
+                                          for field in fields or ['case']]))
+
+    def _serialize(results):
+        if text_fields:
+            model.load_texts(results, [field for field in
+                                       (text_fields if fields is None else fields)
+                                       if field in text_fields and field != 'output'])
+        if fields is None:
+            return [result.as_dict() for result in results]
+        return [dict((field, getattr(result, field)) for field in fields) for result in results]
+
+    if wants_stream():
+        return stream_response(query.order_by(case), _serialize, many=True)
+
+    if wants_page():
+        try:
+            results, cursor = paginate(query, [case], lambda r: [r.case])
+        except ValueError as err:
+            return {'message': str(err)}, 400
+        headers = {'X-Next-Cursor': cursor} if cursor else {}
+        return _serialize(results), 200, headers
+
+    results = query.all()
+    ret = []
+    for idx in range(0, len(results), BATCH_SIZE):
+        ret.extend(_serialize(results[idx:idx + BATCH_SIZE]))
+    return ret
+
+
 class TestRunList(Resource):
     def get(self):
-        runs = Run.query.all()
-        ret = []
-        for run in runs:
-            ret.append(run.as_dict(statistics=True))
-        db.session.commit()
-        return ret
+        fields = parse_fields()
+
+        def _serialize(runs):
+            return [select_fields(run, fields) for run in
+                    Run.batch_as_dict(runs, statistics=True)]
+
+        if wants_stream():
+            return stream_response(Run.query.order_by(Run.date, Run.id), _serialize, many=True)
+
+        if wants_page():
+            try:
+                runs, cursor = paginate(Run.query, [Run.date, Run.id],
+                                        lambda run: [run.date.isoformat(), run.id],
+                                        lambda key: [parse_datetime(key[0]), int(key[1])])
+            except ValueError as err:
+                return {'message': str(err)}, 400
+            headers = {'X-Next-Cursor': cursor} if cursor else {}
+        else:
+            runs, headers = Run.query.all(), {}
+
+        return _serialize(runs), 200, headers
 
     def post(self):
         args = TestRunParser.parse_args()
@@ -61,6 +211,7 @@ class TestRunList(Resource):
             run = Run(**args)
             db.session.add(run)
             db.session.commit()
+            ResponseCache.invalidate(tags_scope(), runs_scope())
         except IntegrityError as err:
             db.session.rollback()
             if "_test_run_id_uc" in  err.message:
@@ -74,64 +225,63 @@ class TestRunList(Resource):
 
 
 class TestRunDetail(Resource):
+    @cached(run_scope)
     def get(self, run_id):
         run = Run.query.get(run_id)
         if not run:
             return {'message': 'Test Run doesn\'t exists'}, 400
-        ret = run.as_dict(statistics=True)
-        db.session.commit()
-        return ret
+        return run.as_dict(statistics=True)
 
+    @restoring
     def delete(self, run_id):
         res = Run.query.get(run_id)
         if not res:
             return {'message': 'Test Run doesn\'t exists'}, 400
-        for record in AutoResult.query.filter(AutoResult.run_id == run_id):
-            db.session.delete(record)
-        for record in ManualResult.query.filter(ManualResult.run_id == run_id):
-            db.session.delete(record)
-        for record in Property.query.filter(Property.run_id == run_id):
-            db.session.delete(record)
-        for record in LinkageResult.query.filter(LinkageResult.run_id == run_id):
-            db.session.delete(record)
-        res.tags = []
+        ret = res.as_dict()
+        AutoResultDaily.forget_runs(db.session.connection(), [run_id])
+        Run.delete_runs([run_id])
         db.session.commit()
-        db.session.delete(res)
-        db.session.commit()
-        return res.as_dict()
+        if ret['archive_path']:
+            Archive.remove_files([ret['archive_path']])
+        ResponseCache.invalidate(run_scope(run_id), tags_scope(), runs_scope())
+        return ret
 
     def put(self, run_id):
+        """
+        Update fields of a test run, tags and properties are kept.
+        """
         args = TestRunParser.parse_args()
         run = Run.query.get(run_id)
         if not run:
             return {'message': 'Test Run doesn\'t exists'}, 400
         for key in args.keys():
-            run[key] = args[key]
+            if key not in ['tags', 'properties']:
+                setattr(run, key, args[key])
         db.session.add(run)
         db.session.commit()
-        return run, 201
+        ResponseCache.invalidate(run_scope(run_id), tags_scope(), runs_scope())
+        return run.as_dict(), 201
 
 
 class AutoResultList(Resource):
     """
     Auto case results of a Auto run record
     """
+    @cached(run_scope)
+    @restoring
     def get(self, run_id):
         run = Run.query.get(run_id)
         if not run:
             return {'message': 'Test Run doesn\'t exists'}, 400
-        results = run.auto_results.all()
-        ret = []
-        for run in results:
-            ret.append(run.as_dict())
-        return ret
+        return _result_list(AutoResult, run_id)
 
+    @restoring
     def post(self, run_id):
         args = AutoResultParser.parse_args()
         result = args
         result['run_id'] = run_id
 
-        result_instance = AutoResult.query.get((run_id, result['case']))
+        result_instance = AutoResult.query.filter_by(run_id=run_id, case=result['case']).first()
         if not result_instance:
             result_instance = AutoResult()
         elif result_instance.result != 'missing':
@@ -143,31 +293,129 @@ class AutoResultList(Resource):
         try:
             result_instance.refresh_result()
             result_instance.gen_linkage_result()
-            result_instance.refresh_comment()
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             raise
+        finally:
+            ResponseCache.invalidate(run_scope(run_id))
         return result_instance.as_dict()
 
 
+class AutoResultBulk(Resource):
+    """
+    Auto case results of a Auto run record, submitted in one batch
+
+    Body is either a JSON array of results or NDJSON (one result per line,
+    with content type application/x-ndjson), each result takes the same
+    fields as a single POST to AutoResultList.
+    """
+    @restoring
+    def post(self, run_id):
+        run = Run.query.get(run_id)
+        if not run:
+            return {'message': 'Test Run doesn\'t exists'}, 400
+
+        try:
+            chunk_size = int(request.args.get('chunk_size', current_app.config['BULK_CHUNK_SIZE']))
+        except ValueError:
+            return {'message': 'Invalid chunk_size'}, 400
+        if chunk_size <= 0:
+            return {'message': 'Invalid chunk_size'}, 400
+
+        try:
+            records = list(_load_bulk_records())
+        except ValueError as err:
+            return {'message': 'Malformed body: %s' % err}, 400
+
+        statuses, accepted = [], {}
+        for record in records:
+            status, result = _validate_auto_result(record)
+            if result is not None and result['case'] in accepted:
+                status, result = {'case': result['case'], 'status': 'invalid',
+                                  'message': 'Duplicated case in request'}, None
+            statuses.append(status)
+            if result is not None:
+                accepted[result['case']] = (status, result)
+
+        cases = list(accepted.keys())
+        CaseLink.prefetch(cases)
+
+        # Each chunk is committed with its linkage, or not at all
+        written = 0
+        for idx in range(0, len(cases), chunk_size):
+            chunk = cases[idx:idx + chunk_size]
+            try:
+                # Linkage of previous chunks may have added cases as missing
+                existing = dict((instance.case, instance) for instance in AutoResult.query.filter(
+                    AutoResult.run_id == run_id, AutoResult.case.in_(chunk)))
+                instances, new = [], []
+                for case in chunk:
+                    status, result = accepted[case]
+                    instance = existing.get(case)
+                    if instance is None:
+                        # Not added to the session, written in bulk by LinkageEngine
+                        instance = AutoResult(run_id=run_id, case=case)
+                        new.append(instance)
+                        status['status'] = 'created'
+                    elif instance.result != 'missing':
+                        status['status'] = 'conflict'
+                        status['message'] = 'AutoResult already exists'
+                        continue
+                    else:
+                        status['status'] = 'updated'
+                    instance.update(**result)
+                    instance.refresh_result()
+                    instances.append(instance)
+
+                engine = LinkageEngine(db.session, run_id)
+                engine.add(new)
+                engine.resolve(instances)
+                engine.flush()
+                db.session.commit()
+                written += len(instances)
+            except Exception as err:
+                db.session.rollback()
+                LOGGER.exception("Failed to submit auto results of run %s", run_id)
+                for case in chunk:
+                    status = accepted[case][0]
+                    if status['status'] != 'conflict':
+                        status['status'] = 'error'
+                        status['message'] = 'Failed to save result: %s' % err
+        if written:
+            ResponseCache.invalidate(run_scope(run_id))
+
+        ret = {'run_id': run_id, 'results': statuses}
+        for status in statuses:
+            ret[status['status']] = ret.get(status['status'], 0) + 1
+        if not written and ret.get('error'):
+            return ret, 500
+        if not written and statuses:
+            return ret, 400
+        return ret
+
+
 class AutoResultDetail(Resource):
+    @restoring
     def get(self, run_id, case_name):
-        res = AutoResult.query.get((run_id, case_name))
+        res = AutoResult.query.filter_by(run_id=run_id, case=case_name).first()
         if not res:
             return {'message': 'AutoResult doesn\'t exists'}, 400
         return res.as_dict(detailed=True)
 
+    @restoring
     def delete(self, run_id, case_name):
-        res = AutoResult.query.get((run_id, case_name))
+        res = AutoResult.query.filter_by(run_id=run_id, case=case_name).first()
         if not res:
             return {'message': 'AutoResult doesn\'t exists'}, 400
         db.session.delete(res)
         db.session.commit()
+        ResponseCache.invalidate(run_scope(run_id))
         return res.as_dict()
 
+    @restoring
     def put(self, run_id, case_name):
-        res = AutoResult.query.get((run_id, case_name))
+        res = AutoResult.query.filter_by(run_id=run_id, case=case_name).first()
         if not res:
             return {'message': 'AutoResult doesn\'t exists'}, 400
 
@@ -179,9 +427,9 @@ class AutoResultDetail(Resource):
             setattr(res, (key), result[(key)])
 
         res.gen_linkage_result(gen_manual=False)
-        res.refresh_comment()
 
         db.session.commit()
+        ResponseCache.invalidate(run_scope(run_id))
 
         return res.as_dict()
 
@@ -190,32 +438,34 @@ class ManualResultList(Resource):
     """
     Auto case results of a Auto run record
     """
+    @cached(run_scope)
+    @restoring
     def get(self, run_id):
         run = Run.query.get(run_id)
         if not run:
             return {'message': 'Test Run doesn\'t exists'}, 400
-        results = run.manual_results.all()
-        ret = []
-        for run in results:
-            ret.append(run.as_dict())
-        return ret
+        return _result_list(ManualResult, run_id)
 
 
 class ManualResultDetail(Resource):
+    @restoring
     def get(self, run_id, case_name):
         res = ManualResult.query.get((run_id, case_name))
         if not res:
             return {'message': 'ManualResult doesn\'t exists'}, 400
         return res.as_dict()
 
+    @restoring
     def delete(self, run_id, case_name):
         res = ManualResult.query.get((run_id, case_name))
         if not res:
             return {'message': 'ManualResult doesn\'t exists'}, 400
         db.session.delete(res)
         db.session.commit()
+        ResponseCache.invalidate(run_scope(run_id))
         return res.as_dict()
 
+    @restoring
     def put(self, run_id, case_name):
         res = ManualResult.query.get((run_id, case_name))
         if not res:
@@ -230,10 +480,43 @@ class ManualResultDetail(Resource):
 
         db.session.add(res)
         db.session.commit()
+        ResponseCache.invalidate(run_scope(run_id))
 
         return res.as_dict()
 
 
+class TestRunDiff(Resource):
+    """
+    Changed auto cases between test runs, each run is compared with
+    the one before it. Runs are given in the URL for a two-way diff,
+    or as a comma separated "runs" argument for a run series.
+    """
+    def get(self, run_a=None, run_b=None):
+        try:
+            if run_a is not None:
+                run_ids = [run_a, run_b]
+            else:
+                run_ids = [int(run_id) for run_id in request.args.get('runs', '').split(',')]
+            time_threshold = float(request.args.get(
+                'time_threshold', current_app.config['DIFF_TIME_THRESHOLD']))
+        except ValueError:
+            return {'message': 'Invalid runs or time_threshold'}, 400
+        if not 2 <= len(run_ids) <= DIFF_MAX_RUNS:
+            return {'message': 'Between 2 and %s runs can be compared' % DIFF_MAX_RUNS}, 400
+        if Run.query.filter(Run.id.in_(run_ids)).count() != len(set(run_ids)):
+            return {'message': 'Test Run doesn\'t exists'}, 400
+        if Archive.restore(run_ids):
+            ResponseCache.invalidate_runs(run_ids)
+
+        counts = dict((change, 0) for change in CHANGES)
+        cases = []
+        for case in diff_runs(run_ids, time_threshold, current_app.config['DIFF_TIME_MIN']):
+            for change in case['changes']:
+                counts[change['type']] += 1
+            cases.append(case)
+        return {'runs': run_ids, 'counts': counts, 'cases': cases}
+
+
 class ErrorList(Resource):
     def get(self):
         ResultWithError = AutoResult.query.filter(AutoResult.error.isnot(None))
@@ -244,6 +527,7 @@ class ErrorList(Resource):
 
 
 class TagList(Resource):
+    @cached(tags_scope)
     def get(self):
         tags = Tag.query.all()
         ret = []
@@ -255,8 +539,10 @@ class TagList(Resource):
 api.add_resource(TestRunList, '/run/', endpoint='test_run_list')
 api.add_resource(TestRunDetail, '/run/<int:run_id>/', endpoint='test_run_detail')
 api.add_resource(AutoResultList, '/run/<int:run_id>/auto/', endpoint='auto_result_list')
+api.add_resource(AutoResultBulk, '/run/<int:run_id>/bulk/auto/', endpoint='auto_result_bulk')
 api.add_resource(AutoResultDetail, '/run/<int:run_id>/auto/<string:case_name>/', endpoint='auto_result_detail')
 api.add_resource(ManualResultList, '/run/<int:run_id>/manual/', endpoint='manual_result_list')
 api.add_resource(ManualResultDetail, '/run/<int:run_id>/manual/<string:case_name>/', endpoint='manual_result_detail')
+api.add_resource(TestRunDiff, '/diff/', '/diff/<int:run_a>/<int:run_b>/', endpoint='test_run_diff')
 api.add_resource(ErrorList, '/error/', endpoint='error_list')
 api.add_resource(TagList, '/tag/', endpoint='tag_list')
@@ -1,18 +1,34 @@
 import re
 import datetime
-from sqlalchemy.exc import IntegrityError
 from flask import Blueprint, render_template, request, jsonify
 from flask import current_app as app
 
-from ..model import db, AutoResult, ManualResult, LinkageResult, Run, Tag
+from ..model import db, ManualResult, Run, Tag
+from ..model import archive as Archive
+from ..utils import caselink as CaseLink
+from ..utils import response_cache as ResponseCache
 from ..tasks import submit_to_polarion as submit_to_polarion_task
-from ..tasks import get_running_tasks_status
+from ..tasks import refresh_testrun as refresh_testrun_task
+from ..tasks import refresh_auto as refresh_auto_task
+from ..tasks import refresh_manual as refresh_manual_task
+from ..tasks import get_running_tasks_status, get_task_status, cancel_task
 
 dashboard = Blueprint('dashboard', __name__)
 
 CHUNK_SIZE = 128
 
 
+@dashboard.before_request
+def restore_archived_run():
+    """
+    Restore results of an archived test run before it's resolved,
+    refreshed or submitted.
+    """
+    run_id = (request.view_args or {}).get('run_id')
+    if run_id is not None and Archive.restore([run_id]):
+        ResponseCache.invalidate_runs([run_id])
+
+
 @dashboard.route('/', methods=['GET'])
 def index():
     return render_template('testrun_overview.html')
@@ -52,71 +68,30 @@ def resolve_manualcase(run_id):
 
 @dashboard.route('/trigger/run/<int:run_id>/refresh', methods=['GET'])
 def refresh_testrun(run_id):
-    LinkageResult.query.filter(LinkageResult.run_id == run_id).\
-        delete(synchronize_session=False)
-    ManualResult.query.filter(ManualResult.run_id == run_id).\
-        delete(synchronize_session=False)
-    AutoResult.query.filter(
-        AutoResult.run_id == run_id,
-        AutoResult.output == None,
-        AutoResult.failure == None,
-        AutoResult.skip == None).\
-        delete(synchronize_session=False)
-
-    for result_instance in AutoResult.query.filter(AutoResult.run_id == run_id):
-        result_instance.refresh_result()
-        result_instance.gen_linkage_result(session=db.session)
-        result_instance.refresh_comment()
-        db.session.add(result_instance)
-
-    try:
-        db.session.commit()
-    except IntegrityError as e:
-        db.session.rollback()
-        return jsonify({'message': 'db error'}), 500
-
-    return jsonify({'message': 'done'}), 200
+    invalidate = request.args.get('invalidate', False) == 'true'
+    task = refresh_testrun_task.delay(run_id, invalidate=invalidate)
+    return jsonify({'message': 'Task queued', 'task_id': task.id}), 200
 
 
 @dashboard.route('/trigger/run/<int:run_id>/auto/<string:case>/refresh', methods=['GET'])
 @dashboard.route('/trigger/run/<int:run_id>/auto/refresh', methods=['GET'])
 def refresh_auto(run_id, case=None):
-    gen_error = request.args.get('error', False) == 'true'
-    gen_result = request.args.get('result', False) == 'true'
-    if case:
-        query = AutoResult.query.filter(AutoResult.run_id == run_id, AutoResult.case == case)
-    else:
-        query = AutoResult.query.filter(AutoResult.run_id == run_id)
-
-    for result_instance in query:
-        result_instance.refresh_result()
-        result_instance.gen_linkage_result(db.session, gen_manual=False)
-        result_instance.refresh_comment()
-
-    try:
-        db.session.commit()
-    except IntegrityError as e:
-        db.session.rollback()
-        return jsonify({'message': 'db error'}), 500
-    return jsonify({'message': 'success'}), 200
+    invalidate = request.args.get('invalidate', False) == 'true'
+    task = refresh_auto_task.delay(run_id, case=case, invalidate=invalidate)
+    return jsonify({'message': 'Task queued', 'task_id': task.id}), 200
 
 
 @dashboard.route('/trigger/run/<int:run_id>/manual/refresh', methods=['GET'])
 def refresh_manual(run_id):
-    ManualResult.query.filter(ManualResult.run_id == run_id).\
-        delete(synchronize_session=False)
+    invalidate = request.args.get('invalidate', False) == 'true'
+    task = refresh_manual_task.delay(run_id, invalidate=invalidate)
+    return jsonify({'message': 'Task queued', 'task_id': task.id}), 200
 
-    for result_instance in AutoResult.query.filter(AutoResult.run_id == run_id):
-        result_instance.gen_linkage_result(db.session, gen_manual=False)
-        result_instance.refresh_comment()
 
-    try:
-        db.session.commit()
-    except IntegrityError as e:
-        db.session.rollback()
-        return jsonify({'message': 'db error'}), 500
-
-    return jsonify({'message': 'success'}), 200
+@dashboard.route('/trigger/caselink/invalidate', methods=['GET'])
+def invalidate_caselink():
+    CaseLink.invalidate_all()
+    return jsonify({'message': 'Caselink cache cleared'}), 200
 
 
 @dashboard.route('/trigger/run/submit', methods=['GET'])
@@ -139,6 +114,9 @@ def submit_to_polarion(run_id=None, run_regex=None):
     if test_runs.count() == 0:
         return jsonify({'message': 'No matching test runs founded'}), 403
 
+    if run_regex and Archive.restore([run.id for run in test_runs]):
+        ResponseCache.invalidate_runs([run.id for run in test_runs])
+
     for test in test_runs:
         errors = test.blocking_errors()
         if not forced and errors:
@@ -155,10 +133,21 @@ def submit_to_polarion(run_id=None, run_regex=None):
     test_runs.update({Run.submit_task: str(task)})
 
     db.session.commit()
+    ResponseCache.invalidate_runs([run.id for run in test_runs])
 
     return jsonify({'message': 'Tasks queued'}), 200
 
 
 @dashboard.route('/tasks', methods=['GET'])
 def get_tasks(run_id=None, run_regex=None):
-    return jsonify(_get_running_tasks_status()), 200
+    return jsonify(get_running_tasks_status()), 200
+
+
+@dashboard.route('/tasks/<string:task_id>', methods=['GET'])
+def get_task(task_id):
+    return jsonify(get_task_status(task_id)), 200
+
+
+@dashboard.route('/tasks/<string:task_id>/cancel', methods=['GET'])
+def cancel(task_id):
+    return jsonify(cancel_task(task_id)), 200
@@ -3,20 +3,17 @@ API for datatable.
 """
 import json
 
-from sqlalchemy import func
 from flask_restful import Resource, Api
 from flask import Blueprint, request
 
-from config import ActiveConfig
-
-from ..model import db, Run, Tag, AutoResult, ManualResult
+from ..model import Run, Tag, AutoResult, ManualResult
+from ..model.search import run_name_filter, contains_case_filter
+from ..utils import count_cache as CountCache
 
 dt_api = Blueprint('dt_api', __name__)
 
 api = Api(dt_api)
 
-SQLITE = ActiveConfig.SQLALCHEMY_DATABASE_URI.startswith("sqlite")
-
 
 class TestRunList(Resource):
     def get(self):
@@ -24,7 +21,7 @@ class TestRunList(Resource):
         start = request.args.get('start', None)
         length = request.args.get('length', None)
         search_value = request.args.get('search[value]')
-        search_regex = request.args.get('search[regex]')
+        search_regex = request.args.get('search[regex]') == 'true'
 
         submit_status = request.args.get('submitStatus', '')
         contains_autocase = request.args.get('containsAutocases', '')
@@ -41,13 +38,11 @@ class TestRunList(Resource):
 
         order = getattr(order_col, order_dir)()
 
-        total = Run.query.count()
+        total = CountCache.count(Run.query)
 
         filtered = Run.query
         if search_value:
-            filtered = filtered.filter(Run.name.like("%%%s%%" % search_value))
-        if search_regex and not SQLITE:
-            filtered = filtered.filter(Run.name.op("~")(search_value))
+            filtered = filtered.filter(run_name_filter(search_value, regex=search_regex))
 
         try:
             tags = json.loads(has_tags)
@@ -62,11 +57,12 @@ class TestRunList(Resource):
         if tags:
             filtered = filtered.filter(Run.tags.any(Tag.name.in_(tags)))
 
-        if contains_autocase and SQLITE:
-            filtered = filtered.filter(Run.auto_results.any(AutoResult.case.op('~')(contains_autocase)))
+        # Case filters are regex where supported
+        if contains_autocase:
+            filtered = filtered.filter(contains_case_filter(AutoResult, contains_autocase, regex=True))
 
-        if contains_manualcase and SQLITE:
-            filtered = filtered.filter(Run.manual_results.any(ManualResult.case.op('~')(contains_manualcase)))
+        if contains_manualcase:
+            filtered = filtered.filter(contains_case_filter(ManualResult, contains_manualcase, regex=True))
 
         if submit_status:
             if submit_status == 'all':
@@ -76,26 +72,27 @@ class TestRunList(Resource):
             elif submit_status == 'submitted':
                 filtered = filtered.filter(Run.submit_date != None)
 
-        filtered = filtered.order_by(order)
-
-        count = filtered.count()
+        if search_value or tags or contains_autocase or contains_manualcase or \
+                submit_status in ('notsubmitted', 'submitted'):
+            count = CountCache.count(filtered, {
+                'search': search_value, 'regex': search_regex, 'tags': tags,
+                'autocases': contains_autocase, 'manualcases': contains_manualcase,
+                'status': submit_status})
+        else:
+            count = total
 
-        ret = []
+        filtered = filtered.order_by(order)
 
         if start is not None:
             filtered = filtered.offset(start)
         if length is not None:
             filtered = filtered.limit(length)
 
-        for run in filtered:
-            ret.append(run.as_dict(statistics=True))
-            db.session.commit()
-
         return {
             'draw': draw,
             'recordsTotal': total,
             'recordsFiltered': count,
-            'data': ret,
+            'data': Run.batch_as_dict(filtered, statistics=True),
         }
 
 
@@ -0,0 +1,133 @@
+"""
+Keyset pagination, field selection and NDJSON streaming for list APIs.
+
+Lists are paginated when "limit" or "cursor" is given, the cursor of
+next page is sent in X-Next-Cursor header. "fields" is a comma separated
+list of keys to return, "format=ndjson" streams the whole list.
+"""
+import json
+import base64
+import datetime
+
+from sqlalchemy import and_, or_
+from flask import Response, request, stream_with_context
+
+STREAM_CHUNK_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Raise ValueError on malformed cursor.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError) as err:
+        raise ValueError(str(err))
+    if not isinstance(values, list):
+        raise ValueError("Cursor should be a list")
+    return values
+
+
+def parse_datetime(value):
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    raise ValueError("Invalid date %s" % value)
+
+
+def parse_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+def select_fields(data, fields):
+    if not fields:
+        return data
+    return dict((key, data[key]) for key in fields if key in data)
+
+
+def wants_stream():
+    return (request.args.get('format') == 'ndjson' or
+            request.accept_mimetypes.best == 'application/x-ndjson')
+
+
+def wants_page():
+    return 'limit' in request.args or 'cursor' in request.args
+
+
+def stream_response(query, serialize, many=False):
+    """
+    Stream query results as NDJSON, rows are fetched in chunks.
+    If many is True, serialize takes a chunk of instances and returns a list.
+    """
+    def _chunks():
+        chunk = []
+        for instance in query.yield_per(STREAM_CHUNK_SIZE):
+            chunk.append(instance)
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _generate():
+        for chunk in _chunks():
+            data = serialize(chunk) if many else [serialize(i) for i in chunk]
+            for item in data:
+                yield json.dumps(item) + "\n"
+    return Response(stream_with_context(_generate()), mimetype='application/x-ndjson')
+
+
+def keyset_filter(query, columns, values, descending=False):
+    """
+    Filter rows ordered after values on columns, same as
+    (col1, col2, ...) > (val1, val2, ...) on databases with row values,
+    or < if descending.
+    """
+    clauses = []
+    for idx, column in enumerate(columns):
+        clause = [columns[i] == values[i] for i in range(idx)]
+        clause.append(column < values[idx] if descending else column > values[idx])
+        clauses.append(and_(*clause))
+    return query.filter(or_(*clauses))
+
+
+def paginate(query, columns, dump_key, load_key=None, descending=False):
+    """
+    Get one page of query ordered by columns, return the instances and the
+    cursor of next page (None for last page).
+
+    dump_key takes an instance and returns JSON serializable key values,
+    load_key converts them back. Raise ValueError on invalid arguments.
+    """
+    limit = int(request.args.get('limit', MAX_PAGE_SIZE))
+    if limit <= 0 or limit > MAX_PAGE_SIZE:
+        raise ValueError("limit should be between 1 and %s" % MAX_PAGE_SIZE)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != len(columns):
+            raise ValueError("Cursor doesn't match this list")
+        if load_key:
+            values = load_key(values)
+        query = keyset_filter(query, columns, values, descending)
+
+    if descending:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*columns)
+    instances = query.limit(limit + 1).all()
+    if len(instances) > limit:
+        instances = instances[:limit]
+        return instances, encode_cursor(dump_key(instances[-1]))
+    return instances, None
@@ -1,9 +1,13 @@
-from datetime import datetime
-from flask import Blueprint, Markup, render_template, request, jsonify
-from sqlalchemy.orm import load_only, joinedload
+from datetime import datetime, time, timedelta
+from flask import Blueprint, Markup, render_template, request, jsonify, current_app
+from sqlalchemy import func
+from sqlalchemy.orm import load_only
 from collections import Counter
 
-from ..model import db, Run, AutoResult, ManualResult, Run
+from ..model import db, Run, AutoResult, AutoResultDaily, CaseHistory, \
+    CaseName, ManualResult, Run, BATCH_SIZE
+from ..utils import matcher as Matcher
+from .pagination import paginate, parse_datetime
 
 dashboard_statistics = Blueprint('dashboard_statistics', __name__)
 CHUNCK_SIZE = 300
@@ -17,77 +21,135 @@ def parse_date(keyword):
     return ret
 
 
-@dashboard_statistics.route('/auto/', methods=['GET'])
-@dashboard_statistics.route('/run/<string:test_run>/auto/', methods=['GET'])
-def autocase_statistics(test_run=None):
-    def parse_date(keyword):
-        try:
-            ret = datetime(*[int(num) for num in request.args.get(keyword).split('-')])
-        except (AttributeError, TypeError, ValueError):
-            ret = None
-        return ret
+def _is_day(value):
+    return value is None or value.time() == time()
+
+
+def _count_auto_results(query, ret):
+    """
+    Add (case, result, count) rows of query to per case statistics.
+    """
+    for case, result, count in query:
+        statistics = ret.setdefault(case, {
+            'failed': 0,
+            'passed': 0,
+            'skipped': 0,
+            'invalid': 0,
+            'total': 0,
+        })
+        result = result or 'invalid'
+        statistics[result] = statistics.get(result, 0) + count
+        statistics['total'] += count
+    return ret
 
-    after = parse_date('after')
-    before = parse_date('before')
 
-    query = AutoResult.query
+def _live_counts(test_run, after=None, before=None):
+    query = db.session.query(CaseName.name, AutoResult.result, func.count())\
+        .select_from(AutoResult).join(CaseName, CaseName.id == AutoResult.case_id)
 
     if after or before or test_run:
-        query = query.join(Run)
+        query = query.join(Run, Run.id == AutoResult.run_id)
 
     if before:
         query = query.filter(Run.date < before)
 
+    # Inclusive like whole days of the rollup
     if after:
-        query = query.filter(Run.date > after)
+        query = query.filter(Run.date >= after)
 
     if test_run:
         query = query.filter(Run.name == test_run)
 
-    cases = query.options(load_only('output', 'failure', 'skip', 'case')).yield_per(CHUNCK_SIZE)
+    return query.group_by(CaseName.name, AutoResult.result)
 
-    ret = {}
 
-    for result_instance in cases:
-        statistics = ret.setdefault(result_instance.case, {
-            'failed': 0,
-            'passed': 0,
-            'skipped': 0,
-            'invalid': 0,
-            'total': 0,
-        })
-        statistics['total'] += 1
-        if result_instance.result is None:
-            statistics['invalid'] += 1
-        else:
-            statistics[result_instance.result] += 1
-    return jsonify(ret), 200
+def _rollup_counts(test_run, after=None, before=None):
+    query = db.session.query(AutoResultDaily.case, AutoResultDaily.result,
+                             func.sum(AutoResultDaily.count))
 
+    if before:
+        query = query.filter(AutoResultDaily.day < before.date())
 
-@dashboard_statistics.route('/auto/<string:case>', methods=['GET'])
-def autocase_detail(case):
-    cases = AutoResult.query.filter(AutoResult.case == case)\
-            .options(joinedload('run'))\
-            .yield_per(CHUNCK_SIZE)
+    if after:
+        query = query.filter(AutoResultDaily.day >= after.date())
 
-    ret = {}
+    if test_run:
+        query = query.filter(AutoResultDaily.run_name == test_run)
 
-    for result_instance in cases:
-        statistics = ret.setdefault(result_instance.case, {
-            'failed': [],
-            'passed': [],
-            'skipped': [],
-            'invalid': [],
-            'total': 0,
-        })
-        statistics['total'] += 1
-        if result_instance.result is None:
-            statistics['invalid'].append(result_instance.run.as_dict())
-        else:
-            statistics[result_instance.result].append(result_instance.run.as_dict())
+    return query.group_by(AutoResultDaily.case, AutoResultDaily.result)
+
+
+@dashboard_statistics.route('/auto/', methods=['GET'])
+@dashboard_statistics.route('/run/<string:test_run>/auto/', methods=['GET'])
+def autocase_statistics(test_run=None):
+    """
+    Count auto results of each case by result, of test runs dated from
+    after (inclusive) to before (exclusive).
+
+    If STATISTICS_ROLLUP is enabled and after/before are whole days,
+    days already rolled up are read from the daily rollup, which keeps
+    counts of purged and archived test runs.
+    """
+    after = parse_date('after')
+    before = parse_date('before')
+
+    ret = {}
+    last_day = AutoResultDaily.last_day() if current_app.config['STATISTICS_ROLLUP'] else None
+    if last_day and _is_day(after) and _is_day(before):
+        end = datetime.combine(last_day + timedelta(days=1), time())
+        _count_auto_results(_rollup_counts(test_run, after, min(before or end, end)), ret)
+        if before is None or before > end:
+            _count_auto_results(_live_counts(test_run, max(after or end, end), before), ret)
+    else:
+        _count_auto_results(_live_counts(test_run, after, before), ret)
     return jsonify(ret), 200
 
 
+@dashboard_statistics.route('/auto/<string:case>', methods=['GET'])
+def autocase_detail(case):
+    """
+    History of an auto case with a summary by result, newest first,
+    paginated with "limit" and "cursor". "expand=run" includes the
+    test run of each entry in this page.
+    """
+    summary = {
+        'failed': 0,
+        'passed': 0,
+        'skipped': 0,
+        'invalid': 0,
+        'total': 0,
+    }
+    for result, count in db.session.query(CaseHistory.result, func.count())\
+            .filter(CaseHistory.case == case)\
+            .group_by(CaseHistory.result):
+        result = result or 'invalid'
+        summary[result] = summary.get(result, 0) + count
+        summary['total'] += count
+
+    query = CaseHistory.query.filter(CaseHistory.case == case)
+    try:
+        history, cursor = paginate(query, [CaseHistory.date, CaseHistory.run_id],
+                                   lambda entry: [entry.date.isoformat(), entry.run_id],
+                                   lambda key: [parse_datetime(key[0]), int(key[1])],
+                                   descending=True)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    ret = [entry.as_dict() for entry in history]
+    if request.args.get('expand') == 'run':
+        run_ids = [entry.run_id for entry in history]
+        runs = {}
+        for idx in range(0, len(run_ids), BATCH_SIZE):
+            for run in Run.batch_as_dict(
+                    Run.query.filter(Run.id.in_(run_ids[idx:idx + BATCH_SIZE]))):
+                runs[run['id']] = run
+        for entry in ret:
+            entry['run'] = runs.get(entry['run_id'])
+
+    headers = {'X-Next-Cursor': cursor} if cursor else {}
+    return jsonify({'case': case, 'summary': summary, 'history': ret}), 200, headers
+
+
 @dashboard_statistics.route('/run/', methods=['GET'])
 @dashboard_statistics.route('/run/<string:name>', methods=['GET'])
 def testrun_statistics(name=None):
@@ -132,11 +194,11 @@ def testrun_lastest(limit=None):
     if limit:
         query = query.limit(limit)
 
-    runs = query.options(load_only('date', 'name', 'id')).yield_per(CHUNCK_SIZE)
-    ret = []
+    return jsonify(Run.batch_as_dict(query, statistics=True)), 200
 
-    for run in runs:
-        ret.append(run.as_dict(statistics=True))
-        db.session.commit()
 
-    return jsonify(ret), 200
+@dashboard_statistics.route('/failure/', methods=['GET'])
+def failure_pattern_statistics():
+    if request.args.get('reset', False) == 'true':
+        Matcher.reset_stats()
+    return jsonify(Matcher.pattern_stats()), 200
@@ -11,6 +11,8 @@ def column_to_table(model, ajax_url, code, extra_column=None):
     """
     columns = model.__table__.columns
     columns = [str(col).split('.')[-1] for col in columns]
+    # Auto results refer to case names by id
+    columns = ['case' if col == 'case_id' else col for col in columns]
     if extra_column:
         columns += extra_column
     resp = make_response(render_template('column_table.html',
@@ -2,13 +2,18 @@
 # Load Flask and config
 from flask_migrate import MigrateCommand
 from flask_script import Manager
-from app import app, db, initdb
+from app import app, db, initdb, rebuild_statistics, rollup_statistics, \
+    purge_runs, archive_runs
 # Start the server
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 manager.command(initdb)
+manager.command(rebuild_statistics)
+manager.command(rollup_statistics)
+manager.command(purge_runs)
+manager.command(archive_runs)
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,151 @@
+"""Refer to auto cases by id of the case name dictionary
+
+Revision ID: 5e0c4b7a9d12
+Revises: 9c41d7e2a8f0
+Create Date: 2026-10-18 18:21:09.604417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e0c4b7a9d12'
+down_revision = '9c41d7e2a8f0'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Number of runs copied by each statement
+BATCH_SIZE = 500
+
+# Case column of each table, by name and by id, referred tables first
+CASE_COLUMNS = [('auto_result', 'case', 'case_id'),
+                ('linkage_results', 'auto_result_id', 'auto_case_id'),
+                ('case_history', 'case', 'case_id')]
+
+case_name = sa.table('case_name', sa.column('id'), sa.column('name'))
+
+
+def _create_tables(ids):
+    """
+    Create tables with case columns by id or by name, suffixed with _new.
+    """
+    def case(table):
+        _, by_name, by_id = [columns for columns in CASE_COLUMNS if columns[0] == table][0]
+        if ids:
+            return sa.Column(by_id, sa.Integer(), nullable=False)
+        return sa.Column(by_name, sa.String(length=65535), nullable=False)
+
+    def case_fk(table):
+        if ids:
+            return [sa.ForeignKeyConstraint([case(table).name], ['case_name.id'], )]
+        return []
+
+    op.create_table('auto_result_new',
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    case('auto_result'),
+    sa.Column('time', sa.Float(), nullable=False),
+    sa.Column('skip_digest', sa.String(length=64), nullable=True),
+    sa.Column('failure_digest', sa.String(length=64), nullable=True),
+    sa.Column('output_digest', sa.String(length=64), nullable=True),
+    sa.Column('source_digest', sa.String(length=64), nullable=True),
+    sa.Column('comment', sa.Text(), nullable=True),
+    sa.Column('result', sa.String(length=255), nullable=True),
+    sa.ForeignKeyConstraint(['failure_digest'], ['blob.digest'], ),
+    sa.ForeignKeyConstraint(['output_digest'], ['blob.digest'], ),
+    sa.ForeignKeyConstraint(['run_id'], ['run.id'], ),
+    sa.ForeignKeyConstraint(['skip_digest'], ['blob.digest'], ),
+    sa.ForeignKeyConstraint(['source_digest'], ['blob.digest'], ),
+    sa.PrimaryKeyConstraint('run_id', case('auto_result').name),
+    *case_fk('auto_result')
+    )
+    op.create_table('linkage_results_new',
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('manual_result_id', sa.String(length=255), nullable=False),
+    case('linkage_results'),
+    sa.Column('error', sa.String(length=255), nullable=True),
+    sa.Column('result', sa.String(length=255), nullable=True),
+    sa.Column('detail', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['run_id', case('linkage_results').name],
+                            ['auto_result_new.run_id', 'auto_result_new.' + case('auto_result').name],
+                            ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['run_id', 'manual_result_id'], ['manual_result.run_id', 'manual_result.case'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['run_id'], ['run.id'], ),
+    sa.PrimaryKeyConstraint('run_id', 'manual_result_id', case('linkage_results').name),
+    *case_fk('linkage_results')
+    )
+    op.create_table('case_history_new',
+    case('case_history'),
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.DateTime(), nullable=False),
+    sa.Column('result', sa.String(length=255), nullable=True),
+    sa.Column('time', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['run_id'], ['run.id'], ),
+    sa.PrimaryKeyConstraint(case('case_history').name, 'run_id'),
+    *case_fk('case_history')
+    )
+
+
+def _copy(table, case, new_case, ids):
+    """
+    Fill <table>_new from table, one batch of runs at a time, replacing
+    column case by new_case, ids (or names) of the case name dictionary.
+    """
+    bind = op.get_bind()
+    columns = [column['name'] for column in sa.inspect(bind).get_columns(table)]
+    old = sa.table(table, *[sa.column(column) for column in columns])
+    new = [column for column in columns if column != case]
+    value, key = (case_name.c.id, case_name.c.name) if ids else (case_name.c.name, case_name.c.id)
+    query = sa.select([old.c[column] for column in new] + [value])\
+        .select_from(old.join(case_name, key == old.c[case]))
+
+    low, high = bind.execute(sa.select([sa.func.min(old.c.run_id), sa.func.max(old.c.run_id)])).first()
+    if low is None:
+        return
+    insert = sa.table(table + '_new', *[sa.column(column) for column in new + [new_case]])
+    for start in range(low, high + 1, BATCH_SIZE):
+        op.execute(insert.insert().from_select(
+            new + [new_case],
+            query.where(sa.and_(old.c.run_id >= start, old.c.run_id < start + BATCH_SIZE))))
+
+
+def _rebuild(ids):
+    """
+    Rebuild tables with case columns by id (or by name), and swap them in.
+    """
+    _create_tables(ids)
+    for table, by_name, by_id in CASE_COLUMNS:
+        if ids:
+            _copy(table, by_name, by_id, ids)
+        else:
+            _copy(table, by_id, by_name, ids)
+    for table, _, _ in reversed(CASE_COLUMNS):
+        op.drop_table(table)
+    for table, _, _ in CASE_COLUMNS:
+        op.rename_table(table + '_new', table)
+        if op.get_bind().dialect.name == 'postgresql':
+            # Keep default names of primary keys
+            op.execute('ALTER TABLE %s RENAME CONSTRAINT %s_new_pkey TO %s_pkey' % (table, table, table))
+
+
+def upgrade():
+    # Every auto case gets an id
+    names = [sa.table(table, sa.column(by_name)).c[by_name] for table, by_name, _ in CASE_COLUMNS]
+    op.execute(case_name.insert().from_select(['name'], sa.union(*[
+        sa.select([name]).where(~sa.exists().where(case_name.c.name == name)) for name in names])))
+
+    _rebuild(ids=True)
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_index('ix_auto_result_case_id_run_id', 'auto_result', ['case_id', 'run_id'], unique=False)
+    op.create_index('ix_auto_result_run_id_result', 'auto_result', ['run_id', 'result'], unique=False)
+    op.create_index('ix_case_history_case_id_date', 'case_history', ['case_id', 'date'], unique=False)
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    _rebuild(ids=False)
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_index('ix_auto_result_case_run_id', 'auto_result', ['case', 'run_id'], unique=False)
+    op.create_index('ix_auto_result_run_id_result', 'auto_result', ['run_id', 'result'], unique=False)
+    op.create_index('ix_case_history_case_date', 'case_history', ['case', 'date'], unique=False)
+    # ### end Alembic commands ###